@@ -0,0 +1,158 @@
+"""
+Apply Journal
+
+Records a sync on disk, so an interrupted sync can be resumed without comparing the zones again.
+
+A journal is a file of JSON lines: a header, then every forward and reverse command pair in the
+order they are applied, then a commit line after each batch is committed, with the position the
+sync has reached.  Commit lines are fsync'd, so the last committed position survives a crash.
+
+Parallel syncs finish commands out of order, so they write progress lines instead, with how many
+statements of each command in the batch are committed.  Each lane can die with a batch committed but
+not recorded, so they also write a begin line before each batch, with the positions of its statements.
+"""
+
+
+import os
+import json
+import time
+import threading
+
+from AbsoluteImport import Import
+
+log = Import('log', prefix='unidist').log
+
+
+# Directory journals are written to, unless a path is given
+JOURNAL_PATH = os.environ.get('DBSYNC_JOURNAL_PATH', os.path.expanduser('~/.dbsync/journal'))
+
+# Bump this when the journal format changes, so old journals are refused instead of misread
+JOURNAL_VERSION = 1
+
+
+# Commit lines are written by all the threads applying batches
+JOURNAL_LOCK = threading.Lock()
+
+
+class JournalError(Exception):
+  """Journal file is missing, unreadable or from a different version."""
+
+
+def GetJournalPath(database_set, zone_source, zone_target, instance):
+  """Returns string, path for a new journal for this sync"""
+  return '%s/%s.%s.%s.%s.%s.journal' % (JOURNAL_PATH, database_set, zone_source, zone_target, instance, time.strftime('%Y%m%d-%H%M%S'))
+
+
+def Create(path, database_set, zone_source, zone_target, instance, forward_commands, reverse_commands):
+  """Write a new journal with all the command pairs.  It is on disk before this returns."""
+  if len(forward_commands) != len(reverse_commands):
+    raise JournalError('Forward and reverse commands are not paired: %s != %s' % (len(forward_commands), len(reverse_commands)))
+
+  header = {'journal':JOURNAL_VERSION, 'database_set':database_set, 'zone_source':zone_source, 'zone_target':zone_target,
+            'instance':instance, 'created':time.time(), 'command_count':len(forward_commands)}
+
+  directory = os.path.dirname(path)
+  if directory and not os.path.isdir(directory):
+    os.makedirs(directory, exist_ok=True)
+
+  # Write to a temp file and rename it into place, so a journal is never missing commands
+  temp_path = '%s.%s.tmp' % (path, os.getpid())
+  with open(temp_path, 'w') as journal_file:
+    journal_file.write(json.dumps(header) + '\n')
+
+    for (forward_command, reverse_command) in zip(forward_commands, reverse_commands):
+      journal_file.write(json.dumps({'forward':forward_command, 'reverse':reverse_command}) + '\n')
+
+    journal_file.flush()
+    os.fsync(journal_file.fileno())
+
+  os.replace(temp_path, path)
+
+  log('Journal created: %s' % path)
+
+
+def Commit(path, position):
+  """Durably record that every statement before position (command index, statement index) is committed"""
+  _WriteCommitLine(path, {'committed':list(position), 'time':time.time()})
+
+
+def CommitProgress(path, progress):
+  """Durably record progress, list of (command index, statement count): the first statements of each command that are committed"""
+  _WriteCommitLine(path, {'progress':[list(item) for item in progress], 'time':time.time()})
+
+
+def Begin(path, positions):
+  """Durably record that a batch of the statements at positions, list of (command index, statement index), is being applied"""
+  _WriteCommitLine(path, {'begin':[list(position) for position in positions], 'time':time.time()})
+
+
+def _WriteCommitLine(path, item):
+  """Append a line to the journal, and fsync it"""
+  with JOURNAL_LOCK:
+    with open(path, 'a') as journal_file:
+      journal_file.write(json.dumps(item) + '\n')
+      journal_file.flush()
+      os.fsync(journal_file.fileno())
+
+
+def Load(path):
+  """Returns dict: header, forward_commands, reverse_commands, and where the sync should resume: position, the
+  (command index, statement index) before which everything is committed, and progress, dict of command index
+  to the number of its statements committed, and replay, list of (command index, statement index) of the
+  statements in begun batches that arent recorded as committed, which may have been committed anyway.
+  """
+  if not os.path.isfile(path):
+    raise JournalError('Journal not found: %s' % path)
+
+  forward_commands = []
+  reverse_commands = []
+  position = (0, 0)
+  progress = {}
+  begun = []
+
+  with open(path) as journal_file:
+    lines = journal_file.read().split('\n')
+
+  try:
+    header = json.loads(lines[0])
+  except ValueError:
+    raise JournalError('Journal header unreadable: %s' % path)
+
+  if header.get('journal') != JOURNAL_VERSION:
+    raise JournalError('Journal version %s, expected %s: %s' % (header.get('journal'), JOURNAL_VERSION, path))
+
+  for (line_number, line) in enumerate(lines[1:], 2):
+    if not line:
+      continue
+
+    try:
+      item = json.loads(line)
+    except ValueError:
+      #NOTE(g): A crash while a commit line was being written leaves it partial.  It wasnt fsync'd,
+      #   so the batch it was for is treated as not committed.
+      if line_number == len(lines):
+        log('Ignoring partial last journal line: %s' % path)
+        break
+      raise JournalError('Journal line %s unreadable: %s' % (line_number, path))
+
+    if 'committed' in item:
+      position = tuple(item['committed'])
+    elif 'begin' in item:
+      begun += [tuple(begin_position) for begin_position in item['begin']]
+    elif 'progress' in item:
+      for (command_index, statement_count) in item['progress']:
+        progress[command_index] = max(statement_count, progress.get(command_index, 0))
+    else:
+      forward_commands.append(item['forward'])
+      reverse_commands.append(item['reverse'])
+
+  if len(forward_commands) != header['command_count']:
+    raise JournalError('Journal has %s commands, expected %s: %s' % (len(forward_commands), header['command_count'], path))
+
+  replay = []
+  for (command_index, statement_index) in begun:
+    if (command_index, statement_index) >= position and statement_index >= progress.get(command_index, 0):
+      replay.append((command_index, statement_index))
+
+  return {'header':header, 'forward_commands':forward_commands, 'reverse_commands':reverse_commands, 'position':position,
+          'progress':progress, 'replay':replay}
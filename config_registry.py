@@ -0,0 +1,69 @@
+"""
+Config Registry
+
+Loads YAML config files once, and parses them again only when they change on disk (their mtime or
+size), so callers can ask for a config as often as they like.  Parsing uses libyaml's C loader,
+when PyYAML was built with it.
+"""
+
+
+import os
+import threading
+
+import yaml
+
+
+# libyaml's loader is many times faster than the pure Python one
+if hasattr(yaml, 'CSafeLoader'):
+  YAML_LOADER = yaml.CSafeLoader
+else:
+  YAML_LOADER = yaml.SafeLoader
+
+
+# Loaded files, keyed on path: (stat key, data)
+CONFIGS = {}
+CONFIGS_LOCK = threading.Lock()
+
+
+def Load(path):
+  """Returns the data of this YAML file, parsing it only if it changed since it was last loaded.
+
+  The data is shared by all callers, and must not be modified.
+  """
+  stat_key = GetStatKey(path)
+
+  with CONFIGS_LOCK:
+    item = CONFIGS.get(path)
+    if item != None and item[0] == stat_key:
+      return item[1]
+
+  with open(path) as config_file:
+    data = yaml.load(config_file, Loader=YAML_LOADER)
+
+  with CONFIGS_LOCK:
+    CONFIGS[path] = (stat_key, data)
+
+  return data
+
+
+def GetChangedPaths():
+  """Returns list of the loaded paths whose files have changed, or gone, since they were loaded"""
+  with CONFIGS_LOCK:
+    items = list(CONFIGS.items())
+
+  changed = []
+  for (path, (stat_key, data)) in items:
+    try:
+      if GetStatKey(path) != stat_key:
+        changed.append(path)
+    except OSError:
+      changed.append(path)
+
+  return changed
+
+
+def GetStatKey(path):
+  """Returns tuple, (mtime in nanoseconds, size) of this file, which changes when the file is written"""
+  stat = os.stat(path)
+
+  return (stat.st_mtime_ns, stat.st_size)
@@ -0,0 +1,385 @@
+"""
+Connection Pool
+
+Thread-safe pool of database connections, used by both query backends.  The backend gives the
+pool functions to create, health check and close its connections, so the pool doesnt care which
+driver is used.
+
+A connection is checked out to a thread.  If the same thread acquires again before releasing, it
+gets the same connection back, so a thread can hold one connection across several queries (for
+transactions) without passing it around.
+
+A held connection can be detached from its thread, and attached to another thread, so one thread
+can open transactions (snapshots) that worker threads then run their queries in.
+
+A connection can also be checked out to no thread, for work that ties it up, like an unbuffered
+stream of rows, while the thread keeps using its own connection.
+"""
+
+
+import threading
+import time
+
+from AbsoluteImport import Import
+
+log = Import('log', prefix='unidist').log
+
+
+# Pool defaults, used unless GetPool() is given other values
+DEFAULT_MIN_SIZE = 0
+DEFAULT_MAX_SIZE = 16
+# Seconds a connection can sit idle before it is closed, unless that would go under min_size
+DEFAULT_IDLE_TIMEOUT = 300
+# Seconds to wait for a connection when max_size are all checked out
+DEFAULT_CHECKOUT_TIMEOUT = 120
+
+
+# All the pools, keyed on the backend's connection cache key
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+
+class PoolTimeout(Exception):
+  """No connection became available before the checkout timeout."""
+
+
+class PoolError(Exception):
+  """Connection was used against the thread ownership rules of the pool."""
+
+
+class ConnectionPool:
+  """Pool of connections to one database.  Connections are checked out per thread."""
+
+  def __init__(self, name, connect, ping=None, close=None, min_size=DEFAULT_MIN_SIZE, max_size=DEFAULT_MAX_SIZE,
+               idle_timeout=DEFAULT_IDLE_TIMEOUT, checkout_timeout=DEFAULT_CHECKOUT_TIMEOUT):
+    """
+    Args:
+      name: string, for logging and metrics.  Should not have a password in it.
+      connect: function(), returns a new connection
+      ping: function(conn), returns boolean, True if the connection is healthy.  Called on checkout.
+      close: function(conn), closes a connection.  Default calls conn.close()
+    """
+    self.name = name
+    self.min_size = min_size
+    self.max_size = max_size
+    self.idle_timeout = idle_timeout
+    self.checkout_timeout = checkout_timeout
+
+    self._connect = connect
+    self._ping = ping
+    self._close = close
+
+    self._lock = threading.Condition()
+    # Idle connections, list of (conn, last_used_time).  The end is the most recently used.
+    self._idle = []
+    # Checked out connections, keyed on thread ID: [conn, acquire_depth]
+    self._owners = {}
+    # Checked out connections that are detached from any thread
+    self._detached = 0
+    # Connections open, idle and checked out
+    self._size = 0
+
+    self.metrics = {'created':0, 'closed':0, 'checkouts':0, 'waits':0, 'wait_seconds':0.0,
+                    'health_check_failures':0, 'reaped':0, 'discarded':0}
+
+
+  def Acquire(self):
+    """Returns a connection checked out to this thread.  Every Acquire() needs a Release()."""
+    thread_id = threading.get_ident()
+
+    with self._lock:
+      owned = self._owners.get(thread_id)
+      if owned:
+        owned[1] += 1
+        return owned[0]
+
+    conn = self._Checkout()
+
+    with self._lock:
+      self._owners[thread_id] = [conn, 1]
+      self.metrics['checkouts'] += 1
+
+    return conn
+
+
+  def Release(self, discard=False):
+    """Release this thread's connection.  It goes back to the pool when the outermost Acquire() is released.
+
+    If discard is True, the connection is broken, and is closed now instead, however deep the Acquire()s are.
+    """
+    thread_id = threading.get_ident()
+    close_conn = None
+
+    with self._lock:
+      owned = self._owners.get(thread_id)
+      if not owned:
+        return
+
+      owned[1] -= 1
+      if owned[1] > 0 and not discard:
+        return
+
+      del self._owners[thread_id]
+
+      if discard:
+        self._size -= 1
+        self.metrics['discarded'] += 1
+        close_conn = owned[0]
+      else:
+        self._idle.append((owned[0], time.time()))
+
+      self._lock.notify()
+
+    if close_conn != None:
+      self._CloseConnection(close_conn)
+
+    self.Reap()
+
+
+  def Detach(self):
+    """Take this thread's connection away from it, however deep its Acquire()s are, and return it.
+
+    The connection stays checked out, so nothing else uses it, until a thread Attach()es it and
+    releases it.  Returns None if this thread doesnt have a connection.
+    """
+    thread_id = threading.get_ident()
+
+    with self._lock:
+      owned = self._owners.pop(thread_id, None)
+      if not owned:
+        return None
+
+      self._detached += 1
+
+    return owned[0]
+
+
+  def Attach(self, conn):
+    """Make a Detach()ed connection this thread's connection, as if this thread had acquired it once."""
+    thread_id = threading.get_ident()
+
+    with self._lock:
+      if thread_id in self._owners:
+        raise PoolError('Thread already has a connection, cant attach another: %s' % self.name)
+
+      self._detached -= 1
+      self._owners[thread_id] = [conn, 1]
+
+
+  def Checkout(self):
+    """Returns a connection that isnt checked out to any thread, for a caller that ties it up for a while.
+
+    This thread's own connection is never returned, so it can keep running queries.  Give it back with Checkin().
+    """
+    conn = self._Checkout()
+
+    with self._lock:
+      self._detached += 1
+      self.metrics['checkouts'] += 1
+
+    return conn
+
+
+  def Checkin(self, conn, discard=False):
+    """Give back a Checkout() connection.  If discard is True, it is closed instead of going back to the pool."""
+    with self._lock:
+      self._detached -= 1
+
+      if discard:
+        self._size -= 1
+        self.metrics['discarded'] += 1
+      else:
+        self._idle.append((conn, time.time()))
+
+      self._lock.notify()
+
+    if discard:
+      self._CloseConnection(conn)
+
+    self.Reap()
+
+
+  def GetThreadConnection(self):
+    """Returns the connection checked out to this thread, or None"""
+    with self._lock:
+      owned = self._owners.get(threading.get_ident())
+
+    if owned:
+      return owned[0]
+    else:
+      return None
+
+
+  def Connection(self):
+    """Returns a context manager that acquires and releases this thread's connection."""
+    return _PoolConnection(self)
+
+
+  def Reap(self):
+    """Close connections that have been idle longer than idle_timeout, keeping at least min_size open."""
+    expired = []
+
+    with self._lock:
+      now = time.time()
+
+      # Oldest idle connections are at the start of the list
+      while self._idle and self._size > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+        (conn, last_used) = self._idle.pop(0)
+        self._size -= 1
+        self.metrics['reaped'] += 1
+        expired.append(conn)
+
+    for conn in expired:
+      self._CloseConnection(conn)
+
+
+  def CloseIdle(self):
+    """Close all idle connections.  Checked out connections are left alone."""
+    with self._lock:
+      idle = self._idle
+      self._idle = []
+      self._size -= len(idle)
+
+    for (conn, last_used) in idle:
+      self._CloseConnection(conn)
+
+
+  def GetMetrics(self):
+    """Returns dict of pool metrics: counters, and the current size, idle and in use connections."""
+    with self._lock:
+      metrics = dict(self.metrics)
+      metrics['size'] = self._size
+      metrics['idle'] = len(self._idle)
+      metrics['in_use'] = len(self._owners) + self._detached
+      metrics['max_size'] = self.max_size
+
+    return metrics
+
+
+  def _Checkout(self):
+    """Returns a healthy idle connection, or a new one, waiting if the pool is at max_size."""
+    start_time = time.time()
+    waited = False
+
+    while True:
+      conn = None
+
+      with self._lock:
+        if self._idle:
+          # Most recently used is the most likely to still be alive
+          (conn, last_used) = self._idle.pop()
+
+        elif self._size < self.max_size:
+          # Reserve the slot now, and connect outside the lock
+          self._size += 1
+
+        else:
+          remaining = self.checkout_timeout - (time.time() - start_time)
+          if remaining <= 0:
+            raise PoolTimeout('No connection available after %s seconds: %s' % (self.checkout_timeout, self.name))
+
+          if not waited:
+            waited = True
+            self.metrics['waits'] += 1
+
+          self._lock.wait(remaining)
+          continue
+
+      if waited:
+        with self._lock:
+          self.metrics['wait_seconds'] += time.time() - start_time
+
+      # New connection
+      if conn == None:
+        try:
+          conn = self._connect()
+        except Exception:
+          with self._lock:
+            self._size -= 1
+            self._lock.notify()
+          raise
+
+        with self._lock:
+          self.metrics['created'] += 1
+
+        return conn
+
+      # Idle connection, make sure it still works before handing it out
+      if self._ping == None or self._Ping(conn):
+        return conn
+
+      log('Connection failed health check, closing: %s' % self.name)
+      with self._lock:
+        self._size -= 1
+        self.metrics['health_check_failures'] += 1
+        self._lock.notify()
+
+      self._CloseConnection(conn)
+
+
+  def _Ping(self, conn):
+    """Returns boolean, True if the connection is healthy"""
+    try:
+      return bool(self._ping(conn))
+    except Exception:
+      return False
+
+
+  def _CloseConnection(self, conn):
+    """Close a connection, ignoring errors, since it is being thrown away"""
+    try:
+      if self._close != None:
+        self._close(conn)
+      else:
+        conn.close()
+    except Exception as exc:
+      log('Error closing connection: %s: %s' % (self.name, exc))
+
+    with self._lock:
+      self.metrics['closed'] += 1
+
+
+class _PoolConnection:
+  """Context manager for ConnectionPool.Connection()"""
+
+  def __init__(self, pool):
+    self.pool = pool
+
+  def __enter__(self):
+    return self.pool.Acquire()
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.pool.Release()
+
+
+def GetPool(key, connect, ping=None, close=None, name=None, **options):
+  """Returns the ConnectionPool for this key, creating it with these arguments if it doesnt exist yet."""
+  with POOLS_LOCK:
+    if key not in POOLS:
+      if name == None:
+        name = str(key)
+
+      POOLS[key] = ConnectionPool(name, connect, ping=ping, close=close, **options)
+
+    return POOLS[key]
+
+
+def CloseAll():
+  """Close the idle connections of every pool.  Checked out connections are left to their threads."""
+  with POOLS_LOCK:
+    pools = list(POOLS.values())
+
+  for pool in pools:
+    pool.CloseIdle()
+
+
+def GetAllMetrics():
+  """Returns dict of pool name to its metrics dict"""
+  with POOLS_LOCK:
+    pools = list(POOLS.values())
+
+  metrics = {}
+  for pool in pools:
+    metrics[pool.name] = pool.GetMetrics()
+
+  return metrics
@@ -20,7 +20,8 @@ import sys
 import os
 import getopt
 import traceback
-import yaml
+import time
+import concurrent.futures
 
 # # Custom script imports
 # import zone_manager
@@ -36,6 +37,8 @@ from AbsoluteImport import Import
 
 log = Import('log', prefix='unidist').log
 zone_manager = Import('zone_manager', prefix='dbsync')
+apply_journal = Import('apply_journal', prefix='dbsync')
+config_registry = Import('config_registry', prefix='dbsync')
 print(zone_manager)
 
 
@@ -43,10 +46,16 @@ print(zone_manager)
 #NOTE(g): Value Tuple = (args, description)
 COMMANDS = {
   'list':('', 'List Groups and their Zones'),
-  'compare':('<database set> <souce_zone> <target_zone> [instance]', 'Compare a Database Set source and target Zone Database Instances, optional DB Instance'),
-  'sync':('<database set> <souce_zone> <target_zone> [instance]', 'Sync a Database Set source and target Zone Database Instances, optional DB Instance'),
+  'compare':('<database set> <souce_zone> <target_zone> [instance]', 'Compare a Database Set source and target Zone Database Instances, optional DB Instance.  Without an instance, every instance is compared in parallel.  Either zone can be a snapshot file, which is compared instead of the live zone'),
+  'snapshot':('<database set> <zone> <instance> [path]', 'Write a snapshot file of a Zone Database Instance: its schema and all its rows, to compare against offline'),
+  'sync':('<database set> <souce_zone> <target_zone>[,<target_zone>...] [instance] | --resume <journal>', 'Sync a Database Set source and target Zone Database Instances, optional DB Instance.  Without an instance, every instance is synced in parallel.  Several comma separated target zones are synced in parallel, reading the source once.  --resume continues an interrupted sync from its journal'),
 }
 
+# Instances of a database set compared or synced at the same time, when no instance is given, and
+#   the most of them using any one database host at the same time
+DEFAULT_INSTANCE_JOBS = 4
+DEFAULT_HOST_JOBS = 2
+
 
 def GetDatabaseSetInstances(database_set, directory_prefix=None):
   """Returns dict of instances"""
@@ -57,7 +66,7 @@ def GetDatabaseSetInstances(database_set, directory_prefix=None):
   if directory_prefix:
     yaml_path = '%s/%s' % (directory_prefix, yaml_path)
 
-  data = yaml.load(open(yaml_path))
+  data = config_registry.Load(yaml_path)
 
   return data
 
@@ -87,7 +96,7 @@ def ProcessCommand(command, args, options):
       for (database_set, database_data) in database_sets.items():
         # If this database set exists and has data, load it (baased on Database Set conf data)
         if database_set in database_set_data and 'data' in database_set_data[database_set]:
-          data = yaml.load(open(database_set_data[database_set]['data']))
+          data = config_registry.Load(database_set_data[database_set]['data'])
           data_str = ' Instances: %s' % len(data)
         else:
           data = None
@@ -122,72 +131,95 @@ def ProcessCommand(command, args, options):
     # Validate arguments
     if database_set not in database_set_data:
       Usage('Database set "%s" is not a valid dataset listed in: conf/database_sets.yaml' % database_set)
-    if zone_source not in zones:
-      Usage('Source Zone "%s" not a valid zone listed in: conf/zones.yaml' % zone_source)
-    if zone_target not in zones:
-      Usage('Target Zone "%s" not a valid zone listed in: conf/zones.yaml' % zone_target)
+    if zone_source not in zones and not zone_manager.IsSnapshotZone(zone_source):
+      Usage('Source Zone "%s" not a valid zone listed in: conf/zones.yaml, or a snapshot file' % zone_source)
+    if zone_target not in zones and not zone_manager.IsSnapshotZone(zone_target):
+      Usage('Target Zone "%s" not a valid zone listed in: conf/zones.yaml, or a snapshot file' % zone_target)
+
+    # Snapshots are of 1 instance, which is compared if none is given
+    for zone in (zone_source, zone_target):
+      if zone_manager.IsSnapshotZone(zone):
+        try:
+          snapshot = zone_manager.GetSnapshotZone(zone, database_set, instance)
+        except zone_manager.ComparisonException as exc:
+          Usage(str(exc))
+
+        print('Snapshot: %s' % snapshot)
+        instance = snapshot.instance
 
     # Get the Database Set data
     #yaml_path = '%s/%s' % (__file__, database_set_data[database_set]['data'])
     yaml_path = '%s' % database_set_data[database_set]['data']
-    data = yaml.load(open(yaml_path))
+    data = config_registry.Load(yaml_path)
     if instance != None and instance not in data:
       Usage('Instance "%s" not found in Database Set data: %s' % (instance, database_set_data[database_set]['data']))
 
-    output += 'Comparing: %s %s %s %s' % (database_set, zone_source, zone_target, instance)
-
-    #TEST: Attempt querying zone, naively...
-    schema_source = zone_manager.GetSchema(zone_source, database_set, instance)
-    schema_target = zone_manager.GetSchema(zone_target, database_set, instance)
+    # No instance, compare every instance in the database set
+    if instance == None:
+      result = RunInstances('compare', database_set, zone_source, zone_target, sorted(data), options)
+    else:
+      result = CompareInstance(database_set, zone_source, zone_target, instance, options)
 
-    # print('schema source:\n%s' % str(schema_source))
-    # print('\n\n');
-    # print('schema target:\n%s' % str(schema_target))
+ # Write a snapshot of a zone database set instance
+  elif command == 'snapshot':
+    if len(args) < 3:
+      Usage('Snapshot: Needs 3 arguments: <database set> <zone> <instance>')
+    elif len(args) > 4:
+      Usage('Snapshot: Too many arguments.  3 are required, the 4th is optional')
 
-    comparison = zone_manager.CompareSchemas(schema_source, schema_target)
-    output += '\n\nComparison: \n'
-    import pprint
-    output += pprint.pformat(comparison)
-
-    # Get the Schema Diff in a key-oriented dictionary format
-    schema_diff_keys = zone_manager.GenerateSchemaDiffKeyDictionary(zone_source, zone_target, database_set, instance, comparison)
-    output += '\n\nSchema Key Diff: \n'
-    import pprint
-    output += pprint.pformat(schema_diff_keys)
-
-
-    # Generate Forward and Reverse commands to sync the Target DB to Source DB
-    (forward_commands, reverse_commands) = zone_manager.GenerateSchemaSyncCommands(zone_source, \
-                                              zone_target, database_set, instance, \
-                                              comparison)
-
-    sql_comparison_forward = zone_manager.GetSql_DatabaseDiff(zone_source, zone_target, database_set, instance)
-    sql_comparison_reverse = zone_manager.GetSql_DatabaseDiff(zone_target, zone_source, database_set, instance)
-    output += '\n\nSQL Comparison: \n'
-    import pprint
-    output += pprint.pformat(sql_comparison_forward)
-
-    # Get the Schema Diff in a key-oriented dictionary format
-    data_diff_keys = zone_manager.GenerateDataDiffKeyDictionary(zone_source, zone_target, database_set, instance, sql_comparison_forward)
-    output += '\n\nData Key Diff: \n'
-    import pprint
-    output += pprint.pformat(data_diff_keys)
-
-
-    forward_commands += zone_manager.CreateSQLFromDataDiff(zone_source, zone_target, database_set, instance, sql_comparison_forward)
-    reverse_commands += zone_manager.CreateSQLFromDataDiff(zone_source, zone_target, database_set, instance, sql_comparison_reverse)
-
-    # If we have any commands
-    if forward_commands or reverse_commands:
-      output += '\n\nCompare completed: \n\nForward: %s\n\nReverse: %s\n\n' % (pprint.pformat(forward_commands), \
-                                                                          pprint.pformat(reverse_commands))
+    (database_set, zone, instance) = args[:3]
+    if len(args) > 3:
+      path = args[3]
     else:
-      output += '\n\nCompare completed: No work to do'
+      path = None
+
+    # Validate arguments
+    if database_set not in database_set_data:
+      Usage('Database set "%s" is not a valid dataset listed in: conf/database_sets.yaml' % database_set)
+    if zone not in zones:
+      Usage('Zone "%s" not a valid zone listed in: conf/zones.yaml' % zone)
+
+    data = config_registry.Load(database_set_data[database_set]['data'])
+    if instance not in data:
+      Usage('Instance "%s" not found in Database Set data: %s' % (instance, database_set_data[database_set]['data']))
 
+    start_time = time.time()
+    (path, tables) = zone_manager.WriteSnapshot(zone, database_set, instance, path=path)
 
-    result = output
+    result = 'Snapshot: %s  %s tables, %s rows, %s bytes, %.2f seconds  (compare with: compare %s %s <zone> %s)' % (path, len(tables),
+             sum(tables.values()), os.path.getsize(path), time.time() - start_time, database_set, path, instance)
 
  # Sync the source and target zone database set instances
+  elif command == 'sync' and args[:1] == ['--resume']:
+    if len(args) != 2:
+      Usage('Sync: --resume needs 1 argument: <journal>')
+
+    journal_path = args[1]
+    try:
+      journal = apply_journal.Load(journal_path)
+    except apply_journal.JournalError as exc:
+      Usage(str(exc))
+
+    header = journal['header']
+    (command_index, statement_index) = journal['position']
+
+    if command_index >= len(journal['forward_commands']):
+      return 'Journal already complete: %s' % journal_path
+
+    print('Resuming: %s %s %s %s from command %s of %s, statement %s, %s commands with parallel progress' % (header['database_set'],
+          header['zone_source'], header['zone_target'], header['instance'], command_index, len(journal['forward_commands']), statement_index,
+          len(journal['progress'])))
+
+    # Apply the rest of the journal's Forward commands, the zones are not compared again
+    totals = zone_manager.SyncTargetZone(header['zone_target'], header['database_set'], header['instance'], journal['forward_commands'],
+                                         journal_path=journal_path, start=journal['position'], progress=journal['progress'],
+                                         workers=options['jobs'], replay=journal['replay'])
+
+    # The journal is complete, its spool files wont be loaded again
+    zone_manager.RemoveSpools(journal['forward_commands'] + journal['reverse_commands'])
+
+    result = GetSyncTotalsReport(totals)
+
   elif command == 'sync':
     # Test all the argument cases for failures
     if len(args) < 1:
@@ -213,73 +245,348 @@ def ProcessCommand(command, args, options):
       Usage('Database set "%s" is not a valid dataset listed in: conf/database_sets.yaml' % database_set)
     if zone_source not in zones:
       Usage('Source Zone "%s" not a valid zone listed in: conf/zones.yaml' % zone_source)
-    if zone_target not in zones:
-      Usage('Target Zone "%s" not a valid zone listed in: conf/zones.yaml' % zone_target)
+
+    # Comma separated target zones are all synced from the source
+    zone_targets = zone_target.split(',')
+    for zone in zone_targets:
+      if zone not in zones:
+        Usage('Target Zone "%s" not a valid zone listed in: conf/zones.yaml' % zone)
+      if zone == zone_source:
+        Usage('Target Zone "%s" is the Source Zone' % zone)
+      if zone_targets.count(zone) > 1:
+        Usage('Target Zone "%s" is given more than once' % zone)
+
+      try:
+        zone_manager.ValidateZoneAcceptsSync(zone_source, zone, database_set)
+      except zone_manager.ComparisonException as exc:
+        Usage(str(exc))
 
     # Get the Database Set data
-    data = yaml.load(open(database_set_data[database_set]['data']))
+    data = config_registry.Load(database_set_data[database_set]['data'])
     if instance != None and instance not in data:
       Usage('Instance "%s" not found in Database Set data: %s' % (instance, database_set_data[database_set]['data']))
 
-    print('Syncing: %s %s %s %s' % (database_set, zone_source, zone_target, instance))
+    # No instance, sync every instance in the database set
+    if instance == None:
+      result = RunInstances('sync', database_set, zone_source, zone_target, sorted(data), options)
+    else:
+      result = SyncInstance(database_set, zone_source, zone_target, instance, options)
 
-    # #TEST: Attempt querying zone, naively...
-    schema_source = zone_manager.GetSchema(zone_source, database_set, instance)
-    schema_target = zone_manager.GetSchema(zone_target, database_set, instance)
 
-    # # print('schema source:\n%s' % str(schema_source))
-    # # print('\n\n');
-    # # print('schema target:\n%s' % str(schema_target))
+  else:
+    #NOTE(g): Running from CLI will test for this, so this is for API usage
+    raise Exception('Unknown command: %s' % command)
+  
+  # Return whatever the result of the command was, so it can be used or formatted
+  return result
 
-    comparison = zone_manager.CompareSchemas(schema_source, schema_target)
-    # #print('Comparison: \n')
-    # #import pprint
-    # #pprint.pprint(comparison)
 
-    # # Generate Forward and Reverse commands to sync the Target DB to Source DB
-    # (forward_commands, reverse_commands) = zone_manager.GenerateSchemaSyncCommands(comparison, zone_source, \
-    #                                           zone_target, database_set, instance)
+def CompareInstance(database_set, zone_source, zone_target, instance, options):
+  """Returns string, the comparison output for 1 instance of a database set"""
+  output = ''
+
+  output += 'Comparing: %s %s %s %s' % (database_set, zone_source, zone_target, instance)
 
-    # schema_source = zone_manager.GetSchema(zone_source, database_set, instance)
-    # schema_target = zone_manager.GetSchema(zone_target, database_set, instance)
+  #TEST: Attempt querying zone, naively...
+  schema_source = zone_manager.GetSchema(zone_source, database_set, instance)
+  schema_target = zone_manager.GetSchema(zone_target, database_set, instance)
 
-    # print('schema source:\n%s' % str(schema_source))
-    # print('\n\n');
-    # print('schema target:\n%s' % str(schema_target))
+  # print('schema source:\n%s' % str(schema_source))
+  # print('\n\n');
+  # print('schema target:\n%s' % str(schema_target))
 
-    # Generate Forward and Reverse commands to sync the Target DB to Source DB
-    (forward_commands, reverse_commands) = zone_manager.GenerateSchemaSyncCommands(zone_source, \
-                                              zone_target, database_set, instance, \
-                                              comparison)
+  comparison = zone_manager.CompareSchemas(schema_source, schema_target)
+  output += '\n\nComparison: \n'
+  import pprint
+  output += pprint.pformat(comparison)
 
-    sql_comparison_forward = zone_manager.GetSql_DatabaseDiff(zone_source, zone_target, database_set, instance)
-    sql_comparison_reverse = zone_manager.GetSql_DatabaseDiff(zone_target, zone_source, database_set, instance)
+  # Get the Schema Diff in a key-oriented dictionary format
+  schema_diff_keys = zone_manager.GenerateSchemaDiffKeyDictionary(zone_source, zone_target, database_set, instance, comparison)
+  output += '\n\nSchema Key Diff: \n'
+  import pprint
+  output += pprint.pformat(schema_diff_keys)
 
-    forward_commands += zone_manager.CreateSQLFromDataDiff(zone_source, zone_target, database_set, instance, sql_comparison_forward)
-    reverse_commands += zone_manager.CreateSQLFromDataDiff(zone_source, zone_target, database_set, instance, sql_comparison_reverse)
 
-    # # If we have any commands
-    # if forward_commands or reverse_commands:
-    #   result = 'Compare completed: \n\nForward: %s\n\nReverse: %s\n\n' % (pprint.pformat(forward_commands), \
-    #                                                                       pprint.pformat(reverse_commands))
-    # else:
-    #   result = 'Compare completed: No work to do'
+  # Generate Forward and Reverse commands to sync the Target DB to Source DB
+  # Compare only shows the commands, so rows arent spooled for bulk loads
+  (forward_commands, reverse_commands) = zone_manager.GenerateSchemaSyncCommands(zone_source, \
+                                            zone_target, database_set, instance, \
+                                            comparison, spool=False)
 
-    import pprint
-    print('Applying SQL:\n%s' % pprint.pformat(forward_commands))
+  sql_comparison_forward = zone_manager.GetSql_DatabaseDiff(zone_source, zone_target, database_set, instance, skip_identical_tables=True,
+                                                            workers=options['jobs'], snapshot=options['snapshot'])
+  output += '\n\nSQL Comparison: \n'
+  import pprint
+  output += pprint.pformat(zone_manager.DataDiffToDicts(sql_comparison_forward))
 
-    # Sync the zone instances with the Forward commands
-    zone_manager.SyncTargetZone(zone_target, database_set, instance, forward_commands)
+  # Get the Schema Diff in a key-oriented dictionary format
+  data_diff_keys = zone_manager.GenerateDataDiffKeyDictionary(zone_source, zone_target, database_set, instance, sql_comparison_forward)
+  output += '\n\nData Key Diff: \n'
+  import pprint
+  output += pprint.pformat(data_diff_keys)
 
-    result = 'Success'
 
+  (data_forward_commands, data_reverse_commands) = zone_manager.CreateSQLFromDataDiffPaired(zone_source, zone_target, database_set, instance,
+                                                                                            sql_comparison_forward, spool=False)
+  forward_commands += data_forward_commands
+  reverse_commands += data_reverse_commands
 
+  # If we have any commands
+  if forward_commands or reverse_commands:
+    output += '\n\nCompare completed: \n\nForward: %s\n\nReverse: %s\n\n' % (pprint.pformat(forward_commands), \
+                                                                        pprint.pformat(reverse_commands))
   else:
-    #NOTE(g): Running from CLI will test for this, so this is for API usage
-    raise Exception('Unknown command: %s' % command)
-  
-  # Return whatever the result of the command was, so it can be used or formatted
-  return result
+    output += '\n\nCompare completed: No work to do'
+
+  return output
+
+
+def SyncInstance(database_set, zone_source, zone_target, instance, options):
+  """Sync 1 instance of a database set.  Returns string, the result."""
+  # Several target zones are synced together
+  if ',' in zone_target:
+    return SyncInstanceTargets(database_set, zone_source, zone_target.split(','), instance, options)
+
+  print('Syncing: %s %s %s %s' % (database_set, zone_source, zone_target, instance))
+
+  # #TEST: Attempt querying zone, naively...
+  schema_source = zone_manager.GetSchema(zone_source, database_set, instance)
+  schema_target = zone_manager.GetSchema(zone_target, database_set, instance)
+
+  # # print('schema source:\n%s' % str(schema_source))
+  # # print('\n\n');
+  # # print('schema target:\n%s' % str(schema_target))
+
+  comparison = zone_manager.CompareSchemas(schema_source, schema_target)
+  # #print('Comparison: \n')
+  # #import pprint
+  # #pprint.pprint(comparison)
+
+  # # Generate Forward and Reverse commands to sync the Target DB to Source DB
+  # (forward_commands, reverse_commands) = zone_manager.GenerateSchemaSyncCommands(comparison, zone_source, \
+  #                                           zone_target, database_set, instance)
+
+  # schema_source = zone_manager.GetSchema(zone_source, database_set, instance)
+  # schema_target = zone_manager.GetSchema(zone_target, database_set, instance)
+
+  # print('schema source:\n%s' % str(schema_source))
+  # print('\n\n');
+  # print('schema target:\n%s' % str(schema_target))
+
+  # Generate Forward and Reverse commands to sync the Target DB to Source DB
+  (forward_commands, reverse_commands) = zone_manager.GenerateSchemaSyncCommands(zone_source, \
+                                            zone_target, database_set, instance, \
+                                            comparison)
+
+  sql_comparison_forward = zone_manager.GetSql_DatabaseDiff(zone_source, zone_target, database_set, instance, skip_identical_tables=True,
+                                                            workers=options['jobs'], snapshot=options['snapshot'])
+
+  (data_forward_commands, data_reverse_commands) = zone_manager.CreateSQLFromDataDiffPaired(zone_source, zone_target, database_set, instance,
+                                                                                            sql_comparison_forward)
+  forward_commands += data_forward_commands
+  reverse_commands += data_reverse_commands
+
+  # # If we have any commands
+  # if forward_commands or reverse_commands:
+  #   result = 'Compare completed: \n\nForward: %s\n\nReverse: %s\n\n' % (pprint.pformat(forward_commands), \
+  #                                                                       pprint.pformat(reverse_commands))
+  # else:
+  #   result = 'Compare completed: No work to do'
+
+  import pprint
+  print('Applying SQL:\n%s' % pprint.pformat(forward_commands))
+
+  # Journal the commands first, so an interrupted sync can be resumed without comparing again
+  journal_path = apply_journal.GetJournalPath(database_set, zone_source, zone_target, instance)
+  apply_journal.Create(journal_path, database_set, zone_source, zone_target, instance, forward_commands, reverse_commands)
+  print('Journal: %s  (resume with: sync --resume %s)' % (journal_path, journal_path))
+
+  # Sync the zone instances with the Forward commands
+  totals = zone_manager.SyncTargetZone(zone_target, database_set, instance, forward_commands, journal_path=journal_path,
+                                       workers=options['jobs'])
+
+  # The journal is complete, its spool files wont be loaded again
+  zone_manager.RemoveSpools(forward_commands + reverse_commands)
+
+  return GetSyncTotalsReport(totals)
+
+
+def SyncInstanceTargets(database_set, zone_source, zone_targets, instance, options):
+  """Sync 1 instance of a database set from the source zone into several target zones.  Returns string, the result of each target.
+
+  The source is read once for all the targets (see zone_manager.GetSql_DatabaseDiffMulti()).  Each target gets its
+  own Forward and Reverse commands and journal, and the targets are synced in parallel.  A failed target doesnt
+  stop the others, and then an exception with every target's result is raised once they are done.
+  """
+  print('Syncing: %s %s %s %s' % (database_set, zone_source, ','.join(zone_targets), instance))
+
+  schema_source = zone_manager.GetSchema(zone_source, database_set, instance)
+
+  # Generate Forward and Reverse commands to sync each Target DB schema to the Source DB
+  target_commands = {}
+  for zone_target in zone_targets:
+    schema_target = zone_manager.GetSchema(zone_target, database_set, instance)
+    comparison = zone_manager.CompareSchemas(schema_source, schema_target)
+
+    target_commands[zone_target] = zone_manager.GenerateSchemaSyncCommands(zone_source, zone_target, database_set, instance, comparison)
+
+  data_diffs = zone_manager.GetSql_DatabaseDiffMulti(zone_source, zone_targets, database_set, instance, skip_identical_tables=True,
+                                                     workers=options['jobs'], snapshot=options['snapshot'])
+
+  journal_paths = {}
+  for zone_target in zone_targets:
+    (forward_commands, reverse_commands) = target_commands[zone_target]
+
+    (data_forward_commands, data_reverse_commands) = zone_manager.CreateSQLFromDataDiffPaired(zone_source, zone_target, database_set, instance,
+                                                                                              data_diffs[zone_target])
+    forward_commands += data_forward_commands
+    reverse_commands += data_reverse_commands
+
+    # Free the diff rows, only the commands are needed now
+    data_diffs[zone_target] = None
+
+    print('Applying SQL: %s: %s commands' % (zone_target, len(forward_commands)))
+
+    # Journal the commands first, so an interrupted sync can be resumed without comparing again
+    journal_paths[zone_target] = apply_journal.GetJournalPath(database_set, zone_source, zone_target, instance)
+    apply_journal.Create(journal_paths[zone_target], database_set, zone_source, zone_target, instance, forward_commands, reverse_commands)
+    print('Journal: %s: %s  (resume with: sync --resume %s)' % (zone_target, journal_paths[zone_target], journal_paths[zone_target]))
+
+  # Sync the zone instances with their Forward commands, all at the same time
+  results = {}
+  with concurrent.futures.ThreadPoolExecutor(max_workers=len(zone_targets)) as executor:
+    futures = {}
+    for zone_target in zone_targets:
+      future = executor.submit(zone_manager.SyncTargetZone, zone_target, database_set, instance, target_commands[zone_target][0],
+                               journal_path=journal_paths[zone_target], workers=options['jobs'])
+      futures[future] = zone_target
+
+    for future in concurrent.futures.as_completed(futures):
+      zone_target = futures[future]
+
+      try:
+        results[zone_target] = (True, GetSyncTotalsReport(future.result()))
+
+        # The journal is complete, its spool files wont be loaded again.  Each target has its own.
+        zone_manager.RemoveSpools(target_commands[zone_target][0] + target_commands[zone_target][1])
+      except Exception as exc:
+        results[zone_target] = (False, 'Failed: %s  (resume with: sync --resume %s)' % (exc, journal_paths[zone_target]))
+
+      print('Sync %s: %s' % (zone_target, results[zone_target][1]))
+
+  output = '\n'.join(['%s: %s' % (zone_target, results[zone_target][1]) for zone_target in zone_targets])
+
+  failed = [zone_target for zone_target in zone_targets if not results[zone_target][0]]
+  if failed:
+    raise Exception('Sync failed for target zones: %s\n\n%s' % (', '.join(failed), output))
+
+  return output
+
+
+def GetSyncTotalsReport(totals):
+  """Returns string, the result of a sync from its SyncTargetZone() totals"""
+  return 'Success: %s statements in %s batches, %.2f seconds, %.2f seconds throttled' % (totals['statements'], totals['batches'], totals['seconds'],
+                                                                                        totals['throttled_seconds'])
+
+
+def RunInstances(command, database_set, zone_source, zone_target, instances, options):
+  """Returns string, report of running compare or sync for all these instances, in worker processes.
+
+  At most options['instance_jobs'] instances run at the same time, and at most options['host_jobs']
+  of them on any one database host, counting both their source and target hosts.  A failed instance
+  doesnt stop the others, it is reported with its error.
+  """
+  start_time = time.time()
+
+  # Database hosts each instance uses, so hosts shared by many instances arent overloaded
+  instance_hosts = {}
+  for instance in instances:
+    instance_hosts[instance] = set()
+    for zone in [zone_source] + zone_target.split(','):
+      (_, host, _, _, _, port, _) = zone_manager.GetZoneConnectionInfo(zone, database_set, instance)
+      instance_hosts[instance].add((host, port))
+
+  print('%s %s instances: %s %s %s, %s at a time, %s per host' % (command.capitalize(), len(instances), database_set, zone_source,
+        zone_target, options['instance_jobs'], options['host_jobs']))
+
+  pending = list(instances)
+  running = {}
+  host_counts = {}
+  results = {}
+
+  with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, options['instance_jobs'])) as executor:
+    while pending or running:
+      # Start pending instances, in order, while there are free workers and their hosts have room
+      for instance in list(pending):
+        if len(running) >= options['instance_jobs']:
+          break
+
+        if [host for host in instance_hosts[instance] if host_counts.get(host, 0) >= options['host_jobs']]:
+          continue
+
+        for host in instance_hosts[instance]:
+          host_counts[host] = host_counts.get(host, 0) + 1
+
+        pending.remove(instance)
+        future = executor.submit(RunInstance, command, database_set, zone_source, zone_target, instance, options)
+        running[future] = instance
+
+      (done, _) = concurrent.futures.wait(list(running.keys()), return_when=concurrent.futures.FIRST_COMPLETED)
+
+      for future in done:
+        instance = running.pop(future)
+
+        for host in instance_hosts[instance]:
+          host_counts[host] -= 1
+
+        try:
+          results[instance] = future.result()
+        # The worker process died, so it couldnt report its own error
+        except Exception as exc:
+          results[instance] = {'instance':instance, 'success':False, 'result':None, 'error':'Worker failed: %s' % exc, 'seconds':0.0}
+
+        print('%s %s: %s, %.2f seconds' % (command.capitalize(), instance, ('Failed', 'Success')[results[instance]['success']],
+              results[instance]['seconds']))
+
+  return GetInstancesReport(command, database_set, zone_source, zone_target, instances, results, time.time() - start_time)
+
+
+def RunInstance(command, database_set, zone_source, zone_target, instance, options):
+  """Returns dict, the result of compare or sync for 1 instance: instance, success, result, error, seconds.  Runs in a worker process."""
+  start_time = time.time()
+
+  try:
+    if command == 'compare':
+      result = CompareInstance(database_set, zone_source, zone_target, instance, options)
+    else:
+      result = SyncInstance(database_set, zone_source, zone_target, instance, options)
+
+    return {'instance':instance, 'success':True, 'result':result, 'error':None, 'seconds':time.time() - start_time}
+
+  except Exception as exc:
+    error = 'Error:\n%s\n%s\n' % ('\n'.join(traceback.format_tb(exc.__traceback__)), str(exc))
+
+    return {'instance':instance, 'success':False, 'result':None, 'error':error, 'seconds':time.time() - start_time}
+
+
+def GetInstancesReport(command, database_set, zone_source, zone_target, instances, results, seconds):
+  """Returns string, the report of all the instance results: a summary, then each instance's result or error"""
+  failed = [instance for instance in instances if not results[instance]['success']]
+
+  output = '%s: %s %s %s, %s instances, %s succeeded, %s failed, %.2f seconds' % (command.capitalize(), database_set, zone_source, zone_target,
+                                                                                 len(instances), len(instances) - len(failed), len(failed), seconds)
+  if failed:
+    output += '\n\nFailed: %s' % ', '.join([str(instance) for instance in failed])
+
+  for instance in instances:
+    item = results[instance]
+
+    if item['success']:
+      output += '\n\n== %s: Success, %.2f seconds\n\n%s' % (instance, item['seconds'], item['result'])
+    else:
+      output += '\n\n== %s: Failed, %.2f seconds\n\n%s' % (instance, item['seconds'], item['error'])
+
+  return output
 
 
 def Usage(error=None, exit_code=None):
@@ -314,6 +621,11 @@ def Usage(error=None, exit_code=None):
   print()
   print('  -h, -?, --help          This usage information')
   print('  -v, --verbose           Verbose output')
+  print('  -j, --jobs <count>      Tables to diff and sync in parallel (default: 1)')
+  print('  -s, --snapshot          Read each zone in a consistent snapshot, ignoring writes made during the compare')
+  print('  -i, --instance-jobs <count>')
+  print('                          Instances to compare or sync in parallel, when no instance is given (default: %s)' % DEFAULT_INSTANCE_JOBS)
+  print('  --host-jobs <count>     Most of those instances using one database host at the same time (default: %s)' % DEFAULT_HOST_JOBS)
   print()
   
   sys.exit(exit_code)
@@ -323,16 +635,20 @@ def Main(args=None):
   if not args:
     args = []
   
-  long_options = ['help', 'verbose']
+  long_options = ['help', 'verbose', 'jobs=', 'snapshot', 'instance-jobs=', 'host-jobs=']
   
   try:
-    (options, args) = getopt.getopt(args, '?hv', long_options)
+    (options, args) = getopt.getopt(args, '?hvsj:i:', long_options)
   except Exception as exc:
     Usage(exc)
   
   # Dictionary of command options, with defaults
   command_options = {}
   command_options['verbose'] = False
+  command_options['jobs'] = 1
+  command_options['snapshot'] = False
+  command_options['instance_jobs'] = DEFAULT_INSTANCE_JOBS
+  command_options['host_jobs'] = DEFAULT_HOST_JOBS
   
   
   # Process out CLI options
@@ -345,6 +661,32 @@ def Main(args=None):
     elif option in ('-v', '--verbose'):
       command_options['verbose'] = True
     
+    # Number of tables to diff in parallel
+    elif option in ('-j', '--jobs'):
+      try:
+        command_options['jobs'] = int(value)
+      except ValueError:
+        Usage('Jobs must be an integer: %s' % value)
+    
+    # Read zones in consistent snapshots
+    elif option in ('-s', '--snapshot'):
+      command_options['snapshot'] = True
+    
+    # Number of instances to compare or sync in parallel, in total and per database host
+    elif option in ('-i', '--instance-jobs', '--host-jobs'):
+      try:
+        value = int(value)
+      except ValueError:
+        Usage('Instance jobs must be an integer: %s' % value)
+
+      if value < 1:
+        Usage('Instance jobs must be at least 1: %s' % value)
+
+      if option == '--host-jobs':
+        command_options['host_jobs'] = value
+      else:
+        command_options['instance_jobs'] = value
+    
     # Invalid option
     else:
       Usage('Unknown option: %s' % option)
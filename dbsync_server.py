@@ -58,6 +58,10 @@ class DatabaseSyncManager:
       print(error)
       Log(error)
       return {'[error]':error}
+
+  def PoolMetrics(self):
+    """Returns dict of connection pool metrics, keyed on pool name"""
+    return zone_manager.query_mysql.GetPoolMetrics()
     
 
 
@@ -8,7 +8,6 @@ import MySQLdb.cursors
 import threading
 import os
 import sys
-import imp
 import gc
 import time
 
@@ -19,6 +18,8 @@ from AbsoluteImport import Import
 
 log = Import('log', prefix='unidist').log
 Log = log
+schema_cache = Import('schema_cache')
+connection_pool = Import('connection_pool')
 
 
 # Default database connection: The OPs DB
@@ -32,12 +33,11 @@ DEFAULT_DB_DATABASE = DEFAULT_DATA['database']
 DEFAULT_DB_PORT = DEFAULT_DATA['port']
 
 
-# Global to store DB connections
-#NOTE(g): We store connections to each database separately, even if
+# DB connections are pooled, see connection_pool
+#NOTE(g): We pool connections to each database separately, even if
 #   they go to the same DB host, so that we dont have to keep track
-#   of which DB we are currently connected to.
-DB_CONNECTION = {}
-DB_CURSOR = {}
+#   of which DB we are currently connected to.  A connection is checked
+#   out to one thread at a time, so threads never share a cursor.
 
 
 # Create a Global Write Lock
@@ -55,29 +55,70 @@ SQL_CACHE_LAST_RESET_TIME = 0
 SQL_CACHE_RESET_DELAY = 300 # 5 minutes
 
 
-# Store the schema cache, because we call it so often
-SCHEMA_CACHE = {}
+# SQL commands that change the schema, and so invalidate the schema cache
+SCHEMA_CHANGE_COMMANDS = ('ALTER', 'CREATE', 'DROP', 'RENAME')
+
+
+# Isolation level of transactions on pooled connections.  Single statements autocommit, and so
+#   always see the latest committed data.  Explicit transactions (START TRANSACTION) read at this
+#   level, so each statement in them also sees the latest commits.  MySQL ignores WITH CONSISTENT
+#   SNAPSHOT at this level, so snapshot transactions must set REPEATABLE READ for themselves first
+#   (see zone_manager.ConsistentSnapshot).
+SESSION_ISOLATION_LEVEL = 'READ COMMITTED'
+
+
+# Number of rows fetched from the server at a time, by QueryStream()
+STREAM_FETCH_SIZE = 1000
+
+# Most bytes Execute() sends in 1 multi-statement packet
+PIPELINE_MAX_BYTES = 1024 * 1024
+
+# mysql_set_server_option() options, to turn multi-statements on for pipelining in Execute(), and off again
+MYSQL_OPTION_MULTI_STATEMENTS_ON = 0
+MYSQL_OPTION_MULTI_STATEMENTS_OFF = 1
 
 
 
 class QueryFailure(Exception):
   """Failure to query the DB properly"""
 
+  def __init__(self, text, code=None):
+    Exception.__init__(self, text)
+    self.code = code
+
+
+def _GetPool(host, user, password, database, port):
+  """Returns the ConnectionPool for this database"""
+  cache_key = (host, user, password, database, port)
+
+  def CreateConnection():
+    Log('Creating MySQL connection: %s@%s:%s/%s' % (user, host, port, database))
+    #NOTE(g): Local infile is allowed, so spooled rows can be bulk loaded with LOAD DATA LOCAL INFILE
+    conn = MySQLdb.Connect(host, user, password, database, port=port, cursorclass=MySQLdb.cursors.DictCursor, local_infile=1)
+    conn.autocommit(True)
+    _SetSessionIsolation(conn)
+    return conn
+
+  return connection_pool.GetPool(cache_key, CreateConnection, ping=_PingConnection, name='%s@%s:%s/%s' % (user, host, port, database))
+
+
+def _SetSessionIsolation(conn):
+  """Set the isolation level that explicit transactions on this connection use"""
+  cursor = conn.cursor()
+  cursor.execute('SET SESSION TRANSACTION ISOLATION LEVEL %s' % SESSION_ISOLATION_LEVEL)
+  cursor.close()
+
+
+def _PingConnection(conn):
+  """Returns True if the connection is alive.  MySQLdb raises an exception if it isnt."""
+  conn.ping()
+
+  return True
+
 
 def CloseAll():
-  """Forcibly close all the MYSQLdb connections"""
-  global DB_CONNECTION
-  global DB_CURSOR
-  
-  # Loop through all our connection cache keys, and close them all
-  keys = list(DB_CONNECTION.keys())
-  for cache_key in keys:
-    DB_CONNECTION[cache_key].close()
-    del DB_CURSOR[cache_key]
-    del DB_CONNECTION[cache_key]
-  
-  # Reload the MySQLdb module to try to clear more cache
-  imp.reload(MySQLdb)
+  """Close all the idle pooled MySQLdb connections"""
+  connection_pool.CloseAll()
   
   # Force GC to run now and do whatever terrible things MySQLdb is doing to 
   #   close our connections and not allow new ones to open
@@ -85,43 +126,67 @@ def CloseAll():
 
 
 def Connect(host, user, password, database, port, reset=False):
-  """Connect to the specified MySQL DB"""
-  global DB_CONNECTION
-  global DB_CURSOR
+  """Returns (conn, cursor) for the specified MySQL DB.  The pooled connection is checked out to
+  this thread, so call Release() when done with it.
 
+  If reset is True, the connection is thrown away, and a new one is used.
+  """
   # Convert to proper empty DB
   if database == None:
     database = ''
 
-  # Create the cache key (tuple), for caching the DB connection and cursor
-  cache_key = (host, user, password, database, port)
+  pool = _GetPool(host, user, password, database, port)
+
+  conn = pool.Acquire()
 
-  # Close any connection we have persistent, if resetting
-  if reset and cache_key in DB_CURSOR:
-    Log('Resetting cache key: %s' % str(cache_key))
-    DB_CONNECTION[cache_key].close()
-    del DB_CURSOR[cache_key]
-    del DB_CONNECTION[cache_key]
-    # Force module reload to clear out anything that is being incorrectly cached
-    imp.reload(MySQLdb)
-    #Log('Connections: %s  Cursors: %s' % (DB_CONNECTION, DB_CURSOR))
-
-  # If no cached cursor/connection exists, create them
-  if reset or cache_key not in DB_CURSOR:
-    Log('Creating MySQL connection: %s' % str(cache_key))
-    conn = MySQLdb.Connect(host, user, password, database, port=port, cursorclass=MySQLdb.cursors.DictCursor)
+  # Throw away the connection we were given, if resetting, and get a new one
+  if reset:
+    Log('Resetting connection: %s' % pool.name)
+    pool.Release(discard=True)
+    conn = pool.Acquire()
+  try:
     cursor = conn.cursor()
+  except MySQLdb.DatabaseError:
+    pool.Release(discard=True)
+    raise
 
-    DB_CURSOR[cache_key] = cursor
-    DB_CONNECTION[cache_key] = conn
-    #Log('Connections: %s  Cursors: %s' % (DB_CONNECTION, DB_CURSOR))
+  return (conn, cursor)
 
-  # Else, use the cache
-  else:
-    conn = DB_CONNECTION[cache_key]
-    cursor = DB_CURSOR[cache_key]
 
-  return (conn, cursor)
+def Release(host, user, password, database, port, discard=False):
+  """Release this thread's connection from Connect() back to its pool.  If discard is True it is broken, so close it."""
+  # Convert to proper empty DB
+  if database == None:
+    database = ''
+
+  _GetPool(host, user, password, database, port).Release(discard=discard)
+
+
+def DetachConnection(host, user, password, database, port):
+  """Returns this thread's connection from Connect(), taken away from this thread but still checked out.
+
+  Used to hold a connection open in a transaction, and hand it to another thread with AttachConnection().
+  Returns None if this thread doesnt have one.
+  """
+  # Convert to proper empty DB
+  if database == None:
+    database = ''
+
+  return _GetPool(host, user, password, database, port).Detach()
+
+
+def AttachConnection(conn, host, user, password, database, port):
+  """Make a DetachConnection() connection this thread's connection.  Queries on this thread use it until Release()."""
+  # Convert to proper empty DB
+  if database == None:
+    database = ''
+
+  _GetPool(host, user, password, database, port).Attach(conn)
+
+
+def GetPoolMetrics():
+  """Returns dict of pool name to pool metrics, for all the connection pools"""
+  return connection_pool.GetAllMetrics()
 
 
 def Query(sql, host=DEFAULT_DB_HOST, user=DEFAULT_DB_USER, 
@@ -148,63 +213,227 @@ def Query(sql, host=DEFAULT_DB_HOST, user=DEFAULT_DB_USER,
   success = False
   tries = 0
   last_error = None
+  last_error_code = None
   while tries <= 3 and success == False:
     tries += 1
+    discard = False
 
     try:
-      # Connect (will save connections)
+      # Connect (checks out a pooled connection)
       (conn, cursor) = Connect(host, user, password, database, port)
 
       # Query
+      #NOTE(g): Connections are in autocommit mode, so writes are committed as they run,
+      #   unless inside a START TRANSACTION, which the caller commits.
       Log('Query: %s' % sql)
       cursor.execute(sql)
-      
-      #Log('Query complete, committing')
-      
-      # Force commit
-      conn.commit()
+
+      # Get the result now, before the connection goes back to the pool
+      if sql.upper()[:6] not in ('INSERT', 'UPDATE', 'DELETE'):
+        result = cursor.fetchall()
+      elif sql.upper()[:6] == 'INSERT':
+        # This is 0 unless we were auto_incrementing, and then it is accurate
+        result = cursor.lastrowid
+
+      else:
+        result = None
+
+      cursor.close()
       
       # Command didnt throw an exception
       success = True
     
     except MySQLdb.DatabaseError as exc:
-      (error_code, error_text) = (exc.code, exc.message)
+      (error_code, error_text) = (exc.args[0], exc.args[1]) if len(exc.args) > 1 else (None, str(exc))
       last_error = '%s: %s (Attempt: %s): %s: %s: %s' % (error_code, error_text, tries, host, database, sql)
+      last_error_code = error_code
       Log(last_error)
       
-      # Connect lost, reconnect
+      # Connect lost, throw this connection away so we reconnect
       if error_code in (2006, '2006'):
         Log('Lost connection: %s' % last_error)
-
-        # Enforce we always close the connections, because 
-        CloseAll()
-
-        # Reset connection
-        Connect(host, user, password, database, port, reset=True)
+        discard = True
       else:
         Log('Unhandled MySQL query error: %s' % last_error)
 
-  # If we made the query, get the result
-  if success:
-    if sql.upper()[:6] not in ('INSERT', 'UPDATE', 'DELETE'):
-      result = cursor.fetchall()
-    elif sql.upper()[:6] == 'INSERT':
-      # This is 0 unless we were auto_incrementing, and then it is accurate
-      result = cursor.lastrowid
+    finally:
+      Release(host, user, password, database, port, discard=discard)
 
-    else:
-      result = None
+  # If we made the query, our own DDL changed the schema, so the recently validated schema cant be trusted
+  if success:
+    if sql.split(' ')[0].upper() in SCHEMA_CHANGE_COMMANDS:
+      schema_cache.Invalidate(host, port, database)
 
   # We failed, no result for you
   else:
-    raise QueryFailure(str(last_error))
+    raise QueryFailure(str(last_error), code=last_error_code)
 
-  # Cache the result
-  SQL_CACHE[cache_key][sql] = result
+  # Cache the result.  Another thread may have reset the cache since we checked it.
+  SQL_CACHE.setdefault(cache_key, {})[sql] = result
 
   return result
 
 
+def QueryStream(sql, host=DEFAULT_DB_HOST, user=DEFAULT_DB_USER, 
+    password=DEFAULT_DB_PASSWORD, database=DEFAULT_DB_DATABASE, 
+    port=DEFAULT_DB_PORT, fetch_size=STREAM_FETCH_SIZE, tuples=False):
+  """Execute a SELECT and yield its rows (dicts) one at a time, from an unbuffered server-side cursor.
+
+  If tuples is True, rows are tuples of the values in SELECT order, which are much smaller than dicts.
+
+  Only fetch_size rows are held in memory at once, so tables of any size can be read.  A dedicated
+  connection is checked out of the pool, because an unbuffered cursor ties up its connection until all
+  rows are read.  If the caller stops reading early, that connection is closed instead of going back.
+
+  If this thread holds a pooled connection (a snapshot transaction), that connection is used instead,
+  so the rows come from its transaction.  It cant run other queries until the rows are all read.
+  """
+  # Convert to proper empty DB
+  if database == None:
+    database = ''
+
+  Log('Query Stream: %s' % sql)
+
+  if tuples:
+    cursor_class = MySQLdb.cursors.SSCursor
+  else:
+    cursor_class = MySQLdb.cursors.SSDictCursor
+
+  pool = _GetPool(host, user, password, database, port)
+  held_conn = pool.GetThreadConnection()
+
+  try:
+    if held_conn != None:
+      conn = pool.Acquire()
+    else:
+      conn = pool.Checkout()
+  except MySQLdb.DatabaseError as exc:
+    raise QueryFailure('%s: %s: %s' % (exc, host, database), code=exc.args[0] if exc.args else None)
+
+  cursor = None
+  finished = False
+  try:
+    cursor = conn.cursor(cursor_class)
+
+    try:
+      cursor.execute(sql)
+    except MySQLdb.DatabaseError as exc:
+      raise QueryFailure('%s: %s: %s: %s' % (exc, host, database, sql), code=exc.args[0] if exc.args else None)
+
+    while True:
+      rows = cursor.fetchmany(fetch_size)
+      if not rows:
+        break
+
+      for row in rows:
+        yield row
+
+    finished = True
+
+  # Always close, even if the caller stopped reading early
+  finally:
+    if held_conn != None:
+      # Closing reads and throws away any rows left, so the connection can be queried again
+      if cursor != None:
+        cursor.close()
+      pool.Release()
+    else:
+      #NOTE(g): Closing the cursor of an unfinished stream would read every row left, so the connection is thrown away
+      if cursor != None and finished:
+        cursor.close()
+      pool.Checkin(conn, discard=not finished)
+
+
+def Execute(statements, host=DEFAULT_DB_HOST, user=DEFAULT_DB_USER, 
+    password=DEFAULT_DB_PASSWORD, database=DEFAULT_DB_DATABASE, 
+    port=DEFAULT_DB_PORT, transaction=True, max_bytes=PIPELINE_MAX_BYTES):
+  """Run a list of statements in order, on this thread's connection.  Nothing is returned from them.
+
+  If transaction is True, they run in 1 transaction, which is committed, or rolled back if any statement
+  fails.  Statements that implicitly commit (DDL) should be run with transaction=False.
+
+  Statements are pipelined: sent together as multi-statement packets of up to max_bytes, so a batch
+  takes a few round trips instead of 1 per statement.  Raises QueryFailure if any statement fails.
+  """
+  # Convert to proper empty DB
+  if database == None:
+    database = ''
+
+  (conn, cursor) = Connect(host, user, password, database, port)
+  discard = False
+
+  try:
+    if transaction:
+      cursor.execute('START TRANSACTION')
+
+    conn.set_server_option(MYSQL_OPTION_MULTI_STATEMENTS_ON)
+    try:
+      for packet in _GetPipelinePackets(statements, max_bytes):
+        cursor.execute(packet)
+
+        # Read the result of every statement in the packet, which raises the error of any that failed
+        while cursor.nextset():
+          pass
+
+    finally:
+      conn.set_server_option(MYSQL_OPTION_MULTI_STATEMENTS_OFF)
+
+    if transaction:
+      conn.commit()
+
+  except MySQLdb.DatabaseError as exc:
+    (error_code, error_text) = (exc.args[0], exc.args[1]) if len(exc.args) > 1 else (None, str(exc))
+
+    # Connect lost, the server rolled back for us, throw this connection away so we reconnect
+    if error_code in (2006, '2006'):
+      discard = True
+
+    elif transaction:
+      try:
+        conn.rollback()
+      except MySQLdb.DatabaseError:
+        discard = True
+
+    raise QueryFailure('%s: %s: %s: %s' % (error_code, error_text, host, database), code=error_code)
+
+  finally:
+    cursor.close()
+    Release(host, user, password, database, port, discard=discard)
+
+  # Our own DDL changed the schema, so the recently validated schema cant be trusted
+  for statement in statements:
+    if statement.split(' ')[0].upper() in SCHEMA_CHANGE_COMMANDS:
+      schema_cache.Invalidate(host, port, database)
+      break
+
+
+def _GetPipelinePackets(statements, max_bytes):
+  """Yields strings, the statements joined into multi-statement packets of up to max_bytes.
+
+  LOAD DATA is always sent alone, so the client can answer the server's request for the local file.
+  """
+  packet = []
+  packet_bytes = 0
+
+  for statement in statements:
+    statement_bytes = len(statement.encode('utf-8')) + 2
+    alone = statement.split(' ')[0].upper() == 'LOAD'
+
+    if packet and (alone or packet_bytes + statement_bytes > max_bytes):
+      yield ';\n'.join(packet)
+      packet = []
+      packet_bytes = 0
+
+    if alone:
+      yield statement
+    else:
+      packet.append(statement)
+      packet_bytes += statement_bytes
+
+  if packet:
+    yield ';\n'.join(packet)
+
+
 def SanitizeSQL(sql):
   """Convert singled quotes to dual single quotes, so SQL doesnt terminate the string improperly"""
   sql = str(sql).replace("'", "''")
@@ -213,21 +442,59 @@ def SanitizeSQL(sql):
 
 def GetSchema(host=DEFAULT_DB_HOST, user=DEFAULT_DB_USER, 
     password=DEFAULT_DB_PASSWORD, database=DEFAULT_DB_DATABASE, 
-    port=DEFAULT_DB_PORT, clear_cache=False):
-  """Returns a dict of tables and fields in those tables for a given database"""
-  global SCHEMA_CACHE
+    port=DEFAULT_DB_PORT, clear_cache=False, bulk=True, table_filter=None):
+  """Returns a dict of tables and fields in those tables for a given database
+
+  If bulk is True, all tables are introspected in a few information_schema queries, and
+  __CREATE_SQL__ is left as None to be fetched with GetCreateTableSql() only when needed.
+  Otherwise each table is queried with DESC, SHOW CREATE TABLE and SHOW INDEXES.
+
+  If table_filter (a TableFilter) is given, only the tables it includes are introspected and
+  returned, and the schema is cached separately for each filter.
+  """
+  if table_filter != None:
+    filter_key = table_filter.key
+  else:
+    filter_key = None
 
   cache_key = (host, user, password, database, port)
 
   # If we want to clear the cache, clear schema and data.  If the schema changed, the data did too
   if clear_cache:
-    SCHEMA_CACHE[cache_key] = {}
+    schema_cache.Invalidate(host, port, database, remove_file=True)
     SQL_CACHE[cache_key] = {}
 
+  # Else, if we validated this schema very recently, use it without checking again
+  else:
+    schema = schema_cache.GetRecent(host, port, database, filter_key=filter_key)
+    if schema != None:
+      return schema
+
+  # Fingerprint the schema, and if it hasnt changed since we cached it, skip introspection
+  sql = schema_cache.GetFingerprintSql(database)
+  result = Query(sql, host=host, user=user, password=password, database=database, port=port, clear_cache=True)
+  fingerprint = schema_cache.GetFingerprint(result[0])
 
-  elif cache_key in SCHEMA_CACHE:
-    return SCHEMA_CACHE[cache_key]
+  schema = schema_cache.Get(host, port, database, fingerprint, filter_key=filter_key)
+  if schema != None:
+    return schema
 
+  if bulk:
+    schema = _GetSchemaBulk(host, user, password, database, port, table_filter)
+  else:
+    schema = _GetSchemaPerTable(host, user, password, database, port, table_filter)
+
+
+  # Save this Schema to the cache, so we dont keep rechecking the same database, unless
+  #   the fingerprint changes because someone changed the schema
+  schema_cache.Put(host, port, database, fingerprint, schema, filter_key=filter_key)
+
+
+  return schema
+
+
+def _GetSchemaPerTable(host, user, password, database, port, table_filter=None):
+  """Returns the schema dict, with DESC, SHOW CREATE TABLE and SHOW INDEXES queries for every included table."""
   schema = {}
 
   sql = "SHOW TABLES"
@@ -236,6 +503,10 @@ def GetSchema(host=DEFAULT_DB_HOST, user=DEFAULT_DB_USER,
     key = list(table_item.keys())[0]
     table = table_item[key]
 
+    # Excluded tables arent queried at all
+    if table_filter != None and not table_filter.IsIncluded(table):
+      continue
+
     schema[table] = {}
 
     field_order_dict = {}
@@ -275,11 +546,55 @@ def GetSchema(host=DEFAULT_DB_HOST, user=DEFAULT_DB_USER,
     for field_order in field_orders:
       schema[table]['__FIELD_ORDER__'].append(field_order_dict[field_order])
 
+  return schema
+
+
+def _GetSchemaBulk(host, user, password, database, port, table_filter=None):
+  """Returns the schema dict, built from information_schema in 2 queries for the whole database.
 
-  # Save this Schema to the cache, so we dont keep rechecking the same cache_key, unless
-  #   we need new results because we change something or its otherwise requests (time limit, user)
-  SCHEMA_CACHE[cache_key] = schema
+  This is the same structure _GetSchemaPerTable() returns, except __CREATE_SQL__ is None.  The
+  CREATE statement is only needed for tables that are created or dropped, so use GetCreateTableSql()
+  to fetch it for just those tables.
+  """
+  schema = {}
 
+  # All columns for all tables, named the same as the DESC result fields, in their table order
+  sql = "SELECT TABLE_NAME AS `Table`, COLUMN_NAME AS `Field`, COLUMN_TYPE AS `Type`, " \
+        "IS_NULLABLE AS `Null`, COLUMN_KEY AS `Key`, COLUMN_DEFAULT AS `Default`, EXTRA AS `Extra` " \
+        "FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = '%s' " \
+        "ORDER BY TABLE_NAME, ORDINAL_POSITION" % SanitizeSQL(database)
+  fields = Query(sql, host=host, user=user, password=password, database=database, port=port)
+  for field in fields:
+    table = field.pop('Table')
+
+    if table_filter != None and not table_filter.IsIncluded(table):
+      continue
+
+    if table not in schema:
+      schema[table] = {'__CREATE_SQL__':None, '__PRIMARY_KEYS__':[], '__FIELD_ORDER__':[]}
+
+    # Rows are ordered by ORDINAL_POSITION, so the count so far is the field order
+    field['_Order'] = len(schema[table]['__FIELD_ORDER__'])
+    schema[table][field['Field']] = field
+    schema[table]['__FIELD_ORDER__'].append(field['Field'])
+
+  # Get the PRIMARY KEY fields for all tables, by their sequence order
+  sql = "SELECT TABLE_NAME AS `Table`, COLUMN_NAME AS `Column_name` FROM information_schema.STATISTICS " \
+        "WHERE TABLE_SCHEMA = '%s' AND INDEX_NAME = 'PRIMARY' " \
+        "ORDER BY TABLE_NAME, SEQ_IN_INDEX" % SanitizeSQL(database)
+  result = Query(sql, host=host, user=user, password=password, database=database, port=port)
+  for item in result:
+    if item['Table'] in schema:
+      schema[item['Table']]['__PRIMARY_KEYS__'].append(item['Column_name'])
 
   return schema
 
+
+def GetCreateTableSql(table, host=DEFAULT_DB_HOST, user=DEFAULT_DB_USER, 
+    password=DEFAULT_DB_PASSWORD, database=DEFAULT_DB_DATABASE, 
+    port=DEFAULT_DB_PORT):
+  """Returns string, the CREATE TABLE statement for this table"""
+  sql = "SHOW CREATE TABLE `%s`" % table
+  table_create = Query(sql, host=host, user=user, password=password, database=database, port=port)
+
+  return table_create[0]['Create Table']
@@ -10,7 +10,7 @@ import mysql.connector.errors
 import threading
 import os
 import sys
-import imp
+import gc
 
 import yaml
 
@@ -19,6 +19,8 @@ from AbsoluteImport import Import
 
 log = Import('log', prefix='unidist').log
 Log = log
+schema_cache = Import('schema_cache')
+connection_pool = Import('connection_pool')
 
 # Default database connection: The OPs DB
 #TODO(g): Wrap in startup-loader function for better error handling and options (path)
@@ -31,12 +33,11 @@ DEFAULT_DB_DATABASE = DEFAULT_DATA['database']
 DEFAULT_DB_PORT = DEFAULT_DATA['port']
 
 
-# Global to store DB connections
-#NOTE(g): We store connections to each database separately, even if
+# DB connections are pooled, see connection_pool
+#NOTE(g): We pool connections to each database separately, even if
 #   they go to the same DB host, so that we dont have to keep track
-#   of which DB we are currently connected to.
-DB_CONNECTION = {}
-DB_CURSOR = {}
+#   of which DB we are currently connected to.  A connection is checked
+#   out to one thread at a time, so threads never share a cursor.
 
 
 # Create a Global Write Lock
@@ -47,6 +48,22 @@ DB_CURSOR = {}
 GLOBAL_WRITE_LOCK = threading.Lock()
 
 
+# SQL commands that change the schema, and so invalidate the schema cache
+SCHEMA_CHANGE_COMMANDS = ('ALTER', 'CREATE', 'DROP', 'RENAME')
+
+
+# Isolation level of transactions on pooled connections.  Single statements autocommit, and so
+#   always see the latest committed data.  Explicit transactions (START TRANSACTION) read at this
+#   level, so each statement in them also sees the latest commits.  MySQL ignores WITH CONSISTENT
+#   SNAPSHOT at this level, so snapshot transactions must set REPEATABLE READ for themselves first
+#   (see zone_manager.ConsistentSnapshot).
+SESSION_ISOLATION_LEVEL = 'READ COMMITTED'
+
+
+# Number of rows fetched from the server at a time, by QueryStream()
+STREAM_FETCH_SIZE = 1000
+
+
 class QueryFailure(Exception):
   """Failure to query the DB properly"""
 
@@ -64,21 +81,36 @@ class MySQLCursorDict(mysql.connector.cursor.MySQLCursor):
     return None
 
 
+def _GetPool(host, user, password, database, port):
+  """Returns the ConnectionPool for this database"""
+  cache_key = (host, user, password, database, port)
+
+  def CreateConnection():
+    Log('Creating MySQL connection: %s@%s:%s/%s' % (user, host, port, database))
+    #NOTE(g): Local infile is allowed, so spooled rows can be bulk loaded with LOAD DATA LOCAL INFILE
+    conn = mysql.connector.connect(user=user, password=password, database=database, host=host, port=port, autocommit=True,
+                                   allow_local_infile=True)
+    _SetSessionIsolation(conn)
+    return conn
+
+  return connection_pool.GetPool(cache_key, CreateConnection, ping=_PingConnection, name='%s@%s:%s/%s' % (user, host, port, database))
+
+
+def _SetSessionIsolation(conn):
+  """Set the isolation level that explicit transactions on this connection use"""
+  cursor = conn.cursor()
+  cursor.execute('SET SESSION TRANSACTION ISOLATION LEVEL %s' % SESSION_ISOLATION_LEVEL)
+  cursor.close()
+
+
+def _PingConnection(conn):
+  """Returns True if the connection is alive"""
+  return conn.is_connected()
+
+
 def CloseAll():
-  """Forcibly close all the MYSQLdb connections"""
-  global DB_CONNECTION
-  global DB_CURSOR
-  
-  # Loop through all our connection cache keys, and close them all
-  keys = list(DB_CONNECTION.keys())
-  for cache_key in keys:
-    DB_CONNECTION[cache_key].close()
-    del DB_CURSOR[cache_key]
-    del DB_CONNECTION[cache_key]
-  
-  # Reload the MySQLdb module to try to clear more cache
-  #imp.reload(MySQLdb)
-  imp.reload(mysql.connector)
+  """Close all the idle pooled mysql-connector connections"""
+  connection_pool.CloseAll()
   
   # Force GC to run now and do whatever terrible things MySQLdb is doing to 
   #   close our connections and not allow new ones to open
@@ -86,99 +118,104 @@ def CloseAll():
 
 
 def Connect(host, user, password, database, port, reset=False):
-  """Connect to the specified MySQL DB"""
-  global DB_CONNECTION
-  global DB_CURSOR
+  """Returns (conn, cursor) for the specified MySQL DB.  The pooled connection is checked out to
+  this thread, so call Release() when done with it.
 
+  If reset is True, the connection is thrown away, and a new one is used.
+  """
   # Convert to proper empty DB
   if database == None:
     database = ''
 
-  # Create the cache key (tuple), for caching the DB connection and cursor
-  cache_key = (host, user, password, database, port)
-
-  # Close any connection we have persistent, if resetting
-  if reset and cache_key in DB_CURSOR:
-    Log('Resetting cache key: %s' % str(cache_key))
-    DB_CONNECTION[cache_key].close()
-    del DB_CURSOR[cache_key]
-    del DB_CONNECTION[cache_key]
-    # Force module reload to clear out anything that is being incorrectly cached
-    imp.reload(mysql.connector)
-    #Log('Connections: %s  Cursors: %s' % (DB_CONNECTION, DB_CURSOR))
+  pool = _GetPool(host, user, password, database, port)
 
-  # If no cached cursor/connection exists, create them
-  if reset or cache_key not in DB_CURSOR:
-    Log('Creating MySQL connection: %s' % str(cache_key))
+  conn = pool.Acquire()
 
-    # conn = MySQLdb.Connect(host, user, password, database, port=port, cursorclass=MySQLdb.cursors.DictCursor)
-    # cursor = conn.cursor()
+  # Throw away the connection we were given, if resetting, and get a new one
+  if reset:
+    Log('Resetting connection: %s' % pool.name)
+    pool.Release(discard=True)
+    conn = pool.Acquire()
 
-    conn = mysql.connector.connect(user=user, password=password, database=database, host=host, port=port)
+  try:
     cursor = conn.cursor(cursor_class=MySQLCursorDict)
-
-    DB_CONNECTION[cache_key] = conn
-    DB_CURSOR[cache_key] = cursor
-    #Log('Connections: %s  Cursors: %s' % (DB_CONNECTION, DB_CURSOR))
-
-  # Else, use the cache
-  else:
-    conn = DB_CONNECTION[cache_key]
-    cursor = DB_CURSOR[cache_key]
+  except mysql.connector.errors.Error:
+    pool.Release(discard=True)
+    raise
 
   return (conn, cursor)
 
 
-#PERFORMANCE(geoff): To deal with Oracle stupidity, I am keeping track of all SQL statements and will only
-#   reset the connection 
-SQL_QUERY_CACHE = {}
+def Release(host, user, password, database, port, discard=False):
+  """Release this thread's connection from Connect() back to its pool.  If discard is True it is broken, so close it."""
+  # Convert to proper empty DB
+  if database == None:
+    database = ''
+
+  _GetPool(host, user, password, database, port).Release(discard=discard)
 
 
-def Query(sql, host=DEFAULT_DB_HOST, user=DEFAULT_DB_USER, 
-		password=DEFAULT_DB_PASSWORD, database=DEFAULT_DB_DATABASE, 
-		port=DEFAULT_DB_PORT):
-  """Execute and Fetch All results, or reutns last row ID inserted if INSERT.
+def DetachConnection(host, user, password, database, port):
+  """Returns this thread's connection from Connect(), taken away from this thread but still checked out.
 
-  NOTE(geoff): This function is not thread-safe, because it modifies a global dictionary that isnt thread safe to manage Oracle cache bug.
+  Used to hold a connection open in a transaction, and hand it to another thread with AttachConnection().
+  Returns None if this thread doesnt have one.
   """
-  global SQL_QUERY_CACHE
+  # Convert to proper empty DB
+  if database == None:
+    database = ''
+
+  return _GetPool(host, user, password, database, port).Detach()
+
+
+def AttachConnection(conn, host, user, password, database, port):
+  """Make a DetachConnection() connection this thread's connection.  Queries on this thread use it until Release()."""
+  # Convert to proper empty DB
+  if database == None:
+    database = ''
+
+  _GetPool(host, user, password, database, port).Attach(conn)
 
-  # #WORKAROUND(geoff): Some problem with Oracle's MySQL driver, Im getting the same data on the same query, 
-  # #   even though I know the data has changed in the database
-  # imp.reload(mysql.connector)
 
+def GetPoolMetrics():
+  """Returns dict of pool name to pool metrics, for all the connection pools"""
+  return connection_pool.GetAllMetrics()
+
+
+def Query(sql, host=DEFAULT_DB_HOST, user=DEFAULT_DB_USER, 
+		password=DEFAULT_DB_PASSWORD, database=DEFAULT_DB_DATABASE, 
+		port=DEFAULT_DB_PORT):
+  """Execute and Fetch All results, or reutns last row ID inserted if INSERT."""
   # Try to reconnect and stuff
   success = False
   tries = 0
   last_error = None
   while tries <= 3 and success == False:
     tries += 1
+    discard = False
 
     try:
-      # Connect (will save connections)
-      #WORKAROUND(geoff): For the Oracle MySQL DB connector, I have to reset the connection each time or it caches the queries and I dont get updated data that has been committed
-      #PERFORMANCE(geoff): Can only do a reset if we have made this exact same query before.  This could make this much faster...
-      reset_connection = False
-      if sql in SQL_QUERY_CACHE:
-        reset_connection = True
-        # Clear the caache
-        SQL_QUERY_CACHE = {}
-      else:
-        SQL_QUERY_CACHE[sql] = True
-
-      # Ensure we have a connection, reset if specified
-      (conn, cursor) = Connect(host, user, password, database, port, reset=reset_connection)
+      # Connect (checks out a pooled connection)
+      #NOTE(g): Connections are in autocommit mode, so every SELECT sees the latest committed
+      #   data, and writes are committed as they run, unless inside a START TRANSACTION.
+      #   The same connection can be reused forever, it never holds an old snapshot.
+      (conn, cursor) = Connect(host, user, password, database, port)
 
       # Query
       #log('Query: %s' % sql)
       cursor.execute(sql)
-      
-      #Log('Query complete, committing')
-      
-      # Force commit
-      if not sql.upper().startswith('SELECT') and not sql.upper().startswith('SHOW') and not sql.upper().startswith('DESC'): # This is only required in mysql-connector
-        log('Commit')
-        conn.commit()
+
+      # Get the result now, before the connection goes back to the pool
+      if sql.split(' ')[0].upper() not in ('INSERT', 'UPDATE', 'DELETE', 'ALTER', 'CREATE', 'DROP', 'START', 'COMMIT', 'ROLLBACK', 'SET', 'FLUSH', 'UNLOCK', 'LOAD', 'TRUNCATE'):
+        result = cursor.fetchall()
+      elif sql.split(' ')[0].upper() == 'INSERT':
+        # This is 0 unless we were auto_incrementing, and then it is accurate
+        result = cursor.lastrowid
+
+      else:
+        result = None
+
+      cursor.close()
       
       # Command didnt throw an exception
       success = True
@@ -186,7 +223,6 @@ def Query(sql, host=DEFAULT_DB_HOST, user=DEFAULT_DB_USER,
     #except MySQLdb.DatabaseError as exc:
     except mysql.connector.errors.DatabaseError as exc:
       log('Exception thrown')
-      log(dir())
       log(exc)
       #(error_code, error_text) = (exc.code, exc.message)
       (error_code, error_text) = (exc.errno, exc.msg)
@@ -194,28 +230,20 @@ def Query(sql, host=DEFAULT_DB_HOST, user=DEFAULT_DB_USER,
       last_exception = exc
       Log(last_error)
       
-      # Connect lost, reconnect
+      # Connect lost, throw this connection away so we reconnect
       if error_code in (2006, '2006'):
         Log('Lost connection: %s' % last_error)
-
-        # Enforce we always close the connections, because 
-        CloseAll()
-
-        # Reset connection
-        Connect(host, user, password, database, port, reset=True)
+        discard = True
       else:
         Log('Unhandled MySQL query error: %s' % last_error)
 
-  # If we made the query, get the result
-  if success:
-    if sql.split(' ')[0].upper() not in ('INSERT', 'UPDATE', 'DELETE', 'ALTER', 'CREATE', 'DROP'):
-      result = cursor.fetchall()
-    elif sql.split(' ')[0].upper() == 'INSERT':
-      # This is 0 unless we were auto_incrementing, and then it is accurate
-      result = cursor.lastrowid
+    finally:
+      Release(host, user, password, database, port, discard=discard)
 
-    else:
-      result = None
+  # If we made the query, our own DDL changed the schema, so the recently validated schema cant be trusted
+  if success:
+    if sql.split(' ')[0].upper() in SCHEMA_CHANGE_COMMANDS:
+      schema_cache.Invalidate(host, port, database)
 
   # We failed, no result for you
   else:
@@ -224,6 +252,125 @@ def Query(sql, host=DEFAULT_DB_HOST, user=DEFAULT_DB_USER,
   return result
 
 
+def QueryStream(sql, host=DEFAULT_DB_HOST, user=DEFAULT_DB_USER, 
+    password=DEFAULT_DB_PASSWORD, database=DEFAULT_DB_DATABASE, 
+    port=DEFAULT_DB_PORT, fetch_size=STREAM_FETCH_SIZE, tuples=False):
+  """Execute a SELECT and yield its rows (dicts) one at a time, from an unbuffered cursor.
+
+  If tuples is True, rows are tuples of the values in SELECT order, which are much smaller than dicts.
+
+  Only fetch_size rows are held in memory at once, so tables of any size can be read.  A dedicated
+  connection is checked out of the pool, because an unbuffered cursor ties up its connection until all
+  rows are read.  If the caller stops reading early, that connection is closed instead of going back.
+
+  If this thread holds a pooled connection (a snapshot transaction), that connection is used instead,
+  so the rows come from its transaction.  It cant run other queries until the rows are all read.
+  """
+  # Convert to proper empty DB
+  if database == None:
+    database = ''
+
+  log('Query Stream: %s' % sql)
+
+  pool = _GetPool(host, user, password, database, port)
+  held_conn = pool.GetThreadConnection()
+
+  try:
+    if held_conn != None:
+      conn = pool.Acquire()
+    else:
+      conn = pool.Checkout()
+  except mysql.connector.errors.DatabaseError as exc:
+    raise QueryFailure('%s: %s: %s' % (exc, host, database), code=exc.errno)
+
+  finished = False
+  try:
+    # MySQLCursor is unbuffered, rows stay on the server until we fetch them
+    if tuples:
+      cursor = conn.cursor()
+    else:
+      cursor = conn.cursor(cursor_class=MySQLCursorDict)
+
+    try:
+      cursor.execute(sql)
+    except mysql.connector.errors.DatabaseError as exc:
+      raise QueryFailure('%s: %s: %s: %s' % (exc, host, database, sql), code=exc.errno)
+
+    while True:
+      rows = cursor.fetchmany(fetch_size)
+      if not rows:
+        break
+
+      for row in rows:
+        yield row
+
+    finished = True
+
+  # Always close, even if the caller stopped reading early
+  finally:
+    if held_conn != None:
+      # Throw away any rows left, so the connection can be queried again
+      if conn.unread_result:
+        conn.consume_results()
+      pool.Release()
+    else:
+      #NOTE(g): Consuming the results of an unfinished stream would read every row left, so the connection is thrown away
+      pool.Checkin(conn, discard=not finished)
+
+
+def Execute(statements, host=DEFAULT_DB_HOST, user=DEFAULT_DB_USER, 
+    password=DEFAULT_DB_PASSWORD, database=DEFAULT_DB_DATABASE, 
+    port=DEFAULT_DB_PORT, transaction=True, max_bytes=None):
+  """Run a list of statements in order, on this thread's connection.  Nothing is returned from them.
+
+  If transaction is True, they run in 1 transaction, which is committed, or rolled back if any statement
+  fails.  Statements that implicitly commit (DDL) should be run with transaction=False.
+
+  mysql-connector cant pipeline multi-statement packets the same way in every version, so each statement
+  is its own round trip.  max_bytes is accepted to match the MySQLdb backend.  Raises QueryFailure if any
+  statement fails.
+  """
+  # Convert to proper empty DB
+  if database == None:
+    database = ''
+
+  (conn, cursor) = Connect(host, user, password, database, port)
+  discard = False
+
+  try:
+    if transaction:
+      cursor.execute('START TRANSACTION')
+
+    for statement in statements:
+      cursor.execute(statement)
+
+    if transaction:
+      conn.commit()
+
+  except mysql.connector.errors.DatabaseError as exc:
+    # Connect lost, the server rolled back for us, throw this connection away so we reconnect
+    if exc.errno in (2006, 2013):
+      discard = True
+
+    elif transaction:
+      try:
+        conn.rollback()
+      except mysql.connector.errors.DatabaseError:
+        discard = True
+
+    raise QueryFailure('%s: %s: %s: %s' % (exc.errno, exc.msg, host, database), code=exc.errno)
+
+  finally:
+    cursor.close()
+    Release(host, user, password, database, port, discard=discard)
+
+  # Our own DDL changed the schema, so the recently validated schema cant be trusted
+  for statement in statements:
+    if statement.split(' ')[0].upper() in SCHEMA_CHANGE_COMMANDS:
+      schema_cache.Invalidate(host, port, database)
+      break
+
+
 def SanitizeSQL(sql):
   """Convert singled quotes to dual single quotes, so SQL doesnt terminate the string improperly"""
   sql = str(sql).replace("'", "''")
@@ -233,8 +380,54 @@ def SanitizeSQL(sql):
 
 def GetSchema(host=DEFAULT_DB_HOST, user=DEFAULT_DB_USER, 
     password=DEFAULT_DB_PASSWORD, database=DEFAULT_DB_DATABASE, 
-    port=DEFAULT_DB_PORT):
-  """Returns a dict of tables and fields in those tables for a given database"""
+    port=DEFAULT_DB_PORT, clear_cache=False, bulk=True, table_filter=None):
+  """Returns a dict of tables and fields in those tables for a given database
+
+  If bulk is True, all tables are introspected in a few information_schema queries, and
+  __CREATE_SQL__ is left as None to be fetched with GetCreateTableSql() only when needed.
+  Otherwise each table is queried with DESC, SHOW CREATE TABLE and SHOW INDEXES.
+
+  If table_filter (a TableFilter) is given, only the tables it includes are introspected and
+  returned, and the schema is cached separately for each filter.
+  """
+  if table_filter != None:
+    filter_key = table_filter.key
+  else:
+    filter_key = None
+
+  # If we want to clear the cache, force the schema to be introspected again
+  if clear_cache:
+    schema_cache.Invalidate(host, port, database, remove_file=True)
+
+  # Else, if we validated this schema very recently, use it without checking again
+  else:
+    schema = schema_cache.GetRecent(host, port, database, filter_key=filter_key)
+    if schema != None:
+      return schema
+
+  # Fingerprint the schema, and if it hasnt changed since we cached it, skip introspection
+  sql = schema_cache.GetFingerprintSql(database)
+  result = Query(sql, host=host, user=user, password=password, database=database, port=port)
+  fingerprint = schema_cache.GetFingerprint(result[0])
+
+  schema = schema_cache.Get(host, port, database, fingerprint, filter_key=filter_key)
+  if schema != None:
+    return schema
+
+  if bulk:
+    schema = _GetSchemaBulk(host, user, password, database, port, table_filter)
+  else:
+    schema = _GetSchemaPerTable(host, user, password, database, port, table_filter)
+
+  # Save this Schema to the cache, so we dont keep rechecking the same database, unless
+  #   the fingerprint changes because someone changed the schema
+  schema_cache.Put(host, port, database, fingerprint, schema, filter_key=filter_key)
+
+  return schema
+
+
+def _GetSchemaPerTable(host, user, password, database, port, table_filter=None):
+  """Returns the schema dict, with DESC, SHOW CREATE TABLE and SHOW INDEXES queries for every included table."""
   schema = {}
 
   sql = "SHOW TABLES"
@@ -243,6 +436,10 @@ def GetSchema(host=DEFAULT_DB_HOST, user=DEFAULT_DB_USER,
     key = list(table_item.keys())[0]
     table = table_item[key]
 
+    # Excluded tables arent queried at all
+    if table_filter != None and not table_filter.IsIncluded(table):
+      continue
+
     schema[table] = {}
 
     field_order_dict = {}
@@ -282,7 +479,55 @@ def GetSchema(host=DEFAULT_DB_HOST, user=DEFAULT_DB_USER,
     for field_order in field_orders:
       schema[table]['__FIELD_ORDER__'].append(field_order_dict[field_order])
 
+  return schema
+
 
+def _GetSchemaBulk(host, user, password, database, port, table_filter=None):
+  """Returns the schema dict, built from information_schema in 2 queries for the whole database.
+
+  This is the same structure _GetSchemaPerTable() returns, except __CREATE_SQL__ is None.  The
+  CREATE statement is only needed for tables that are created or dropped, so use GetCreateTableSql()
+  to fetch it for just those tables.
+  """
+  schema = {}
+
+  # All columns for all tables, named the same as the DESC result fields, in their table order
+  sql = "SELECT TABLE_NAME AS `Table`, COLUMN_NAME AS `Field`, COLUMN_TYPE AS `Type`, " \
+        "IS_NULLABLE AS `Null`, COLUMN_KEY AS `Key`, COLUMN_DEFAULT AS `Default`, EXTRA AS `Extra` " \
+        "FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = '%s' " \
+        "ORDER BY TABLE_NAME, ORDINAL_POSITION" % SanitizeSQL(database)
+  fields = Query(sql, host=host, user=user, password=password, database=database, port=port)
+  for field in fields:
+    table = field.pop('Table')
+
+    if table_filter != None and not table_filter.IsIncluded(table):
+      continue
+
+    if table not in schema:
+      schema[table] = {'__CREATE_SQL__':None, '__PRIMARY_KEYS__':[], '__FIELD_ORDER__':[]}
+
+    # Rows are ordered by ORDINAL_POSITION, so the count so far is the field order
+    field['_Order'] = len(schema[table]['__FIELD_ORDER__'])
+    schema[table][field['Field']] = field
+    schema[table]['__FIELD_ORDER__'].append(field['Field'])
+
+  # Get the PRIMARY KEY fields for all tables, by their sequence order
+  sql = "SELECT TABLE_NAME AS `Table`, COLUMN_NAME AS `Column_name` FROM information_schema.STATISTICS " \
+        "WHERE TABLE_SCHEMA = '%s' AND INDEX_NAME = 'PRIMARY' " \
+        "ORDER BY TABLE_NAME, SEQ_IN_INDEX" % SanitizeSQL(database)
+  result = Query(sql, host=host, user=user, password=password, database=database, port=port)
+  for item in result:
+    if item['Table'] in schema:
+      schema[item['Table']]['__PRIMARY_KEYS__'].append(item['Column_name'])
 
   return schema
 
+
+def GetCreateTableSql(table, host=DEFAULT_DB_HOST, user=DEFAULT_DB_USER, 
+    password=DEFAULT_DB_PASSWORD, database=DEFAULT_DB_DATABASE, 
+    port=DEFAULT_DB_PORT):
+  """Returns string, the CREATE TABLE statement for this table"""
+  sql = "SHOW CREATE TABLE `%s`" % table
+  table_create = Query(sql, host=host, user=user, password=password, database=database, port=port)
+
+  return table_create[0]['Create Table']
@@ -0,0 +1,189 @@
+"""
+Schema Cache
+
+Stores database schemas on disk, keyed by (host, port, database), so they survive CLI runs and
+server restarts.  Schemas of only the tables a table filter includes are cached separately, keyed
+on the filter too.  A cached schema is only used if its fingerprint still matches the database,
+which is a single cheap query against information_schema, instead of introspecting every table.
+"""
+
+
+import os
+import pickle
+import hashlib
+import threading
+import time
+
+from AbsoluteImport import Import
+
+log = Import('log', prefix='unidist').log
+
+
+# Directory the cached schema files are stored in
+SCHEMA_CACHE_PATH = os.environ.get('DBSYNC_SCHEMA_CACHE_PATH', os.path.expanduser('~/.dbsync/schema_cache'))
+
+# Seconds a validated in-process schema is trusted, before its fingerprint is checked again.
+#NOTE(g): GetTableSchema() asks for both zone schemas once per table, so this keeps those from
+#   each costing a fingerprint query.  DDL we run ourselves invalidates immediately.
+SCHEMA_CACHE_VALIDATE_DELAY = 30
+
+# In-process cache of schemas: key -> {'fingerprint':str, 'schema':dict, 'validated':float}
+SCHEMA_CACHE = {}
+SCHEMA_CACHE_LOCK = threading.Lock()
+
+# Bump this when the schema dict structure changes, so old cache files are ignored
+SCHEMA_CACHE_VERSION = 1
+
+
+def GetCacheKey(host, port, database, filter_key=None):
+  """Returns tuple, the cache key for this database, and table filter if the schema is filtered"""
+  if filter_key == None:
+    return (host, str(port), database)
+
+  return (host, str(port), database, filter_key)
+
+
+def GetCachePath(host, port, database, filter_key=None):
+  """Returns string, path to the cache file for this database"""
+  key_hash = hashlib.sha1(repr(GetCacheKey(host, port, database, filter_key=filter_key)).encode('utf-8')).hexdigest()
+
+  return '%s/%s.schema' % (SCHEMA_CACHE_PATH, key_hash)
+
+
+def GetFingerprintSql(database):
+  """Returns string, SQL to get a single row that changes whenever the database schema changes.
+
+  It covers the tables and their options, columns with their collations, indexes and whether they are unique, and
+  foreign keys, since GetApplyLanes() and IsUpsertSafe() read those from the cached CREATE TABLE statements.
+
+  UPDATE_TIME and AUTO_INCREMENT are not used, because every INSERT/UPDATE/DELETE moves them, and that isnt a schema
+  change.  Each row is hashed with part of an MD5, not CRC32, which is linear under BIT_XOR: the same change to 2
+  tables with names of the same length would cancel out.
+  """
+  database = str(database).replace("'", "''")
+
+  checksum = "BIT_XOR(CAST(CONV(LEFT(MD5(CONCAT_WS('#', %s)), 16), 16, 10) AS UNSIGNED))"
+
+  sql = "SELECT " \
+        "(SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = '%(database)s') AS table_count, " \
+        "(SELECT MAX(CREATE_TIME) FROM information_schema.TABLES WHERE TABLE_SCHEMA = '%(database)s') AS create_time, " \
+        "(SELECT %(table_checksum)s " \
+        "FROM information_schema.TABLES WHERE TABLE_SCHEMA = '%(database)s') AS table_checksum, " \
+        "(SELECT COUNT(*) FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = '%(database)s') AS column_count, " \
+        "(SELECT %(column_checksum)s " \
+        "FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = '%(database)s') AS column_checksum, " \
+        "(SELECT %(index_checksum)s " \
+        "FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = '%(database)s') AS index_checksum, " \
+        "(SELECT %(foreign_key_checksum)s " \
+        "FROM information_schema.REFERENTIAL_CONSTRAINTS WHERE CONSTRAINT_SCHEMA = '%(database)s') AS foreign_key_checksum" % {
+          'database':database,
+          'table_checksum':checksum % 'TABLE_NAME, ENGINE, TABLE_COLLATION, CREATE_OPTIONS, TABLE_COMMENT',
+          'column_checksum':checksum % 'TABLE_NAME, COLUMN_NAME, ORDINAL_POSITION, COLUMN_TYPE, IS_NULLABLE, COLUMN_KEY, ' \
+                                       'COLUMN_DEFAULT, ISNULL(COLUMN_DEFAULT), EXTRA, COLLATION_NAME',
+          'index_checksum':checksum % 'TABLE_NAME, INDEX_NAME, NON_UNIQUE, SEQ_IN_INDEX, COLUMN_NAME',
+          'foreign_key_checksum':checksum % 'TABLE_NAME, CONSTRAINT_NAME, UNIQUE_CONSTRAINT_NAME, REFERENCED_TABLE_NAME, ' \
+                                            'UPDATE_RULE, DELETE_RULE',
+        }
+
+  return sql
+
+
+def GetFingerprint(row):
+  """Returns string, fingerprint from the row result of the GetFingerprintSql() query"""
+  fields = ('table_count', 'create_time', 'table_checksum', 'column_count', 'column_checksum', 'index_checksum', 'foreign_key_checksum')
+
+  fingerprint = '|'.join([str(row[field]) for field in fields])
+
+  return fingerprint
+
+
+def GetRecent(host, port, database, filter_key=None):
+  """Returns schema dict if it was validated in the last SCHEMA_CACHE_VALIDATE_DELAY seconds, or None"""
+  cache_key = GetCacheKey(host, port, database, filter_key=filter_key)
+
+  with SCHEMA_CACHE_LOCK:
+    item = SCHEMA_CACHE.get(cache_key)
+
+    if item and time.time() < item['validated'] + SCHEMA_CACHE_VALIDATE_DELAY:
+      return item['schema']
+
+  return None
+
+
+def Get(host, port, database, fingerprint, filter_key=None):
+  """Returns the cached schema dict if it matches the fingerprint, or None.  Checks memory, then disk."""
+  cache_key = GetCacheKey(host, port, database, filter_key=filter_key)
+
+  # In-process cache
+  with SCHEMA_CACHE_LOCK:
+    item = SCHEMA_CACHE.get(cache_key)
+
+    if item and item['fingerprint'] == fingerprint:
+      item['validated'] = time.time()
+      return item['schema']
+
+  # On-disk cache
+  path = GetCachePath(host, port, database, filter_key=filter_key)
+  if not os.path.isfile(path):
+    return None
+
+  try:
+    with open(path, 'rb') as cache_file:
+      data = pickle.load(cache_file)
+  except Exception as exc:
+    log('Schema cache unreadable, ignoring: %s: %s' % (path, exc))
+    return None
+
+  if data.get('version') != SCHEMA_CACHE_VERSION or data.get('key') != cache_key or data.get('fingerprint') != fingerprint:
+    return None
+
+  with SCHEMA_CACHE_LOCK:
+    SCHEMA_CACHE[cache_key] = {'fingerprint':fingerprint, 'schema':data['schema'], 'validated':time.time()}
+
+  return data['schema']
+
+
+def Put(host, port, database, fingerprint, schema, filter_key=None):
+  """Save the schema for this fingerprint, in memory and on disk"""
+  cache_key = GetCacheKey(host, port, database, filter_key=filter_key)
+
+  with SCHEMA_CACHE_LOCK:
+    SCHEMA_CACHE[cache_key] = {'fingerprint':fingerprint, 'schema':schema, 'validated':time.time()}
+
+  data = {'version':SCHEMA_CACHE_VERSION, 'key':cache_key, 'fingerprint':fingerprint, 'schema':schema}
+
+  # Write to a temp file and rename it into place, so a reader never sees a partial file
+  path = GetCachePath(host, port, database, filter_key=filter_key)
+  temp_path = '%s.%s.%s.tmp' % (path, os.getpid(), threading.get_ident())
+  try:
+    if not os.path.isdir(SCHEMA_CACHE_PATH):
+      os.makedirs(SCHEMA_CACHE_PATH, exist_ok=True)
+
+    with open(temp_path, 'wb') as cache_file:
+      pickle.dump(data, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    os.replace(temp_path, path)
+
+  except (OSError, pickle.PickleError) as exc:
+    log('Schema cache could not be written: %s: %s' % (path, exc))
+
+
+def Invalidate(host, port, database, remove_file=False):
+  """Forget the in-process schemas of this database, for every table filter, so the next GetSchema checks the fingerprint.
+
+  The disk file is still validated by fingerprint, so it only needs removing when forced.
+  """
+  database_key = GetCacheKey(host, port, database)
+
+  with SCHEMA_CACHE_LOCK:
+    cache_keys = [cache_key for cache_key in SCHEMA_CACHE if cache_key[:3] == database_key]
+    for cache_key in cache_keys:
+      del SCHEMA_CACHE[cache_key]
+
+  if remove_file:
+    # Filtered schemas not in memory are left on disk, their fingerprints still validate them
+    filter_keys = set([None] + [cache_key[3] for cache_key in cache_keys if len(cache_key) > 3])
+    for filter_key in filter_keys:
+      path = GetCachePath(host, port, database, filter_key=filter_key)
+      if os.path.isfile(path):
+        os.remove(path)
@@ -0,0 +1,293 @@
+"""
+Table Codec
+
+Renders row values as SQL literals.  A TableCodec is compiled once per table schema: the fields in
+table order, a primary key extractor, and a formatter for each field, chosen from its MySQL type.
+Generating SQL for a row is then only calling the formatters, instead of parsing the field types
+and sorting the fields again for every value.
+
+Rows can be dicts, or tuples of the values in the codec's field order, which the diff uses since
+they are several times smaller.  The Tuple methods take tuple rows.
+"""
+
+
+import datetime
+import decimal
+import json
+import operator
+import threading
+
+
+# MySQL base types, lower case, without size or attributes, by how their values are rendered
+TEXT_TYPES = ('char', 'varchar', 'tinytext', 'text', 'mediumtext', 'longtext', 'enum', 'set')
+BINARY_TYPES = ('binary', 'varbinary', 'tinyblob', 'blob', 'mediumblob', 'longblob')
+NUMERIC_TYPES = ('tinyint', 'smallint', 'mediumint', 'int', 'integer', 'bigint', 'decimal', 'numeric', 'float', 'double', 'real')
+TEMPORAL_TYPES = ('date', 'datetime', 'timestamp', 'time', 'year')
+JSON_TYPES = ('json',)
+BIT_TYPES = ('bit',)
+
+
+# Compiled codecs, keyed on id() of the table schema dict: (table_schema, codec).  The schema is kept,
+#   so its id cant be reused by another dict while the codec is cached.
+TABLE_CODECS = {}
+TABLE_CODECS_LOCK = threading.Lock()
+
+# Most codecs cached, before the cache is cleared.  Schemas are only replaced when they change.
+TABLE_CODEC_CACHE_SIZE = 4096
+
+
+class TableCodec:
+  """Compiled SQL rendering for the rows of 1 table schema."""
+
+  def __init__(self, table_schema):
+    field_infos = [field_info for field_info in table_schema.values() if type(field_info) == dict and 'Type' in field_info]
+
+    # Fields in their table order
+    ordered_infos = sorted([field_info for field_info in field_infos if '_Order' in field_info], key=operator.itemgetter('_Order'))
+    self.fields = tuple([field_info['Field'] for field_info in ordered_infos])
+
+    #NOTE(g): Back-quoting all field names, to avoid any reserved word conflicts
+    self.sql_fields = ', '.join(['`%s`' % field for field in self.fields])
+
+    # Formatter function for every field, so values can also be rendered 1 at a time
+    self.formatters = {}
+    for field_info in field_infos:
+      self.formatters[field_info['Field']] = GetFormatter(field_info['Type'])
+
+    self.row_formatters = tuple([(field, self.formatters[field]) for field in self.fields])
+    self.tuple_formatters = tuple([self.formatters[field] for field in self.fields])
+
+    # Index of each field in tuple rows
+    self.field_indexes = {}
+    for (index, field) in enumerate(self.fields):
+      self.field_indexes[field] = index
+
+    self.primary_keys = tuple(table_schema.get('__PRIMARY_KEYS__', []))
+    self.primary_key_formatters = tuple([(field, self.formatters[field]) for field in self.primary_keys])
+
+    # Primary key extractor, always returns a tuple
+    if len(self.primary_keys) == 1:
+      primary_key_getter = operator.itemgetter(self.primary_keys[0])
+      self.GetPrimaryKey = lambda row: (primary_key_getter(row),)
+    elif self.primary_keys:
+      self.GetPrimaryKey = operator.itemgetter(*self.primary_keys)
+    else:
+      self.GetPrimaryKey = lambda row: ()
+
+    self.GetTuplePrimaryKey = self.GetTupleGetter(self.primary_keys)
+    self.primary_key_tuple_formatters = tuple([(self.field_indexes[field], self.formatters[field]) for field in self.primary_keys])
+
+
+  def Format(self, field, value):
+    """Returns string, the SQL literal for this field's value"""
+    return self.formatters[field](value)
+
+
+  def FormatRow(self, row):
+    """Returns string, the row's values in table order as a SQL tuple: (1, 'a', NULL)"""
+    return '(%s)' % ', '.join([formatter(row[field]) for (field, formatter) in self.row_formatters])
+
+
+  def FormatPrimaryKey(self, row):
+    """Returns list of strings, the SQL literals of the row's primary key values"""
+    return [formatter(row[field]) for (field, formatter) in self.primary_key_formatters]
+
+
+  def FormatKey(self, key):
+    """Returns list of strings, the SQL literals of a primary key tuple's values"""
+    return [formatter(value) for ((field, formatter), value) in zip(self.primary_key_formatters, key)]
+
+
+  def FormatTuple(self, row):
+    """Returns string, a tuple row's values as a SQL tuple: (1, 'a', NULL)"""
+    return '(%s)' % ', '.join([formatter(value) for (formatter, value) in zip(self.tuple_formatters, row)])
+
+
+  def FormatTuplePrimaryKey(self, row):
+    """Returns list of strings, the SQL literals of a tuple row's primary key values"""
+    return [formatter(row[index]) for (index, formatter) in self.primary_key_tuple_formatters]
+
+
+  def GetTupleGetter(self, fields):
+    """Returns function(row), which returns a tuple of these fields' values from a tuple row"""
+    indexes = [self.field_indexes[field] for field in fields]
+
+    if len(indexes) == 1:
+      getter = operator.itemgetter(indexes[0])
+      return lambda row: (getter(row),)
+    elif indexes:
+      return operator.itemgetter(*indexes)
+    else:
+      return lambda row: ()
+
+
+  def ToTuple(self, row):
+    """Returns tuple row, the values of a dict row in field order"""
+    return tuple([row[field] for field in self.fields])
+
+
+  def ToDict(self, row):
+    """Returns dict row, from a tuple row"""
+    return dict(zip(self.fields, row))
+
+
+def GetTableCodec(table_schema):
+  """Returns the TableCodec for this table schema dict, compiling it on first use"""
+  cache_key = id(table_schema)
+
+  with TABLE_CODECS_LOCK:
+    item = TABLE_CODECS.get(cache_key)
+    if item != None and item[0] is table_schema:
+      return item[1]
+
+  codec = TableCodec(table_schema)
+
+  with TABLE_CODECS_LOCK:
+    if len(TABLE_CODECS) >= TABLE_CODEC_CACHE_SIZE:
+      TABLE_CODECS.clear()
+
+    TABLE_CODECS[cache_key] = (table_schema, codec)
+
+  return codec
+
+
+def GetBaseType(field_type):
+  """Returns string, the lower case type name of a field's Type, without size or attributes: 'int(10) unsigned' -> 'int'"""
+  return field_type.split('(')[0].split(' ')[0].lower()
+
+
+def GetFormatter(field_type):
+  """Returns function(value), which returns the SQL literal for a value of this MySQL field Type"""
+  base_type = GetBaseType(field_type)
+
+  if base_type in TEXT_TYPES:
+    return FormatText
+  elif base_type in BINARY_TYPES:
+    return FormatBinary
+  elif base_type in NUMERIC_TYPES:
+    return FormatNumber
+  elif base_type in TEMPORAL_TYPES:
+    return FormatTemporal
+  elif base_type in JSON_TYPES:
+    return FormatJson
+  elif base_type in BIT_TYPES:
+    return FormatBit
+  else:
+    return FormatOther
+
+
+def EscapeString(value):
+  """Returns string, escaped to go in single quotes in MySQL's default SQL mode"""
+  # Backslash first, so the escapes added after it arent escaped again
+  return value.replace('\\', '\\\\').replace("'", "''").replace('\x00', '\\0')
+
+
+def FormatText(value):
+  """Returns string, SQL literal for a text value"""
+  if value == None:
+    return 'NULL'
+
+  if type(value) == bytes:
+    value = value.decode('utf-8')
+
+  return "'%s'" % EscapeString(str(value))
+
+
+def FormatBinary(value):
+  """Returns string, SQL literal for a binary value, as hex, so any bytes survive: 0x0aff"""
+  if value == None:
+    return 'NULL'
+
+  if type(value) == str:
+    value = value.encode('utf-8')
+
+  if not value:
+    return "''"
+
+  return '0x%s' % bytes(value).hex()
+
+
+def FormatNumber(value):
+  """Returns string, SQL literal for a numeric value"""
+  if value == None:
+    return 'NULL'
+
+  if type(value) == bool:
+    return str(int(value))
+  elif isinstance(value, (int, float, decimal.Decimal)):
+    return str(value)
+
+  # Not a number type, let MySQL convert it
+  return FormatText(value)
+
+
+def FormatTemporal(value):
+  """Returns string, SQL literal for a date, time or year value"""
+  if value == None:
+    return 'NULL'
+
+  if isinstance(value, datetime.datetime):
+    return "'%s'" % value.isoformat(' ')
+  elif isinstance(value, datetime.timedelta):
+    return "'%s'" % FormatTimeDelta(value)
+  elif isinstance(value, (datetime.date, datetime.time)):
+    return "'%s'" % value.isoformat()
+  elif type(value) == int:
+    return str(value)
+
+  return FormatText(value)
+
+
+def FormatTimeDelta(value):
+  """Returns string, a TIME column value (which the drivers return as timedelta) in MySQL format: -838:59:59.000000"""
+  microseconds = value.days * 86400000000 + value.seconds * 1000000 + value.microseconds
+
+  if microseconds < 0:
+    sign = '-'
+    microseconds = -microseconds
+  else:
+    sign = ''
+
+  (seconds, microseconds) = divmod(microseconds, 1000000)
+  (minutes, seconds) = divmod(seconds, 60)
+  (hours, minutes) = divmod(minutes, 60)
+
+  if microseconds:
+    return '%s%02d:%02d:%02d.%06d' % (sign, hours, minutes, seconds, microseconds)
+  else:
+    return '%s%02d:%02d:%02d' % (sign, hours, minutes, seconds)
+
+
+def FormatJson(value):
+  """Returns string, SQL literal for a JSON value.  Drivers return JSON as text, decoded values are encoded again."""
+  if value == None:
+    return 'NULL'
+
+  if type(value) in (str, bytes):
+    return FormatText(value)
+
+  return FormatText(json.dumps(value))
+
+
+def FormatBit(value):
+  """Returns string, SQL literal for a BIT value, which the drivers return as big-endian bytes: b'101'"""
+  if value == None:
+    return 'NULL'
+
+  if type(value) == bytes:
+    value = int.from_bytes(value, 'big')
+
+  return "b'%s'" % format(int(value), 'b')
+
+
+def FormatOther(value):
+  """Returns string, SQL literal for a value of a type without its own formatter, from the Python type"""
+  if value == None:
+    return 'NULL'
+
+  if type(value) in (bytes, bytearray):
+    return FormatBinary(value)
+  elif isinstance(value, (int, float, decimal.Decimal)):
+    return FormatNumber(value)
+
+  return FormatText(value)
@@ -0,0 +1,88 @@
+"""
+Table Filter
+
+Decides which tables of a database set are synced, from a zone's table_whitelist and table_blacklist
+glob patterns in conf/zones.yaml.  Whitelisted tables are always included, blacklisted tables are
+excluded, and every other table is included.
+
+All the patterns are compiled into one anchored regex, so checking a table is a single match, and
+filters are cached on their patterns, so each is compiled once.
+"""
+
+
+import re
+import threading
+
+
+# Compiled filters, keyed on (whitelist patterns, blacklist patterns)
+TABLE_FILTERS = {}
+TABLE_FILTERS_LOCK = threading.Lock()
+
+
+class TableFilter:
+  """Compiled whitelist and blacklist of table name globs."""
+
+  def __init__(self, whitelist, blacklist):
+    self.whitelist = tuple(whitelist)
+    self.blacklist = tuple(blacklist)
+
+    # Identifies the filter, for caching what it was applied to
+    self.key = repr((self.whitelist, self.blacklist))
+
+    # The whitelist alternative is tried first, so a table in both lists is included
+    alternatives = []
+    if self.whitelist:
+      alternatives.append('(?P<whitelist>%s)' % '|'.join([GetGlobRegex(pattern) for pattern in self.whitelist]))
+    if self.blacklist:
+      alternatives.append('(?P<blacklist>%s)' % '|'.join([GetGlobRegex(pattern) for pattern in self.blacklist]))
+
+    if alternatives:
+      self._match = re.compile('(?:%s)\\Z' % '|'.join(alternatives)).match
+    else:
+      self._match = None
+
+
+  def __repr__(self):
+    return 'TableFilter(whitelist=%s, blacklist=%s)' % (list(self.whitelist), list(self.blacklist))
+
+
+  def IsIncluded(self, table):
+    """Returns boolean, True if this table is synced"""
+    if self._match == None:
+      return True
+
+    match = self._match(table)
+
+    return match == None or match.lastgroup == 'whitelist'
+
+
+  def Filter(self, tables):
+    """Returns list of the included tables, in the same order"""
+    return [table for table in tables if self.IsIncluded(table)]
+
+
+def GetTableFilter(whitelist, blacklist):
+  """Returns the TableFilter for these lists of glob patterns, compiling it on first use"""
+  cache_key = (tuple(whitelist or []), tuple(blacklist or []))
+
+  with TABLE_FILTERS_LOCK:
+    table_filter = TABLE_FILTERS.get(cache_key)
+    if table_filter == None:
+      table_filter = TableFilter(cache_key[0], cache_key[1])
+      TABLE_FILTERS[cache_key] = table_filter
+
+  return table_filter
+
+
+def GetGlobRegex(pattern):
+  """Returns string, regex for a table name glob: * matches any characters, ? matches 1, everything else is literal"""
+  parts = []
+  for char in str(pattern):
+    if char == '*':
+      parts.append('.*')
+    elif char == '?':
+      parts.append('.')
+    else:
+      parts.append(re.escape(char))
+
+  return ''.join(parts)
@@ -7,9 +7,16 @@ have different users.
 """
 
 
-import yaml
+import os
+import array
+import bisect
 import re
-import operator
+import time
+import datetime
+import itertools
+import threading
+import queue
+import concurrent.futures
 
 # import query_mysql_oracle as query_mysql
 
@@ -18,24 +25,389 @@ from AbsoluteImport import Import
 log = Import('log', prefix='unidist').log
 #query_mysql = Import('query_mysql_oracle')
 query_mysql = Import('query_mysql_legacy')
+apply_journal = Import('apply_journal')
+table_codec = Import('table_codec')
+config_registry = Import('config_registry')
+table_filter = Import('table_filter')
+zone_snapshot = Import('zone_snapshot')
+connection_pool = Import('connection_pool')
 
 
 #TODO(g): Move this into a startup-loading function, to harder and provide better error handling or options (path)
 ZONE_PATH = __file__ + '/conf/zones.yaml'
 #print('Zone Path: %s' % ZONE_PATH)
-ZONES = yaml.load(open(ZONE_PATH))
+ZONES = config_registry.Load(ZONE_PATH)
 ZONE_APPROVERS_PATH = __file__ + '/conf/approvers.yaml'
-ZONE_APPROVERS = yaml.load(open(ZONE_APPROVERS_PATH))
+ZONE_APPROVERS = config_registry.Load(ZONE_APPROVERS_PATH)
 DATABASE_SETS_PATH = __file__ + '/conf/database_sets.yaml'
-DATABASE_SETS = yaml.load(open(DATABASE_SETS_PATH))
+DATABASE_SETS = config_registry.Load(DATABASE_SETS_PATH)
+
+# Seconds between checks for changed config files, and when they were last checked
+CONFIG_CHECK_INTERVAL = 1
+CONFIG_CHECK_TIME = time.time()
+
+# Resolved GetZoneConnectionInfo() results, keyed on (zone, database_set, instance).  Cleared when a config file changes.
+ZONE_CONNECTION_INFO = {}
+ZONE_INFO_LOCK = threading.RLock()
+
+# Snapshot files used as zones, keyed on path: zone_snapshot.Snapshot
+SNAPSHOT_ZONES = {}
+SNAPSHOT_ZONES_LOCK = threading.Lock()
+
+
+# Row diff modes for GetSql_TableRowDiff()
+#   full:   Fetch all rows from both zones, and compare them in dicts keyed by primary key
+#   stream: Stream both zones ordered by primary key, and merge-join them in constant memory
+#   checksum: Compare checksums of primary key ranges on the servers, and only fetch rows from ranges that differ
+#   digest: Stream a digest of every row from both zones, keeping only key -> digest, and only fetch rows whose digests differ
+#NOTE(g): Snapshot zones cant run queries, tables with a snapshot on either side are always diffed with stream
+DIFF_MODES = ('full', 'stream', 'checksum', 'digest')
+DEFAULT_DIFF_MODE = 'full'
+
+# MySQL types that ORDER BY sorts with a collation.  These are ordered as BINARY, so the server
+#   sorts them the same way Python compares strings, which the merge-join relies on.
+COLLATED_TYPES = ('char', 'varchar', 'tinytext', 'text', 'mediumtext', 'longtext', 'enum', 'set')
+
+
+# Checksum diff mode: Number of primary key ranges a table is first split into, and the row count at or
+#   below which a mismatched range is fetched and diffed, instead of being bisected again
+CHECKSUM_CHUNK_COUNT = 64
+CHECKSUM_LEAF_ROWS = 1000
+
+# MySQL integer types, which primary key ranges can be computed on
+INTEGER_TYPES = ('tinyint', 'smallint', 'mediumint', 'int', 'integer', 'bigint')
+
+# Digest diff mode: Rows fetched per query, for the keys whose digests differ
+DIGEST_FETCH_ROWS = 1000
+
+
+# Connections allowed to one database host at the same time, unless the zone database set
+#   sets max_connections in conf/zones.yaml
+DEFAULT_MAX_CONNECTIONS = 8
+
+# Batched INSERTs: Most bytes in 1 multi-row statement, and the most of a target host's max_allowed_packet
+#   it can use, leaving room for the protocol overhead
+INSERT_BATCH_MAX_BYTES = 1024 * 1024
+INSERT_BATCH_PACKET_FRACTION = 0.75
+
+# Bulk loads: Directory the TSV spool files for LOAD DATA LOCAL INFILE are written to
+SPOOL_PATH = os.environ.get('DBSYNC_SPOOL_PATH', os.path.expanduser('~/.dbsync/spool'))
+
+# Numbers spool files, so a table spooled twice in the same second, for several target zones, gets 2 files
+SPOOL_COUNTER = itertools.count()
+
+# LOAD DATA statements made by CreateLoadData(), and their spool file path
+LOAD_DATA_REGEX = re.compile(r"^LOAD DATA LOCAL INFILE '((?:[^']|'')*)' INTO TABLE ")
+
+# Tables with more than this fraction of their rows different are reloaded in bulk, instead of with
+#   row statements, unless the target zone database set sets bulk_load_fraction in conf/zones.yaml
+DEFAULT_BULK_LOAD_FRACTION = 0.5
+# Tables with fewer different rows than this are never reloaded, row statements are quick enough
+BULK_LOAD_MIN_ROWS = 1000
+
+# MySQL types spooled as hex and loaded through UNHEX(), so their bytes survive the text file
+BINARY_TYPES = ('binary', 'varbinary', 'tinyblob', 'blob', 'mediumblob', 'longblob')
+
+# Apply engine: Statements per transaction when syncing, unless the target zone database set sets
+#   apply_transaction_size in conf/zones.yaml
+DEFAULT_APPLY_TRANSACTION_SIZE = 100
+
+# Statements that implicitly commit in MySQL, so they cant be in an apply transaction, and run alone
+IMPLICIT_COMMIT_COMMANDS = ('ALTER', 'CREATE', 'DROP', 'RENAME', 'TRUNCATE')
+
+# MySQL errors a replayed DDL statement gets if it was already applied: table exists, unknown table,
+#   duplicate column name, cant drop the column.  The statement is done, so they arent failures.
+REPLAY_APPLIED_ERROR_CODES = (1050, 1051, 1060, 1091)
+
+# Apply throttle: Seconds between samples of the throttle hosts, and the most seconds to wait for them to get
+#   back under the limits before the sync fails, unless the zone's throttle sets interval and max_wait
+DEFAULT_THROTTLE_INTERVAL = 1
+DEFAULT_THROTTLE_MAX_WAIT = 600
+
+# Table written to by a DML statement, and tables referenced by foreign keys in a CREATE TABLE
+STATEMENT_TABLE_REGEX = re.compile(r"^\s*(?:INSERT\s+INTO|DELETE\s+FROM|UPDATE|REPLACE\s+INTO|LOAD\s+DATA\s+LOCAL\s+INFILE\s+'(?:[^'\\]|\\.|'')*'\s+INTO\s+TABLE)"
+                                   r"\s+`?([\w$]+)`?[\s(]", re.IGNORECASE)
+FOREIGN_KEY_REGEX = re.compile(r"FOREIGN\s+KEY\s*\([^)]*\)\s*REFERENCES\s+(?:`?[\w$]+`?\.)?`?([\w$]+)`?", re.IGNORECASE)
+# Unique keys, other than the primary key, in a CREATE TABLE
+UNIQUE_KEY_REGEX = re.compile(r"^\s*UNIQUE\s+(?:KEY|INDEX)\b", re.IGNORECASE | re.MULTILINE)
+
+# max_allowed_packet of each host, keyed on (host, port).  Queried on first use.
+MAX_ALLOWED_PACKETS = {}
+MAX_ALLOWED_PACKETS_LOCK = threading.Lock()
+
+
+# Semaphores limiting connections per host, keyed on (host, port).  Created on first use.
+HOST_SEMAPHORES = {}
+HOST_SEMAPHORES_LOCK = threading.Lock()
+
+
+# Consistent snapshot reads: Statements to start snapshot transactions.  FROM SESSION starts a snapshot at the
+#   same position as another connection's snapshot, which only some servers (Percona, have_snapshot_cloning) support.
+SNAPSHOT_START_SQL = 'START TRANSACTION WITH CONSISTENT SNAPSHOT'
+SNAPSHOT_START_FROM_SESSION_SQL = 'START TRANSACTION WITH CONSISTENT SNAPSHOT FROM SESSION %s'
+
+#NOTE(g): MySQL only takes a consistent snapshot in REPEATABLE READ, at any other level WITH CONSISTENT SNAPSHOT is
+#   ignored with a warning.  Pooled connections are READ COMMITTED, so the next transaction is set to REPEATABLE READ
+#   before every snapshot starts.  Without SESSION, this only applies to that 1 transaction.
+SNAPSHOT_ISOLATION_SQL = 'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ'
+
+
+class ComparisonException(Exception):
+  """Failed to compare database zones for configuration reasons."""
+
+
+class ThrottleTimeout(Exception):
+  """Throttle hosts stayed over their lag or load limits for longer than max_wait."""
+
+
+class ConsistentSnapshot:
+  """Snapshot transactions in each zone, so every read of a compare sees each zone at a single point in time.
+
+  There are a number of slots, each is 1 held connection per zone, in a snapshot transaction.  A thread takes
+  a slot with Use(), and all its Query(), QueryStream() and GetSchema() calls for those zones run in the slot's
+  snapshots.  With more than 1 slot, for parallel workers, the snapshots in a zone are started at the same
+  position if the server supports FROM SESSION, or if the zone database set allows snapshot_global_lock
+  (FLUSH TABLES WITH READ LOCK, held only while the snapshots are started).  Otherwise each slot has its own
+  snapshot, and tables diffed in different slots may be from slightly different points in time.
+
+  There are never more slots than any zone's max_connections, or than its connection pool can hold
+  with 1 connection left for opening them.  Workers past that wait in Use() for a free slot.
+  """
+
+  def __init__(self, zones, database_set, instance, slots=1):
+    self.zones = list(zones)
+    self.database_set = database_set
+    self.instance = instance
+    self.slot_count = max(1, min(int(slots), self._GetMaxSlots()))
+
+    if self.slot_count < int(slots):
+      log('Snapshot slots limited to %s, for %s workers' % (self.slot_count, slots))
+
+    # Free slots.  Each slot is a dict keyed on zone, of the connection in its snapshot.
+    self._slots = queue.Queue()
+    # All the slots, to close them
+    self._all_slots = []
+
+
+  def __enter__(self):
+    self.Open()
+    return self
+
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.Close()
+
+
+  def Open(self):
+    """Start the snapshot transactions in every zone"""
+    slots = [{} for count in range(self.slot_count)]
+    self._all_slots = slots
+
+    try:
+      for zone in self.zones:
+        connections = self._OpenZone(zone)
+
+        for (slot, conn) in zip(slots, connections):
+          slot[zone] = conn
+
+    except Exception:
+      self.Close()
+      raise
+
+    for slot in slots:
+      self._slots.put(slot)
+
+
+  def Use(self):
+    """Returns context manager, that makes a free slot's snapshots this thread's connections, waiting for a free slot."""
+    return _SnapshotSlot(self)
+
+
+  def Close(self):
+    """End the snapshot transactions, and release their connections back to their pools"""
+    for slot in self._all_slots:
+      for (zone, conn) in list(slot.items()):
+        connect_args = self._GetConnectArgs(zone)
+        query_module = connect_args[0]
+
+        try:
+          query_module.AttachConnection(conn, *connect_args[1:])
+          Query(zone, self.database_set, self.instance, 'COMMIT')
+          query_module.Release(*connect_args[1:])
+
+        except Exception as exc:
+          log('Failed to end snapshot, discarding connection: %s: %s' % (zone, exc))
+          query_module.Release(*connect_args[1:], discard=True)
+
+        del slot[zone]
+
+    self._all_slots = []
+    self._slots = queue.Queue()
+
+
+  def _GetMaxSlots(self):
+    """Returns int, the most slots the zones can hold connections for"""
+    #NOTE(g): Opening the slots runs queries on this thread's own pooled connection too
+    max_slots = connection_pool.DEFAULT_MAX_SIZE - 1
+
+    for zone in self.zones:
+      max_connections = int(ZONES[zone][self.database_set].get('max_connections', DEFAULT_MAX_CONNECTIONS))
+      max_slots = min(max_slots, max_connections)
+
+    return max_slots
+
+
+  def _GetConnectArgs(self, zone):
+    """Returns tuple (query_module, host, user, password, database, port)"""
+    (query_module, host, database, user, password, port, zone_data) = GetZoneConnectionInfo(zone, self.database_set, self.instance)
+
+    return (query_module, host, user, password, database, int(port))
+
+
+  def _OpenZone(self, zone):
+    """Returns list of slot_count connections in this zone, each in a snapshot transaction"""
+    connections = []
+
+    # 1 snapshot has nothing to line up with
+    if self.slot_count == 1:
+      connections.append(self._StartSnapshot(zone, SNAPSHOT_START_SQL))
+      return connections
+
+    # Clone the first snapshot into the others
+    result = Query(zone, self.database_set, self.instance, "SHOW VARIABLES LIKE 'have_snapshot_cloning'")
+    if result and str(result[0]['Value']).upper() == 'YES':
+      connections.append(self._StartSnapshot(zone, SNAPSHOT_START_SQL))
+
+      connect_args = self._GetConnectArgs(zone)
+      connect_args[0].AttachConnection(connections[0], *connect_args[1:])
+      try:
+        connection_id = Query(zone, self.database_set, self.instance, 'SELECT CONNECTION_ID() AS connection_id')[0]['connection_id']
+      finally:
+        connect_args[0].DetachConnection(*connect_args[1:])
+
+      for count in range(1, self.slot_count):
+        connections.append(self._StartSnapshot(zone, SNAPSHOT_START_FROM_SESSION_SQL % int(connection_id)))
+
+      return connections
+
+    # Stop writes while the snapshots start, if allowed for this zone
+    if ZONES[zone][self.database_set].get('snapshot_global_lock', False):
+      lock_conn = self._StartSnapshot(zone, 'FLUSH TABLES WITH READ LOCK', snapshot=False)
+
+      try:
+        for count in range(self.slot_count):
+          connections.append(self._StartSnapshot(zone, SNAPSHOT_START_SQL))
+
+      finally:
+        connect_args = self._GetConnectArgs(zone)
+        connect_args[0].AttachConnection(lock_conn, *connect_args[1:])
+        try:
+          Query(zone, self.database_set, self.instance, 'UNLOCK TABLES')
+        finally:
+          connect_args[0].Release(*connect_args[1:])
+
+      return connections
+
+    log('Snapshot position cant be shared, each worker gets its own snapshot: %s' % zone)
+    for count in range(self.slot_count):
+      connections.append(self._StartSnapshot(zone, SNAPSHOT_START_SQL))
+
+    return connections
+
+
+  def _StartSnapshot(self, zone, sql, snapshot=True):
+    """Returns a held connection, taken away from this thread, after running sql on it.
+
+    If snapshot is True, sql starts a snapshot transaction, and it is run in REPEATABLE READ.
+    """
+    connect_args = self._GetConnectArgs(zone)
+    query_module = connect_args[0]
+
+    (conn, cursor) = query_module.Connect(*connect_args[1:])
+    cursor.close()
+
+    try:
+      if snapshot:
+        Query(zone, self.database_set, self.instance, SNAPSHOT_ISOLATION_SQL)
+
+      Query(zone, self.database_set, self.instance, sql)
+    except Exception:
+      query_module.Release(*connect_args[1:], discard=True)
+      raise
+
+    return query_module.DetachConnection(*connect_args[1:])
+
+
+class _SnapshotSlot:
+  """Context manager for ConsistentSnapshot.Use()"""
+
+  def __init__(self, snapshot):
+    self.snapshot = snapshot
+    self.slot = None
+
+  def __enter__(self):
+    self.slot = self.snapshot._slots.get()
+
+    attached = []
+    try:
+      for (zone, conn) in self.slot.items():
+        connect_args = self.snapshot._GetConnectArgs(zone)
+        connect_args[0].AttachConnection(conn, *connect_args[1:])
+        attached.append(zone)
+
+    except Exception:
+      for zone in attached:
+        connect_args = self.snapshot._GetConnectArgs(zone)
+        connect_args[0].DetachConnection(*connect_args[1:])
+      self.snapshot._slots.put(self.slot)
+      raise
+
+    return self.slot
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    lost_zones = []
+
+    for (zone, conn) in self.slot.items():
+      connect_args = self.snapshot._GetConnectArgs(zone)
+      if connect_args[0].DetachConnection(*connect_args[1:]) is not conn:
+        lost_zones.append(zone)
+
+    # Lost connections were already closed by their pool
+    for zone in lost_zones:
+      del self.slot[zone]
+
+    # The slot goes back even if broken, so Close() still releases the connections we have
+    self.snapshot._slots.put(self.slot)
+
+    #NOTE(g): A lost connection was replaced on reconnect, so reads after it werent in the snapshot
+    if lost_zones and exc_type == None:
+      raise ComparisonException('Snapshot connection lost, reads were not consistent: %s' % ', '.join(lost_zones))
 
 
 def ReloadZoneInfo():
-  """Do this dynamically, so we can refresh the data and not restart things or reload the module."""
-  global ZONES, ZONE_APPROVERS
+  """Do this dynamically, so we can refresh the data and not restart things or reload the module.
+
+  Only config files that changed on disk are parsed again, and then the resolved connection info
+  is cleared.  Returns boolean, True if any config file changed.
+  """
+  global ZONES, ZONE_APPROVERS, DATABASE_SETS, CONFIG_CHECK_TIME
+
+  with ZONE_INFO_LOCK:
+    CONFIG_CHECK_TIME = time.time()
+
+    if not config_registry.GetChangedPaths():
+      return False
+
+    ZONES = config_registry.Load(ZONE_PATH)
+    ZONE_APPROVERS = config_registry.Load(ZONE_APPROVERS_PATH)
+    DATABASE_SETS = config_registry.Load(DATABASE_SETS_PATH)
+
+    # Database set data files are loaded again as they are used
+    ZONE_CONNECTION_INFO.clear()
 
-  ZONES = yaml.load(open(ZONE_PATH))
-  ZONE_APPROVERS = yaml.load(open(ZONE_APPROVERS_PATH))
+  log('Zone info reloaded')
+
+  return True
 
 
 def GetZoneDataSetData(zone, database_set):
@@ -79,6 +451,17 @@ def ValidateZoneSourceAndTarget(zone_source, zone_target):
   return (zone_source, zone_target)
 
 
+def ValidateZoneAcceptsSync(zone_source, zone_target, database_set):
+  """Raises ComparisonException if the target zone database set doesnt accept a full sync from the source zone.
+
+  Zones with only_accept_full_update_from only accept syncs from that zone.
+  """
+  accept_from = ZONES[zone_target][database_set].get('only_accept_full_update_from', None)
+
+  if accept_from != None and accept_from != zone_source:
+    raise ComparisonException('Zone "%s" only accepts full updates from zone "%s", not: %s' % (zone_target, accept_from, zone_source))
+
+
 def _FormatData(text, data):
   """Returns formatted text, using key/value from data dictionary"""
   for (key, value) in data.items():
@@ -90,11 +473,33 @@ def _FormatData(text, data):
 
 
 def GetZoneConnectionInfo(zone, database_set, instance):
-  """Returns the connection information"""
+  """Returns the connection information: (query_module, host, database, user, password, port, data)
+
+  Resolved once per zone, database set and instance, until a config file changes.  The data dict
+  is shared, and must not be modified.
+  """
+  if time.time() - CONFIG_CHECK_TIME >= CONFIG_CHECK_INTERVAL:
+    ReloadZoneInfo()
+
+  cache_key = (zone, database_set, instance)
+
+  with ZONE_INFO_LOCK:
+    connection_info = ZONE_CONNECTION_INFO.get(cache_key)
+    if connection_info != None:
+      return connection_info
+
+    connection_info = _GetZoneConnectionInfo(zone, database_set, instance)
+    ZONE_CONNECTION_INFO[cache_key] = connection_info
+
+  return connection_info
+
+
+def _GetZoneConnectionInfo(zone, database_set, instance):
+  """Returns the connection information, resolved from the config files"""
   # print()
   # print('%s' % ZONES[zone][database_set])
   yaml_path = '%s/%s' % (__file__, DATABASE_SETS[database_set]['data'])
-  data = yaml.load(open(yaml_path))
+  data = config_registry.Load(yaml_path)
   # print(data[instance])
 
   host = _FormatData(ZONES[zone][database_set]['host'], data[instance])
@@ -102,11 +507,20 @@ def GetZoneConnectionInfo(zone, database_set, instance):
   user = _FormatData(ZONES[zone][database_set]['user'], data[instance])
   password = _FormatData(ZONES[zone][database_set]['password'], data[instance])
   port = _FormatData(str(ZONES[zone][database_set].get('port', 3306)), data[instance])
+  instance_data = data[instance]
 
   # Pack in the data we need as well, as one validated dict
   data = {}
   #data['table_blacklist'] = ZONES[zone][database_set].get('table_blacklist', [])
   data['table_blacklist'] = ZONES[zone][database_set]['table_blacklist']
+  data['table_whitelist'] = ZONES[zone][database_set].get('table_whitelist', [])
+  data['table_filter'] = table_filter.GetTableFilter(data['table_whitelist'], data['table_blacklist'])
+
+  # Throttle hosts are formatted like the host, so each instance can have its own replicas
+  throttle = ZONES[zone][database_set].get('throttle')
+  if throttle:
+    data['throttle'] = dict(throttle)
+    data['throttle']['hosts'] = [_FormatData(str(throttle_host), instance_data) for throttle_host in throttle.get('hosts', [])]
 
   # print()
   # print('Host: %s' % host)
@@ -135,18 +549,162 @@ def Query(zone, database_set, instance, sql):
   return result
 
 
+def QueryStream(zone, database_set, instance, sql, tuples=False):
+  """Query the database in this zone.  Yields dicts, or tuples if tuples is True, one row at a time.  Master DB is always used."""
+  # Get all our connection information
+  (query_module, host, database, user, password, port, zone_data) = GetZoneConnectionInfo(zone, database_set, instance)
+
+  return query_module.QueryStream(sql, host=host, user=user, password=password, database=database, port=int(port), tuples=tuples)
+
+
 def GetSchema(zone, database_set, instance):
-  """Query the database in this zone.  Returns list of dicts.  Master DB is always used."""
+  """Query the database in this zone.  Returns list of dicts.  Master DB is always used.
+
+  Tables the zone's table_whitelist and table_blacklist exclude are not introspected, and are not in the schema.
+  """
   #print('GetSchema: %s %s %s' % (zone, database_set, instance))
 
+  # Snapshots have the schema of their zone when they were written
+  snapshot = GetSnapshotZone(zone, database_set, instance)
+  if snapshot != None:
+    return snapshot.schema
+
   # Get all our connection information
   (query_module, host, database, user, password, port, zone_data) = GetZoneConnectionInfo(zone, database_set, instance)
 
-  schema = query_module.GetSchema(host=host, user=user, password=password, database=database, port=int(port))
+  schema = query_module.GetSchema(host=host, user=user, password=password, database=database, port=int(port),
+                                  table_filter=zone_data.get('table_filter'))
 
   return schema
 
 
+def GetTableCreateSql(zone, database_set, instance, table, table_schema):
+  """Returns string, CREATE TABLE statement for this table.
+
+  Bulk schemas leave __CREATE_SQL__ as None, so it is fetched here only for the tables
+  that are actually created or dropped, and saved back into the table schema.
+  """
+  if table_schema.get('__CREATE_SQL__') == None:
+    (query_module, host, database, user, password, port, zone_data) = GetZoneConnectionInfo(zone, database_set, instance)
+
+    table_schema['__CREATE_SQL__'] = query_module.GetCreateTableSql(table, host=host, user=user, password=password, database=database, port=int(port))
+
+  return table_schema['__CREATE_SQL__']
+
+
+def IsSnapshotZone(zone):
+  """Returns boolean, True if this zone is the path of a snapshot file (see WriteSnapshot()), instead of a zone in conf/zones.yaml"""
+  if zone in SNAPSHOT_ZONES:
+    return True
+
+  if zone in ZONES:
+    return False
+
+  return zone_snapshot.IsSnapshotFile(zone)
+
+
+def GetSnapshotZone(zone, database_set, instance):
+  """Returns zone_snapshot.Snapshot if this zone is a snapshot file, or None if it is a live zone.
+
+  Raises ComparisonException if the snapshot is of a different database set, or instance if one is given.
+  """
+  if not IsSnapshotZone(zone):
+    return None
+
+  with SNAPSHOT_ZONES_LOCK:
+    snapshot = SNAPSHOT_ZONES.get(zone)
+
+    if snapshot == None:
+      try:
+        snapshot = zone_snapshot.Open(zone)
+      except zone_snapshot.SnapshotError as exc:
+        raise ComparisonException(str(exc))
+
+      SNAPSHOT_ZONES[zone] = snapshot
+
+  if snapshot.database_set != database_set or (instance != None and str(snapshot.instance) != str(instance)):
+    raise ComparisonException('Snapshot is of %s %s, not %s %s: %s' % (snapshot.database_set, snapshot.instance, database_set, instance, zone))
+
+  return snapshot
+
+
+def WriteSnapshot(zone, database_set, instance, path=None):
+  """Write a snapshot file of this zone's database set instance: its schema, and every table's rows in primary key order.
+
+  All the tables are read in 1 ConsistentSnapshot, so the snapshot is of a single point in time.  The
+  snapshot can then be compared against in place of the zone, by passing its path as the zone.
+
+  Returns tuple (path, tables), tables is a dict of table name to row count.
+  """
+  if path == None:
+    path = zone_snapshot.GetSnapshotPath(database_set, zone, instance)
+
+  with ConsistentSnapshot((zone,), database_set, instance) as consistent_snapshot:
+    with consistent_snapshot.Use():
+      schema = GetSchema(zone, database_set, instance)
+
+      # Snapshots are compared without a server, so they need every table's CREATE statement
+      for (table, table_schema) in schema.items():
+        GetTableCreateSql(zone, database_set, instance, table, table_schema)
+
+      writer = zone_snapshot.SnapshotWriter(path, database_set, zone, instance, schema)
+
+      try:
+        for table in sorted(schema.keys()):
+          table_schema = schema[table]
+          rows = IterTableRows(zone, database_set, instance, table, table_schema, order_fields=GetRowKeyFields(table_schema))
+
+          writer.WriteTable(table, table_codec.GetTableCodec(table_schema).fields, rows)
+
+        writer.Close()
+
+      except Exception:
+        writer.Abort()
+        raise
+
+  return (path, writer.tables)
+
+
+def IterTableRows(zone, database_set, instance, table, table_schema, order_fields=None):
+  """Returns iterator of the tuple rows of this table, in the field order of table_schema (its TableCodec).
+
+  If order_fields is given, the rows are sorted on those fields, like GetFieldsOrderSql().  Snapshot zones
+  read the rows from their snapshot file.  Nothing is returned if the table doesnt exist in the zone.
+  """
+  codec = table_codec.GetTableCodec(table_schema)
+
+  snapshot = GetSnapshotZone(zone, database_set, instance)
+
+  if snapshot == None:
+    (query_module, _, _, _, _, _, zone_data) = GetZoneConnectionInfo(zone, database_set, instance)
+
+    sql = 'SELECT %s FROM %s' % (codec.sql_fields, table)
+    if order_fields:
+      sql += ' ORDER BY %s' % GetFieldsOrderSql(table_schema, order_fields)
+
+    return _QueryStreamIfTableExists(zone, database_set, instance, sql, query_module, tuples=True)
+
+  rows = snapshot.IterRows(table, codec.fields)
+
+  #NOTE(g): Snapshot rows are in the row key order of the snapshot's own table schema.  Other orders are sorted in memory.
+  if order_fields and (table not in snapshot.schema or list(order_fields) != list(GetRowKeyFields(snapshot.schema[table]))):
+    GetKey = codec.GetTupleGetter(order_fields)
+    rows = iter(sorted(rows, key=lambda row: GetSortKey(GetKey(row))))
+
+  return rows
+
+
+def GetTableRowCount(zone, database_set, instance, table):
+  """Returns int, the number of rows in this zone's table"""
+  snapshot = GetSnapshotZone(zone, database_set, instance)
+  if snapshot != None:
+    return snapshot.GetRowCount(table)
+
+  result = Query(zone, database_set, instance, 'SELECT COUNT(*) AS row_count FROM %s' % table)
+
+  return int(result[0]['row_count'])
+
+
 def CompareSchemas(schema_source, schema_target):
   """Returns the differences between source and target."""
   comparison = {'create':{}, 'drop':{}, 'alter':{}}
@@ -192,10 +750,13 @@ def CompareSchemas(schema_source, schema_target):
   return comparison
 
 
-def GenerateSchemaSyncCommands(zone_source, zone_target, database_set, instance, comparison):
+def GenerateSchemaSyncCommands(zone_source, zone_target, database_set, instance, comparison, spool=True):
   """Generate a Forward and Reverse command list to sync up source and target schemas.
   Reverse should be able to undo any of the schema changes performed.
 
+  The rows of created and dropped tables are bulk loaded from spool files.  If spool is False, as when
+  the commands are only shown, they are INSERTs instead, so no spool files are written.
+
   NOTE: All forward and reverse commands must be paired.  If a forward is added, a reverse 
       must be added, even if it is None/'', and so nothing will OCCUR.  This allows these 
       statements to be ordered pairs, so they can be re-ordered later on user discretion.
@@ -236,26 +797,34 @@ def GenerateSchemaSyncCommands(zone_source, zone_target, database_set, instance,
       sql = 'DROP TABLE %s' % table
       forward_commands.append(sql)
 
+      # Bulk schemas dont have the CREATE statement yet, get it from the target where the table lives
+      if table_create_sql == None:
+        table_create_sql = GetTableCreateSql(zone_target, database_set, instance, table, {})
+
       # Add reverse to CREATE the table again
-      #TODO(g): Do I also have to grab all the data in the table to re-INSERT it back in?  In the normal case, yes, so I need to think of another case to save this step.
       sql_statements = []
       sql_statements.append(table_create_sql)
 
-      # Get all the rows in INSERT format to re-populate this table
-      insert_rows = GetSql_InsertAll(zone_target, zone_source, database_set, instance, table)
-      sql_statements += insert_rows
+      # Spool the rows from the target, to bulk load them back into this table
+      schema_target = GetSchema(zone_target, database_set, instance)
+      if spool:
+        sql_statements += GetSql_BulkLoadTable(zone_target, database_set, instance, table, schema_target[table])
+      else:
+        sql_statements += GetSql_InsertAll(zone_target, zone_source, database_set, instance, table, schema_target[table])
 
       reverse_commands.append(sql_statements)
 
   if comparison['create']:
     for (table, table_data) in comparison['create'].items():
-      sql = table_data['__CREATE_SQL__']
+      sql = GetTableCreateSql(zone_source, database_set, instance, table, table_data)
       sql_statements = []
       sql_statements.append(sql)
 
-      # Get all the rows in INSERT format to populate this table
-      insert_rows = GetSql_InsertAll(zone_source, zone_target, database_set, instance, table)
-      sql_statements += insert_rows
+      # Spool the rows from the source, to bulk load them into the new table
+      if spool:
+        sql_statements += GetSql_BulkLoadTable(zone_source, database_set, instance, table, table_data)
+      else:
+        sql_statements += GetSql_InsertAll(zone_source, zone_target, database_set, instance, table, table_data)
       forward_commands.append(sql_statements)
 
       # Add reverse to CREATE the table again
@@ -321,20 +890,11 @@ def CreateAlterModifyColumn(table, field, source_data, target_data):
 
 
 def SqlValue(table_schema, field, value):
-  """Returns a prepared string for a SQL value.  Quoting and sanitization is applied."""
-  #NOTE(g): Not just passing this in in case we want to access index or other data that
-  #   is not in the field_info dictionary
-  field_info = table_schema[field]
-
-  if value == None:
-    sql_value = 'NULL'
-  elif field_info['Type'].split('(')[0].lower() in ('varchar', 'char', 'blob'):
-    # Quote the value and turn any single quotes to double single quotes to escape them
-    sql_value = "'%s'" % SanitizeSqlString(value)
-  else:
-    sql_value = str(value)
+  """Returns a prepared string for a SQL value.  Quoting and sanitization is applied, for the field's type.
 
-  return sql_value
+  Generating SQL for many rows should use the table_codec directly, which this looks up every call.
+  """
+  return table_codec.GetTableCodec(table_schema).Format(field, value)
 
 
 def SanitizeSqlString(value):
@@ -349,234 +909,1545 @@ def SanitizeSqlString(value):
 
 def GetTableFieldsInOrder(table_schema):
   """Returns a list of strings, the fields in their table order"""
-  # Get only the Field Dictionaries in a list, strip out other data
-  field_dict_list = []
-  for field in table_schema.keys():
-    if type(table_schema[field]) == dict and '_Order' in table_schema[field]:
-      field_dict_list.append(table_schema[field])
+  # The table's codec sorted them once
+  return list(table_codec.GetTableCodec(table_schema).fields)
 
-  # Get sorted field list
-  field_dicts_sorted = sorted(field_dict_list, key=operator.itemgetter('_Order'))
 
-  fields = []
-  for field_info in field_dicts_sorted:
-    fields.append(field_info['Field'])
+def CreateInsert(table_schema_source, table_schema_target, table, row):
+  """Return str, INSERT statement for this table"""
+  # Fields in order, and their values properly quoted and escaped for their type
+  codec = table_codec.GetTableCodec(table_schema_source)
 
-  #print('Sorted Fields: %s' % fields)
+  insert_sql = 'INSERT INTO %s (%s) VALUES %s' % (table, codec.sql_fields, codec.FormatRow(row))
 
-  return fields
+  return insert_sql
 
 
-def CreateInsert(table_schema_source, table_schema_target, table, row):
-  """Return str, INSERT statement for this table"""
-  # Get the table fields in order
-  fields = GetTableFieldsInOrder(table_schema_source)
+def IterInsertBatches(table_schema_source, table_schema_target, table, rows, max_bytes, update_fields=None):
+  """Yields (sql, batch_rows), multi-row INSERT statements for all the rows, and the rows in each.
 
-  # List of SQL fields
-  insert_sql_fields = []
-  for field in fields:
-    #NOTE(g): Back-quoting all field names, to avoid any reserved word conflicts
-    insert_sql_fields.append('`%s`' % field)
+  rows are tuple rows, in the field order of table_schema_source (its TableCodec).
 
-  # List of SQL field values, properly quoted and escaped for their type
-  insert_sql_values = []
-  for field in fields:
-    insert_sql_values.append(SqlValue(table_schema_source, field, row[field]))
+  If update_fields is not None, these are upserts: INSERT ... ON DUPLICATE KEY UPDATE, which only
+  set the update_fields of rows that already exist.
 
-  insert_sql = 'INSERT INTO %s (%s) VALUES (%s)' % (table, ', '.join(insert_sql_fields), ', '.join(insert_sql_values))
+  Each statement is at most max_bytes, unless a single row is bigger than that, and then it is alone.
+  """
+  # Fields in order, and their values properly quoted and escaped for their type
+  codec = table_codec.GetTableCodec(table_schema_source)
 
-  return insert_sql
+  insert_prefix = 'INSERT INTO %s (%s) VALUES ' % (table, codec.sql_fields)
 
+  if update_fields:
+    insert_suffix = ' ON DUPLICATE KEY UPDATE %s' % ', '.join(['`%s` = VALUES(`%s`)' % (field, field) for field in update_fields])
+  else:
+    insert_suffix = ''
 
-def CreateUpdate(table_schema_source, table_schema_target, table, source_row, target_row):
-  """Return str, UPDATE statement for this row, so target becomes like source"""
-  # Get the table fields in order
-  fields = GetTableFieldsInOrder(table_schema_target)
+  prefix_bytes = len(insert_prefix.encode('utf-8')) + len(insert_suffix.encode('utf-8'))
 
-  # Build SET clauses section (`count` = 5)
-  set_clauses = []
-  for field in fields:
-    # If the row field values are different, UPDATE them.  Primary keys will always be skipped.
-    #NOTE(g): First checking if the field doesnt exist.  I am assuming that this field will
-    #   be created by the schema update, which occurs before this.
-    if field not in target_row  or (field in source_row and source_row[field] != target_row[field]):
-      sql_set = '`%s` = %s' % (field, SqlValue(table_schema_target, field, source_row[field]))
-      set_clauses.append(sql_set)
+  batch_values = []
+  batch_rows = []
+  batch_bytes = prefix_bytes
 
-  # If we have no sets to perform, for whatever reason, then we do not create an UPDATE statement
-  if not set_clauses:
-    return None
+  for row in rows:
+    row_values = codec.FormatTuple(row)
+    # Row bytes, and the ', ' separator
+    row_bytes = len(row_values.encode('utf-8')) + 2
 
-  # Build WHERE clauses sections (`id` = 1) for each primary key field
-  where_clauses = []
-  for field in table_schema_target['__PRIMARY_KEYS__']:
-    where_clauses.append('`%s` = %s' % (field, SqlValue(table_schema_target, field, source_row[field])))
+    if batch_rows and batch_bytes + row_bytes > max_bytes:
+      yield (insert_prefix + ', '.join(batch_values) + insert_suffix, batch_rows)
 
-  update_sql = 'UPDATE %s SET %s WHERE %s' % (table, ', '.join(set_clauses), ' AND '.join(where_clauses))
-  
-  return update_sql
+      batch_values = []
+      batch_rows = []
+      batch_bytes = prefix_bytes
 
+    batch_values.append(row_values)
+    batch_rows.append(row)
+    batch_bytes += row_bytes
 
-def CreateDelete(table_schema_source, table_schema_target, table, row):
-  """Return str, DELETE statement for this row"""
-  # Build WHERE clauses sections (`id` = 1) for each primary key field
-  where_clauses = []
-  for field in table_schema_source['__PRIMARY_KEYS__']:
-    where_clauses.append('`%s` = %s' % (field, SqlValue(table_schema_source, field, row[field])))
+  if batch_rows:
+    yield (insert_prefix + ', '.join(batch_values) + insert_suffix, batch_rows)
 
-  delete_sql = 'DELETE FROM %s WHERE %s' % (table, ' AND '.join(where_clauses))
 
-  return delete_sql
+def IterDeleteBatches(table_schema_source, table_schema_target, table, rows, max_bytes):
+  """Yields (sql, batch_rows), set-based DELETE ... WHERE (primary keys) IN (...) statements for all the rows.
 
+  rows are tuple rows, in the field order of table_schema_source (its TableCodec).
 
-def GetSql_InsertAll(zone_source, zone_target, database_set, instance, table, selected_schema_keys=None):
-  """Returns list of strings for all INSERT statements to create all the rows in a table."""
-  sql = 'SELECT * FROM %s' % table
-  rows = Query(zone_source, database_set, instance, sql)
+  Each statement is at most max_bytes, unless a single row is bigger than that.  Tables without a primary
+  key get a DELETE per row, from CreateDelete().
+  """
+  codec = table_codec.GetTableCodec(table_schema_source)
+  primary_keys = codec.primary_keys
 
-  # Get the schemas for the tables, each time so that they can be matches together
-  (table_schema_source, table_schema_target) = GetTableSchema(zone_source, zone_target, database_set, instance, table, selected_schema_keys=selected_schema_keys)
+  if not primary_keys:
+    for row in rows:
+      yield (CreateDelete(table_schema_source, table_schema_target, table, codec.ToDict(row)), [row])
+    return
 
-  inserts = []
-  for row_data in rows:
-    insert_sql = CreateInsert(table_schema_source, table_schema_target, table, row_data)
-    inserts.append(insert_sql)
+  # Build the WHERE clause start: `id` IN (, or (`id`, `other`) IN (
+  if len(primary_keys) == 1:
+    delete_prefix = 'DELETE FROM %s WHERE `%s` IN (' % (table, primary_keys[0])
+  else:
+    delete_prefix = 'DELETE FROM %s WHERE (%s) IN (' % (table, ', '.join(['`%s`' % field for field in primary_keys]))
+  prefix_bytes = len(delete_prefix.encode('utf-8')) + 1
 
-  return inserts
+  batch_values = []
+  batch_rows = []
+  batch_bytes = prefix_bytes
 
+  for row in rows:
+    key_values = codec.FormatTuplePrimaryKey(row)
+    if len(key_values) == 1:
+      row_values = key_values[0]
+    else:
+      row_values = '(%s)' % ', '.join(key_values)
+    # Row bytes, and the ', ' separator
+    row_bytes = len(row_values.encode('utf-8')) + 2
 
-def GetRowPrimaryKeyTuple(table_schema, row):
-  """Returns a list of the primary keys for this row."""
-  primary_key_data = []
+    if batch_rows and batch_bytes + row_bytes > max_bytes:
+      yield (delete_prefix + ', '.join(batch_values) + ')', batch_rows)
 
-  for field in table_schema['__PRIMARY_KEYS__']:
-    primary_key_data.append(row[field])
+      batch_values = []
+      batch_rows = []
+      batch_bytes = prefix_bytes
 
-  return tuple(primary_key_data)
+    batch_values.append(row_values)
+    batch_rows.append(row)
+    batch_bytes += row_bytes
 
+  if batch_rows:
+    yield (delete_prefix + ', '.join(batch_values) + ')', batch_rows)
 
-def GetSql_DatabaseDiff(zone_source, zone_target, database_set, instance, selected_schema_keys=None):
-  """Return all the difference data between source and target database."""
-  diff = {}
 
-  schema_source = GetSchema(zone_source, database_set, instance)
+def GetStatementByteBudget(zone, database_set, instance):
+  """Returns int, most bytes a batched statement run in this zone should be, from its max_allowed_packet"""
+  # Statements for a snapshot are only shown, never run
+  if IsSnapshotZone(zone):
+    return INSERT_BATCH_MAX_BYTES
 
-  for (table, schema_data) in schema_source.items():
-    diff[table] = GetSql_TableRowDiff(zone_source, zone_target, database_set, instance, table, selected_schema_keys=selected_schema_keys)
+  (query_module, host, database, user, password, port, zone_data) = GetZoneConnectionInfo(zone, database_set, instance)
 
-  return diff
+  with MAX_ALLOWED_PACKETS_LOCK:
+    max_allowed_packet = MAX_ALLOWED_PACKETS.get((host, port))
 
+  if max_allowed_packet == None:
+    result = Query(zone, database_set, instance, 'SELECT @@max_allowed_packet AS max_allowed_packet')
+    max_allowed_packet = int(result[0]['max_allowed_packet'])
 
-def SkipTableCheck(table, zone_data):
-  """Check that this table isnt blacklisted"""
+    with MAX_ALLOWED_PACKETS_LOCK:
+      MAX_ALLOWED_PACKETS[(host, port)] = max_allowed_packet
 
-  # print(zone_data['table_blacklist'])
-  # import sys
-  # sys.exit(0)
+  return min(INSERT_BATCH_MAX_BYTES, int(max_allowed_packet * INSERT_BATCH_PACKET_FRACTION))
 
-  for black_item in zone_data['table_blacklist']:
-    black_item_regex = black_item.replace('*', '.*?')
 
-    results = re.findall(black_item_regex, table)
+def GetChangedFields(table_schema_target, source_row, target_row):
+  """Returns tuple of the fields to SET, so the target row becomes like the source row, in table order"""
+  changed_fields = []
 
-    # Match on the regex, skip this table, its black listed
-    if results:
-      return True
+  for field in table_codec.GetTableCodec(table_schema_target).fields:
+    # If the row field values are different, UPDATE them.  Primary keys will always be skipped.
+    #NOTE(g): First checking if the field doesnt exist.  I am assuming that this field will
+    #   be created by the schema update, which occurs before this.
+    if field not in target_row  or (field in source_row and source_row[field] != target_row[field]):
+      changed_fields.append(field)
 
-  return False
+  return tuple(changed_fields)
 
 
+def CreateUpdate(table_schema_source, table_schema_target, table, source_row, target_row):
+  """Return str, UPDATE statement for this row, so target becomes like source.
 
-def GetSql_TableRowDiff(zone_source, zone_target, database_set, instance, table, selected_schema_keys=None):
-  """Returns list of strings for all INSERT statements to create all the rows in a table."""
-  # Difference between source and target data
-  diff = {'insert':[], 'delete':[], 'update':[]}
+  Tables without a primary key match the target row on all its fields, with <=> so NULLs match, and update
+  only 1 row, since other rows can have the same values.
+  """
+  codec = table_codec.GetTableCodec(table_schema_target)
 
-  sql = 'SELECT * FROM %s' % table
-  #TOOD(g): If a table is missing, going to have some issues here.  Work through this with testing.
+  # Build SET clauses section (`count` = 5)
+  set_clauses = []
+  for field in GetChangedFields(table_schema_target, source_row, target_row):
+    sql_set = '`%s` = %s' % (field, codec.formatters[field](source_row[field]))
+    set_clauses.append(sql_set)
 
+  # If we have no sets to perform, for whatever reason, then we do not create an UPDATE statement
+  if not set_clauses:
+    return None
 
-  # Get the Query Module, needed for exception handling
-  #TODO(g): Make this easier, so all the work doesnt have to be done every time?  This loads data and stuff...
-  (query_module, _, _, _, _, _, zone_data) = GetZoneConnectionInfo(zone_source, database_set, instance)
+  # Build WHERE clauses sections (`id` = 1) for each primary key field
+  if codec.primary_keys:
+    where_clauses = []
+    for (field, sql_value) in zip(codec.primary_keys, codec.FormatPrimaryKey(source_row)):
+      where_clauses.append('`%s` = %s' % (field, sql_value))
 
-  if SkipTableCheck(table, zone_data):
-    return diff
+    return 'UPDATE %s SET %s WHERE %s' % (table, ', '.join(set_clauses), ' AND '.join(where_clauses))
 
-  # Source Rows
-  try:
-    source_rows = Query(zone_source, database_set, instance, sql)
-  except query_module.QueryFailure as e:
-    # If we failed because the table doesnt exist (MySQL error code)
-    if e.code == 1146:
-      source_rows = []
-    else:
-      raise e
+  where_clauses = []
+  for (field, formatter) in codec.row_formatters:
+    if field in target_row:
+      where_clauses.append('`%s` <=> %s' % (field, formatter(target_row[field])))
+
+  update_sql = 'UPDATE %s SET %s WHERE %s LIMIT 1' % (table, ', '.join(set_clauses), ' AND '.join(where_clauses))
+
+  return update_sql
+
+
+def CreateDelete(table_schema_source, table_schema_target, table, row):
+  """Return str, DELETE statement for this row.
+
+  Tables without a primary key match the row on all its fields, with <=> so NULLs match, and delete
+  only 1 row, since other rows can have the same values.
+  """
+  codec = table_codec.GetTableCodec(table_schema_source)
+
+  # Build WHERE clauses sections (`id` = 1) for each primary key field
+  if codec.primary_keys:
+    where_clauses = []
+    for (field, sql_value) in zip(codec.primary_keys, codec.FormatPrimaryKey(row)):
+      where_clauses.append('`%s` = %s' % (field, sql_value))
+
+    return 'DELETE FROM %s WHERE %s' % (table, ' AND '.join(where_clauses))
+
+  where_clauses = []
+  for (field, formatter) in codec.row_formatters:
+    where_clauses.append('`%s` <=> %s' % (field, formatter(row[field])))
+
+  delete_sql = 'DELETE FROM %s WHERE %s LIMIT 1' % (table, ' AND '.join(where_clauses))
+
+  return delete_sql
+
+
+def GetSql_InsertAll(zone_source, zone_target, database_set, instance, table, table_schema):
+  """Returns list of strings for all INSERT statements to create all the rows in a table.
+
+  table_schema is the source zone's.  Rows are batched into multi-row INSERTs that fit the
+  max_allowed_packet of both zones, since this is used to populate either zone.
+  """
+  rows = IterTableRows(zone_source, database_set, instance, table, table_schema)
+
+  max_bytes = min(GetStatementByteBudget(zone_source, database_set, instance), GetStatementByteBudget(zone_target, database_set, instance))
+
+  inserts = []
+  for (insert_sql, batch_rows) in IterInsertBatches(table_schema, table_schema, table, rows, max_bytes):
+    inserts.append(insert_sql)
+
+  return inserts
+
+
+def GetSql_BulkLoadTable(zone, database_set, instance, table, table_schema):
+  """Returns list of strings, the LOAD DATA statement to load all the rows of this zone's table into another zone.
+
+  The rows are streamed into a spool file now, so they are never all held in memory.  The list is empty if
+  the table has no rows.
+  """
+  (spool_path, row_count) = WriteTableSpool(zone, database_set, instance, table, table_schema)
+
+  if row_count == 0:
+    os.remove(spool_path)
+    return []
+
+  return [CreateLoadData(table_schema, table, spool_path)]
+
+
+def WriteTableSpool(zone, database_set, instance, table, table_schema):
+  """Stream all the rows of this zone's table into a TSV spool file, in LOAD DATA format.  Returns (path, row_count)"""
+  fields = GetTableFieldsInOrder(table_schema)
+
+  if not os.path.isdir(SPOOL_PATH):
+    os.makedirs(SPOOL_PATH, exist_ok=True)
+
+  # Snapshot zones are file paths, only their file name goes in the spool name
+  zone_name = os.path.basename(str(zone))
+
+  spool_path = '%s/%s.%s.%s.%s.%s.%s.%s.tsv' % (SPOOL_PATH, zone_name, database_set, instance, table, int(time.time()), os.getpid(),
+                                               next(SPOOL_COUNTER))
+
+  # Binary fields are written as hex, and decoded by CreateLoadData()
+  binary_fields = [GetFieldBaseType(table_schema[field]) in BINARY_TYPES for field in fields]
+
+  row_count = 0
+
+  with open(spool_path, 'wb') as spool_file:
+    for row in IterTableRows(zone, database_set, instance, table, table_schema):
+      values = []
+      for (value, binary) in zip(row, binary_fields):
+        values.append(SpoolValue(value, binary))
+
+      spool_file.write(b'\t'.join(values) + b'\n')
+      row_count += 1
+
+  log('Spooled %s rows: %s: %s' % (row_count, table, spool_path))
+
+  return (spool_path, row_count)
+
+
+def RemoveSpools(commands):
+  """Remove the spool files that the LOAD DATA statements of these commands load, once they are no longer needed"""
+  for statement in FlattenCommand(commands):
+    match = LOAD_DATA_REGEX.match(statement)
+    if not match:
+      continue
+
+    # Undo the escaping of CreateLoadData()
+    spool_path = match.group(1).replace('\\\\', '\\').replace("''", "'")
+
+    if spool_path.endswith('.tsv') and os.path.isfile(spool_path):
+      os.remove(spool_path)
+      log('Removed spool: %s' % spool_path)
+
+
+def SpoolValue(value, binary=False):
+  """Returns bytes, the value in LOAD DATA escape format.  If binary, the value is written as hex."""
+  if value == None:
+    return b'\\N'
+
+  if binary:
+    if type(value) == str:
+      value = value.encode('utf-8')
+    return value.hex().encode('ascii')
+
+  # Like the SQL literals of table_codec: str() of a timedelta is '1 day, 6:00:00', which a TIME column misreads
+  if type(value) == bytes:
+    data = value
+  elif isinstance(value, datetime.timedelta):
+    data = table_codec.FormatTimeDelta(value).encode('ascii')
+  elif type(value) == bool:
+    data = str(int(value)).encode('ascii')
+  else:
+    data = str(value).encode('utf-8')
+
+  # Backslash first, so the escapes added after it arent escaped again
+  data = data.replace(b'\\', b'\\\\').replace(b'\t', b'\\t').replace(b'\n', b'\\n').replace(b'\r', b'\\r').replace(b'\x00', b'\\0')
+
+  return data
+
+
+def CreateLoadData(table_schema, table, spool_path):
+  """Returns string, LOAD DATA LOCAL INFILE statement to load a WriteTableSpool() file into the table"""
+  fields = GetTableFieldsInOrder(table_schema)
+
+  # Binary fields are read into variables, and decoded from hex
+  load_fields = []
+  set_clauses = []
+  for field in fields:
+    if GetFieldBaseType(table_schema[field]) in BINARY_TYPES:
+      load_fields.append('@`%s`' % field)
+      set_clauses.append('`%s` = UNHEX(@`%s`)' % (field, field))
+    else:
+      load_fields.append('`%s`' % field)
+
+  sql = "LOAD DATA LOCAL INFILE '%s' INTO TABLE %s CHARACTER SET utf8mb4 " \
+        "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' (%s)" % (SanitizeSqlString(spool_path).replace('\\', '\\\\'),
+                                                                                     table, ', '.join(load_fields))
+
+  if set_clauses:
+    sql += ' SET %s' % ', '.join(set_clauses)
+
+  return sql
+
+
+def IsBulkReload(zone_source, zone_target, database_set, instance, table, table_diff, table_schema_source, table_schema_target, selected_schema_keys):
+  """Returns boolean, True if so many rows of this table are different that it should be reloaded in bulk.
+
+  Only done when every change is selected, and the table fields are the same, since all the source rows are loaded.
+  Never done for tables referenced by foreign keys: MySQL wont TRUNCATE them (error 1701), and emptying them would
+  cascade to, or be refused by, the rows that reference them.
+  """
+  if selected_schema_keys != None or not IsSameFields(table_schema_source, table_schema_target):
+    return False
+
+  changed_count = table_diff.GetChangeCount()
+  if changed_count < BULK_LOAD_MIN_ROWS:
+    return False
+
+  if IsSnapshotZone(zone_target):
+    bulk_load_fraction = DEFAULT_BULK_LOAD_FRACTION
+  else:
+    bulk_load_fraction = ZONES[zone_target][database_set].get('bulk_load_fraction', DEFAULT_BULK_LOAD_FRACTION)
+
+  row_count = GetTableRowCount(zone_source, database_set, instance, table)
+  if changed_count <= row_count * float(bulk_load_fraction):
+    return False
+
+  # The target gets the source's foreign keys with the schema sync, so both zones' are checked
+  if IsForeignKeyReferenced(zone_source, database_set, instance, table) or IsForeignKeyReferenced(zone_target, database_set, instance, table):
+    return False
+
+  return True
+
+
+def GetRowPrimaryKeyTuple(table_schema, row):
+  """Returns a tuple of the primary keys for this row."""
+  return table_codec.GetTableCodec(table_schema).GetPrimaryKey(row)
+
+
+def GetSql_DatabaseDiff(zone_source, zone_target, database_set, instance, selected_schema_keys=None, diff_mode=None, skip_identical_tables=False, workers=1,
+                        snapshot=False):
+  """Return all the difference data between source and target database: dict of table name to TableDiff.
+
+  If skip_identical_tables is True, tables with the same row count and checksum in both zones
+  are not diffed, so their rows are never fetched.
+
+  If workers is more than 1, that many tables are diffed at the same time, limited per host by
+  the max_connections of each zone database set.
+
+  If snapshot is True, all reads run in ConsistentSnapshot transactions, so writes made to the
+  zones during the compare dont show up in the diff.
+
+  Either zone can be a snapshot file (see WriteSnapshot()), which is read instead of a live zone.
+  """
+  # Snapshot files dont change, only live zones need snapshot transactions
+  live_zones = [zone for zone in (zone_source, zone_target) if not IsSnapshotZone(zone)]
+
+  if not snapshot or not live_zones:
+    return _GetSql_DatabaseDiff(zone_source, zone_target, database_set, instance, selected_schema_keys, diff_mode, skip_identical_tables, workers, None)
+
+  with ConsistentSnapshot(live_zones, database_set, instance, slots=workers) as consistent_snapshot:
+    return _GetSql_DatabaseDiff(zone_source, zone_target, database_set, instance, selected_schema_keys, diff_mode, skip_identical_tables, workers,
+                                consistent_snapshot)
+
+
+def _GetSql_DatabaseDiff(zone_source, zone_target, database_set, instance, selected_schema_keys, diff_mode, skip_identical_tables, workers, consistent_snapshot):
+  """GetSql_DatabaseDiff(), with all reads in consistent_snapshot, if it isnt None"""
+  diff = {}
+  tables = []
+
+  # Schemas, checksums, and the tables diffed on this thread, are read in 1 snapshot slot
+  if consistent_snapshot != None:
+    slot = consistent_snapshot.Use()
+  else:
+    slot = _NoSnapshotSlot()
+
+  with slot:
+    schema_source = GetSchema(zone_source, database_set, instance)
+    # Load the target schema now, so the workers dont all introspect it at once
+    GetSchema(zone_target, database_set, instance)
+
+    if skip_identical_tables:
+      identical_tables = GetIdenticalTables(zone_source, zone_target, database_set, instance)
+    else:
+      identical_tables = set()
+
+    for (table, schema_data) in schema_source.items():
+      if table in identical_tables:
+        diff[table] = NewTableDiff(zone_source, zone_target, database_set, instance, table, selected_schema_keys=selected_schema_keys)
+      else:
+        tables.append(table)
+
+    if workers <= 1:
+      for table in tables:
+        diff[table] = GetSql_TableRowDiff(zone_source, zone_target, database_set, instance, table, selected_schema_keys=selected_schema_keys, diff_mode=diff_mode)
+
+  if workers > 1:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+      futures = {}
+      for table in tables:
+        future = executor.submit(_GetSql_TableRowDiffLimited, zone_source, zone_target, database_set, instance, table, selected_schema_keys, diff_mode,
+                                 consistent_snapshot)
+        futures[future] = table
+
+      # Any worker exception is raised here
+      for future in concurrent.futures.as_completed(futures):
+        diff[futures[future]] = future.result()
+
+  return diff
+
+
+def _GetSql_TableRowDiffLimited(zone_source, zone_target, database_set, instance, table, selected_schema_keys, diff_mode, consistent_snapshot=None):
+  """GetSql_TableRowDiff(), run once a connection to both the source and target hosts is available.
+
+  If consistent_snapshot isnt None, the table is read in one of its slots.
+  """
+  semaphores = GetHostSemaphores((zone_source, zone_target), database_set, instance)
+
+  for semaphore in semaphores:
+    semaphore.acquire()
 
-  # Target Rows
   try:
-    target_rows = Query(zone_target, database_set, instance, sql)
-  except query_module.QueryFailure as e:
-    # If we failed because the table doesnt exist (MySQL error code)
-    if e.code == 1146:
-      target_rows = []
+    if consistent_snapshot != None:
+      slot = consistent_snapshot.Use()
     else:
-      raise e
+      slot = _NoSnapshotSlot()
 
+    with slot:
+      return GetSql_TableRowDiff(zone_source, zone_target, database_set, instance, table, selected_schema_keys=selected_schema_keys, diff_mode=diff_mode)
 
-  # Get the schemas for the tables, each time so that they can be matches together
+  finally:
+    for semaphore in semaphores:
+      semaphore.release()
+
+
+def GetSql_DatabaseDiffMulti(zone_source, zone_targets, database_set, instance, selected_schema_keys=None, skip_identical_tables=False, workers=1,
+                             snapshot=False):
+  """Returns dict keyed on target zone, of its diff from the source zone: dict of table name to TableDiff.
+
+  Like GetSql_DatabaseDiff() for each target, but the source is only read once for all of them: its
+  schema, table checksums, and row digests are shared, and its changed rows are fetched once (see
+  GetSql_TableRowDiffMulti()).
+
+  If workers is more than 1, that many tables are diffed at the same time, limited per host by the
+  max_connections of each zone database set.  If snapshot is True, all reads run in 1 ConsistentSnapshot
+  of the source and every target.
+  """
+  if not snapshot:
+    return _GetSql_DatabaseDiffMulti(zone_source, zone_targets, database_set, instance, selected_schema_keys, skip_identical_tables, workers, None)
+
+  with ConsistentSnapshot([zone_source] + list(zone_targets), database_set, instance, slots=workers) as consistent_snapshot:
+    return _GetSql_DatabaseDiffMulti(zone_source, zone_targets, database_set, instance, selected_schema_keys, skip_identical_tables, workers,
+                                     consistent_snapshot)
+
+
+def _GetSql_DatabaseDiffMulti(zone_source, zone_targets, database_set, instance, selected_schema_keys, skip_identical_tables, workers,
+                              consistent_snapshot):
+  """GetSql_DatabaseDiffMulti(), with all reads in consistent_snapshot, if it isnt None"""
+  diffs = {}
+  for zone_target in zone_targets:
+    diffs[zone_target] = {}
+
+  # Tables to diff, and the targets each is diffed against
+  table_targets = []
+
+  # Schemas, checksums, and the tables diffed on this thread, are read in 1 snapshot slot
+  if consistent_snapshot != None:
+    slot = consistent_snapshot.Use()
+  else:
+    slot = _NoSnapshotSlot()
+
+  with slot:
+    schema_source = GetSchema(zone_source, database_set, instance)
+    # Load the target schemas now, so the workers dont all introspect them at once
+    for zone_target in zone_targets:
+      GetSchema(zone_target, database_set, instance)
+
+    if skip_identical_tables:
+      identical_tables = GetIdenticalTablesMulti(zone_source, zone_targets, database_set, instance)
+    else:
+      identical_tables = {}
+
+    for table in schema_source.keys():
+      targets = []
+      for zone_target in zone_targets:
+        if table in identical_tables.get(zone_target, ()):
+          diffs[zone_target][table] = NewTableDiff(zone_source, zone_target, database_set, instance, table, selected_schema_keys=selected_schema_keys)
+        else:
+          targets.append(zone_target)
+
+      if targets:
+        table_targets.append((table, targets))
+
+    if workers <= 1:
+      for (table, targets) in table_targets:
+        for (zone_target, table_diff) in GetSql_TableRowDiffMulti(zone_source, targets, database_set, instance, table,
+                                                                  selected_schema_keys=selected_schema_keys).items():
+          diffs[zone_target][table] = table_diff
+
+  if workers > 1:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+      futures = {}
+      for (table, targets) in table_targets:
+        future = executor.submit(_GetSql_TableRowDiffMultiLimited, zone_source, targets, database_set, instance, table, selected_schema_keys,
+                                 consistent_snapshot)
+        futures[future] = table
+
+      # Any worker exception is raised here
+      for future in concurrent.futures.as_completed(futures):
+        for (zone_target, table_diff) in future.result().items():
+          diffs[zone_target][futures[future]] = table_diff
+
+  return diffs
+
+
+def _GetSql_TableRowDiffMultiLimited(zone_source, zone_targets, database_set, instance, table, selected_schema_keys, consistent_snapshot=None):
+  """GetSql_TableRowDiffMulti(), run once a connection to the source and every target host is available.
+
+  If consistent_snapshot isnt None, the table is read in one of its slots.
+  """
+  semaphores = GetHostSemaphores([zone_source] + list(zone_targets), database_set, instance)
+
+  for semaphore in semaphores:
+    semaphore.acquire()
+
+  try:
+    if consistent_snapshot != None:
+      slot = consistent_snapshot.Use()
+    else:
+      slot = _NoSnapshotSlot()
+
+    with slot:
+      return GetSql_TableRowDiffMulti(zone_source, zone_targets, database_set, instance, table, selected_schema_keys=selected_schema_keys)
+
+  finally:
+    for semaphore in semaphores:
+      semaphore.release()
+
+
+class _NoSnapshotSlot:
+  """Context manager that does nothing, used in place of ConsistentSnapshot.Use() when not in snapshot mode"""
+
+  def __enter__(self):
+    return None
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    pass
+
+
+def GetHostSemaphore(zone, database_set, instance):
+  """Returns the semaphore limiting connections to this zone's host, to its max_connections."""
+  (query_module, host, database, user, password, port, zone_data) = GetZoneConnectionInfo(zone, database_set, instance)
+
+  with HOST_SEMAPHORES_LOCK:
+    if (host, port) not in HOST_SEMAPHORES:
+      max_connections = ZONES[zone][database_set].get('max_connections', DEFAULT_MAX_CONNECTIONS)
+      HOST_SEMAPHORES[(host, port)] = threading.BoundedSemaphore(int(max_connections))
+
+    return HOST_SEMAPHORES[(host, port)]
+
+
+def GetHostSemaphores(zones, database_set, instance):
+  """Returns list of the host semaphores of these zones, without duplicates, in the order they must be acquired.
+
+  Snapshot zones have no host, and no semaphore.
+  """
+  semaphores = []
+  for zone in zones:
+    if IsSnapshotZone(zone):
+      continue
+
+    semaphore = GetHostSemaphore(zone, database_set, instance)
+    if semaphore not in semaphores:
+      semaphores.append(semaphore)
+
+  # Always acquire in the same order, so 2 workers cant each hold the semaphore the other is waiting on
+  semaphores.sort(key=id)
+
+  return semaphores
+
+
+def GetIdenticalTables(zone_source, zone_target, database_set, instance):
+  """Returns set of table names that have the same fields, row count and checksum in both zones."""
+  return GetIdenticalTablesMulti(zone_source, [zone_target], database_set, instance)[zone_target]
+
+
+def GetIdenticalTablesMulti(zone_source, zone_targets, database_set, instance):
+  """Returns dict keyed on target zone, of the set of table names with the same fields, row count and checksum in it and the source.
+
+  The source tables are checksummed once, for all the targets.  Snapshot zones cant be checksummed, and have no identical tables.
+  Only tables with a primary key are checksummed: the checksum is a BIT_XOR of the rows, and without one, duplicate
+  rows cancel each other out, so rows {x, x} and {y, y} would match.
+  """
+  identical_tables = {}
+  for zone_target in zone_targets:
+    identical_tables[zone_target] = set()
+
+  if IsSnapshotZone(zone_source):
+    return identical_tables
+
+  zone_targets = [zone_target for zone_target in zone_targets if not IsSnapshotZone(zone_target)]
+
+  (query_module, _, _, _, _, _, zone_data) = GetZoneConnectionInfo(zone_source, database_set, instance)
+
+  schema_source = GetSchema(zone_source, database_set, instance)
+
+  # Only tables in both zones with the same fields and primary key can match.  Blacklisted tables are never diffed anyway.
+  target_tables = {}
+  for zone_target in zone_targets:
+    schema_target = GetSchema(zone_target, database_set, instance)
+
+    target_tables[zone_target] = []
+    for table in schema_source.keys():
+      if table not in schema_target or SkipTableCheck(table, zone_data):
+        continue
+
+      primary_keys = schema_source[table]['__PRIMARY_KEYS__']
+      if primary_keys and primary_keys == schema_target[table]['__PRIMARY_KEYS__'] and IsSameFields(schema_source[table], schema_target[table]):
+        target_tables[zone_target].append(table)
+
+  tables = [table for table in schema_source.keys() if [zone_target for zone_target in zone_targets if table in target_tables[zone_target]]]
+  if not tables:
+    return identical_tables
+
+  source_checksums = GetTableChecksums(zone_source, database_set, instance, schema_source, tables)
+
+  for zone_target in zone_targets:
+    if not target_tables[zone_target]:
+      continue
+
+    target_checksums = GetTableChecksums(zone_target, database_set, instance, schema_source, target_tables[zone_target])
+
+    for table in target_tables[zone_target]:
+      if source_checksums[table] == target_checksums[table]:
+        identical_tables[zone_target].add(table)
+
+    log('Identical tables, skipping diff: %s: %s of %s' % (zone_target, len(identical_tables[zone_target]), len(target_tables[zone_target])))
+
+  return identical_tables
+
+
+def GetTableChecksums(zone, database_set, instance, schema, tables):
+  """Returns dict keyed on table name, of (row_count, checksum).  All tables are checksummed in 1 statement."""
+  selects = []
+  for table in tables:
+    sql = "SELECT '%s' AS table_name, COUNT(*) AS row_count, BIT_XOR(%s) AS checksum FROM %s" % (SanitizeSqlString(table),
+                                                                                              GetRowChecksumSql(schema[table]), table)
+    selects.append(sql)
+
+  result = Query(zone, database_set, instance, ' UNION ALL '.join(selects))
+
+  checksums = {}
+  for item in result:
+    checksums[item['table_name']] = (int(item['row_count']), int(item['checksum']))
+
+  return checksums
+
+
+def SkipTableCheck(table, zone_data):
+  """Returns boolean, True if this table is excluded by the zone's table_whitelist and table_blacklist"""
+  zone_filter = zone_data.get('table_filter')
+  if zone_filter == None:
+    zone_filter = table_filter.GetTableFilter(zone_data.get('table_whitelist', []), zone_data['table_blacklist'])
+
+  return not zone_filter.IsIncluded(table)
+
+
+class TableDiff:
+  """Row differences of 1 table, between the source and target zones.
+
+  Rows are tuples of field values, in the field order of their zone's table schema (its TableCodec): insert
+  has source rows, delete has target rows, and update has (source row, target row) pairs.  Tuples are several
+  times smaller than dict rows, and compare faster.  ToDict() returns the dict rows, for output.
+  """
+  __slots__ = ('table', 'table_schema_source', 'table_schema_target', 'source_codec', 'target_codec', 'insert', 'delete', 'update',
+               'key_fields', 'GetSourceKey', 'GetTargetKey', '_same_fields', '_target_indexes', '_update_indexes')
+
+  def __init__(self, table, table_schema_source, table_schema_target):
+    self.table = table
+    self.table_schema_source = table_schema_source
+    self.table_schema_target = table_schema_target
+    self.source_codec = table_codec.GetTableCodec(table_schema_source)
+    self.target_codec = table_codec.GetTableCodec(table_schema_target)
+
+    self.insert = []
+    self.delete = []
+    self.update = []
+
+    source_indexes = self.source_codec.field_indexes
+    target_indexes = self.target_codec.field_indexes
+
+    # Rows are matched on the source's row key fields, that the target has too.  Both sides must be sorted on these.
+    self.key_fields = [field for field in GetRowKeyFields(table_schema_source) if field in target_indexes]
+    self.GetSourceKey = self.source_codec.GetTupleGetter(self.key_fields)
+    self.GetTargetKey = self.target_codec.GetTupleGetter(self.key_fields)
+
+    # Rows are the same if they have the same fields and values, like dict rows.  Usually the fields are in the same order.
+    self._same_fields = (self.source_codec.fields == self.target_codec.fields)
+    if set(source_indexes) == set(target_indexes):
+      self._target_indexes = tuple([target_indexes[field] for field in self.source_codec.fields])
+    else:
+      self._target_indexes = None
+
+    # Fields an update can SET: the target's fields that the source has too, in target order
+    self._update_indexes = tuple([(field, source_indexes[field], target_indexes[field]) for field in self.target_codec.fields
+                                  if field in source_indexes])
+
+
+  def __repr__(self):
+    return 'TableDiff(%s: insert=%s, delete=%s, update=%s)' % (self.table, len(self.insert), len(self.delete), len(self.update))
+
+
+  def IsSameRow(self, source_row, target_row):
+    """Returns boolean, True if the source and target rows have the same fields and values"""
+    if self._same_fields:
+      return source_row == target_row
+
+    if self._target_indexes == None:
+      return False
+
+    for (source_value, target_index) in zip(source_row, self._target_indexes):
+      if source_value != target_row[target_index]:
+        return False
+
+    return True
+
+
+  def GetChangedFields(self, source_row, target_row):
+    """Returns tuple of the fields to SET, so the target row becomes like the source row, in table order"""
+    return tuple([field for (field, source_index, target_index) in self._update_indexes if source_row[source_index] != target_row[target_index]])
+
+
+  def GetChangeCount(self):
+    """Returns int, the number of rows inserted, deleted and updated"""
+    return len(self.insert) + len(self.delete) + len(self.update)
+
+
+  def Reverse(self):
+    """Returns TableDiff from the target to the source.  The rows are shared, not copied."""
+    reverse_diff = TableDiff(self.table, self.table_schema_target, self.table_schema_source)
+
+    reverse_diff.insert = self.delete
+    reverse_diff.delete = self.insert
+    reverse_diff.update = [(target_row, source_row) for (source_row, target_row) in self.update]
+
+    return reverse_diff
+
+
+  def ToDict(self):
+    """Returns dict of lists of dict rows: insert, delete, update (pairs of source and target rows)"""
+    source_codec = self.source_codec
+    target_codec = self.target_codec
+
+    return {'insert':[source_codec.ToDict(row) for row in self.insert],
+            'delete':[target_codec.ToDict(row) for row in self.delete],
+            'update':[(source_codec.ToDict(source_row), target_codec.ToDict(target_row)) for (source_row, target_row) in self.update]}
+
+
+def NewTableDiff(zone_source, zone_target, database_set, instance, table, selected_schema_keys=None):
+  """Returns empty TableDiff for this table, with the current schemas of both zones"""
   (table_schema_source, table_schema_target) = GetTableSchema(zone_source, zone_target, database_set, instance, table, selected_schema_keys=selected_schema_keys)
-  table_schema = table_schema_source
 
-  # Build dictionary for source based on primary keys
+  return TableDiff(table, table_schema_source, table_schema_target)
+
+
+def DataDiffToDicts(diff):
+  """Returns dict of table name to the dict of dict rows of its TableDiff, see TableDiff.ToDict()"""
+  diff_dicts = {}
+
+  for (table, table_diff) in diff.items():
+    diff_dicts[table] = table_diff.ToDict()
+
+  return diff_dicts
+
+
+def GetSql_TableRowDiff(zone_source, zone_target, database_set, instance, table, selected_schema_keys=None, diff_mode=None):
+  """Returns TableDiff, the row differences between the source and target table: insert, delete, update
+
+  diff_mode is one of DIFF_MODES, default is DEFAULT_DIFF_MODE.
+  """
+  if diff_mode == None:
+    diff_mode = DEFAULT_DIFF_MODE
+
+  # Snapshot zones can only be read in row order, not queried
+  if diff_mode != 'stream' and (IsSnapshotZone(zone_source) or IsSnapshotZone(zone_target)):
+    diff_mode = 'stream'
+
+  # Stream mode: Only the differences are kept in memory, not the tables
+  if diff_mode == 'stream':
+    diff = NewTableDiff(zone_source, zone_target, database_set, instance, table, selected_schema_keys=selected_schema_keys)
+
+    for (operation, data) in IterTableRowDiff(zone_source, zone_target, database_set, instance, table, selected_schema_keys=selected_schema_keys):
+      getattr(diff, operation).append(data)
+
+    return diff
+
+  # Checksum mode: Only rows from primary key ranges whose checksums differ are fetched
+  elif diff_mode == 'checksum':
+    return GetSql_TableRowDiffChecksum(zone_source, zone_target, database_set, instance, table, selected_schema_keys=selected_schema_keys)
+
+  # Digest mode: Only row digests are kept in memory, and only rows whose digests differ are fetched
+  elif diff_mode == 'digest':
+    return GetSql_TableRowDiffDigest(zone_source, zone_target, database_set, instance, table, selected_schema_keys=selected_schema_keys)
+
+  elif diff_mode != 'full':
+    raise ComparisonException('Unknown diff mode: %s  Valid Options: %s' % (diff_mode, DIFF_MODES))
+
+  # Difference between source and target data
+  diff = NewTableDiff(zone_source, zone_target, database_set, instance, table, selected_schema_keys=selected_schema_keys)
+
+  # Get the Query Module, needed for exception handling
+  #TODO(g): Make this easier, so all the work doesnt have to be done every time?  This loads data and stuff...
+  (query_module, _, _, _, _, _, zone_data) = GetZoneConnectionInfo(zone_source, database_set, instance)
+
+  if SkipTableCheck(table, zone_data):
+    return diff
+
+  # Rows are tuples in each zone's field order, keyed on their row key.  Missing tables have no rows.
+  source_sql = 'SELECT %s FROM %s' % (diff.source_codec.sql_fields, table)
   source_rows_keyed = {}
-  for row in source_rows:
-    key = GetRowPrimaryKeyTuple(table_schema, row)
-    source_rows_keyed[key] = row
+  GetSourceKey = diff.GetSourceKey
+  for row in _QueryStreamIfTableExists(zone_source, database_set, instance, source_sql, query_module, tuples=True):
+    source_rows_keyed[GetSourceKey(row)] = row
 
-  # Build dictionary for target based on primary keys
+  target_sql = 'SELECT %s FROM %s' % (diff.target_codec.sql_fields, table)
   target_rows_keyed = {}
-  for row in target_rows:
-    key = GetRowPrimaryKeyTuple(table_schema, row)
-    target_rows_keyed[key] = row
+  GetTargetKey = diff.GetTargetKey
+  for row in _QueryStreamIfTableExists(zone_target, database_set, instance, target_sql, query_module, tuples=True):
+    target_rows_keyed[GetTargetKey(row)] = row
 
-  # Get all the different SQL statements: INSERT, UPDATE, DELETE
-  diff_sql_statements = []
+  table_schema_source = diff.table_schema_source
 
   # Compare source rows with target rows to find INSERT and UPDATE requirements
   for (row_key, row) in source_rows_keyed.items():
+    target_row = target_rows_keyed.get(row_key)
+
     # If the key isnt found in target, INSERT this row
-    if row_key not in target_rows_keyed:
-      primary_key = GeneratePrimaryKeyId(table_schema_source, row)
-      select_key = GenerateDataKey('insert', zone_source, zone_target, database_set, instance, table, primary_key)
-      if selected_schema_keys == None or select_key in selected_schema_keys:
-        diff['insert'].append(row)
-      else:
-        print('Select key not found: %s - %s' % (select_key, selected_schema_keys))
+    if target_row == None:
+      if IsDataKeySelected('insert', zone_source, zone_target, database_set, instance, table, table_schema_source, row, selected_schema_keys,
+                           codec=diff.source_codec):
+        diff.insert.append(row)
+
     # Else, if the source row data is different than the target row data, UPDATE this row
-    elif row != target_rows_keyed[row_key]:
+    elif not diff.IsSameRow(row, target_row):
       #NOTE(g): This is just to find differences, the selection process has not yet occurred, so it's
       #   OK to store updates that will not be applied because the Target table does not have the field
       #   that the Source table has, so the SQL will not be generated
-      primary_key = GeneratePrimaryKeyId(table_schema_source, row)
-      select_key = GenerateDataKey('update', zone_source, zone_target, database_set, instance, table, primary_key)
-      if selected_schema_keys == None or select_key in selected_schema_keys:
-        diff['update'].append((row, target_rows_keyed[row_key]))
+      if IsDataKeySelected('update', zone_source, zone_target, database_set, instance, table, table_schema_source, row, selected_schema_keys,
+                           codec=diff.source_codec):
+        diff.update.append((row, target_row))
+
+  # Compare target rows with source rows to find DELETE requirements
+  for (row_key, row) in target_rows_keyed.items():
+    # If the key isnt found in source, DELETE this row
+    if row_key not in source_rows_keyed:
+      if IsDataKeySelected('delete', zone_source, zone_target, database_set, instance, table, table_schema_source, row, selected_schema_keys,
+                           codec=diff.target_codec):
+        diff.delete.append(row)
+
+  return diff
+
+
+def IterTableRowDiff(zone_source, zone_target, database_set, instance, table, selected_schema_keys=None):
+  """Yields the row differences between the source and target table, as (operation, data) tuples.
+
+  operation is 'insert'/'update'/'delete', classified the same as GetSql_TableRowDiff().  data is the
+  tuple row, or (source_row, target_row) for 'update', in the field orders of a TableDiff.
+
+  Both tables are read ordered by primary key through unbuffered cursors and merge-joined, so only
+  the current row from each zone is held in memory.  Tables without a primary key are ordered and
+  matched on all their fields.
+  """
+  # Tables are filtered on the source's lists.  Snapshots were filtered when they were written, so a live target's are used.
+  for zone in (zone_source, zone_target):
+    if not IsSnapshotZone(zone):
+      (_, _, _, _, _, _, zone_data) = GetZoneConnectionInfo(zone, database_set, instance)
+
+      if SkipTableCheck(table, zone_data):
+        return
+      break
+
+  # Get the schemas for the tables, each time so that they can be matches together
+  table_diff = NewTableDiff(zone_source, zone_target, database_set, instance, table, selected_schema_keys=selected_schema_keys)
+
+  # Both sides are sorted on the fields the rows are matched on, or the merge-join finds rows missing that arent
+  source_rows = IterTableRows(zone_source, database_set, instance, table, table_diff.table_schema_source, order_fields=table_diff.key_fields)
+  target_rows = IterTableRows(zone_target, database_set, instance, table, table_diff.table_schema_target, order_fields=table_diff.key_fields)
+
+  for item in MergeRowDiff(zone_source, zone_target, database_set, instance, table, table_diff, source_rows, target_rows, selected_schema_keys=selected_schema_keys):
+    yield item
+
+
+def MergeRowDiff(zone_source, zone_target, database_set, instance, table, table_diff, source_rows, target_rows, selected_schema_keys=None):
+  """Yields (operation, data) row differences, merge-joining two tuple row iterators sorted by their row keys.
+
+  table_diff has the field orders of the rows, and how to match them.  Rows are not added to it.
+  """
+  GetSourceKey = table_diff.GetSourceKey
+  GetTargetKey = table_diff.GetTargetKey
+  table_schema_source = table_diff.table_schema_source
+
+  source_row = next(source_rows, None)
+  target_row = next(target_rows, None)
+
+  # Merge-join: Advance whichever side has the lower key, or both if the keys match
+  while source_row != None or target_row != None:
+    if target_row == None:
+      operation = 'insert'
+    elif source_row == None:
+      operation = 'delete'
+    else:
+      source_key = GetSortKey(GetSourceKey(source_row))
+      target_key = GetSortKey(GetTargetKey(target_row))
+
+      if source_key < target_key:
+        operation = 'insert'
+      elif target_key < source_key:
+        operation = 'delete'
+      elif not table_diff.IsSameRow(source_row, target_row):
+        operation = 'update'
       else:
-        print('Select key not found: %s - %s' % (select_key, selected_schema_keys))
+        operation = None
+
+    if operation == 'insert':
+      if IsDataKeySelected(operation, zone_source, zone_target, database_set, instance, table, table_schema_source, source_row, selected_schema_keys,
+                           codec=table_diff.source_codec):
+        yield (operation, source_row)
+
+      source_row = next(source_rows, None)
+
+    elif operation == 'delete':
+      if IsDataKeySelected(operation, zone_source, zone_target, database_set, instance, table, table_schema_source, target_row, selected_schema_keys,
+                           codec=table_diff.target_codec):
+        yield (operation, target_row)
+
+      target_row = next(target_rows, None)
+
+    else:
+      if operation == 'update' and IsDataKeySelected(operation, zone_source, zone_target, database_set, instance, table, table_schema_source, source_row,
+                                                     selected_schema_keys, codec=table_diff.source_codec):
+        yield (operation, (source_row, target_row))
+
+      source_row = next(source_rows, None)
+      target_row = next(target_rows, None)
+
+
+def GetSql_TableRowDiffChecksum(zone_source, zone_target, database_set, instance, table, selected_schema_keys=None):
+  """Returns the same diff dict as GetSql_TableRowDiff(), fetching only rows whose checksums differ.
+
+  The table is split into CHECKSUM_CHUNK_COUNT ranges of its first primary key field, and each range
+  gets a COUNT(*) and BIT_XOR(GetRowChecksumSql()) of its rows computed on both servers.  Ranges that dont match
+  are bisected until they have CHECKSUM_LEAF_ROWS rows or less, and then only those rows are fetched.
+
+  Tables that cant be checksummed this way (no integer primary key, or different fields in the
+  source and target) are diffed with the stream mode.
+  """
+  diff = NewTableDiff(zone_source, zone_target, database_set, instance, table, selected_schema_keys=selected_schema_keys)
+
+  (query_module, _, _, _, _, _, zone_data) = GetZoneConnectionInfo(zone_source, database_set, instance)
+
+  if SkipTableCheck(table, zone_data):
+    return diff
+
+  schema_source = GetSchema(zone_source, database_set, instance)
+  schema_target = GetSchema(zone_target, database_set, instance)
+
+  if table not in schema_source or table not in schema_target or not IsChecksumComparable(schema_source[table], schema_target[table]):
+    return GetSql_TableRowDiff(zone_source, zone_target, database_set, instance, table, selected_schema_keys=selected_schema_keys, diff_mode='stream')
+
+  table_schema_source = schema_source[table]
+  key_field = table_schema_source['__PRIMARY_KEYS__'][0]
+
+  # Get the full key range, across both zones
+  sql = 'SELECT MIN(`%s`) AS min_key, MAX(`%s`) AS max_key FROM %s' % (key_field, key_field, table)
+  source_range = Query(zone_source, database_set, instance, sql)[0]
+  target_range = Query(zone_target, database_set, instance, sql)[0]
+
+  min_keys = [int(key) for key in (source_range['min_key'], target_range['min_key']) if key != None]
+  max_keys = [int(key) for key in (source_range['max_key'], target_range['max_key']) if key != None]
+
+  # Both tables are empty
+  if not min_keys:
+    return diff
+
+  start = min(min_keys)
+  end = max(max_keys) + 1
+  span = max(1, -(-(end - start) // CHECKSUM_CHUNK_COUNT))
+
+  _DiffChecksumRange(zone_source, zone_target, database_set, instance, table, table_schema_source, start, end, span, diff, selected_schema_keys)
+
+  return diff
+
+
+def _DiffChecksumRange(zone_source, zone_target, database_set, instance, table, table_schema_source, start, end, span, diff, selected_schema_keys):
+  """Checksum [start, end) in chunks of span keys, and add the rows of mismatched chunks to diff, bisecting large chunks."""
+  source_chunks = GetChunkChecksums(zone_source, database_set, instance, table, table_schema_source, start, end, span)
+  target_chunks = GetChunkChecksums(zone_target, database_set, instance, table, table_schema_source, start, end, span)
+
+  chunks = list(set(source_chunks.keys()) | set(target_chunks.keys()))
+  chunks.sort()
+
+  for chunk in chunks:
+    # Same row count and checksum, skip these rows entirely
+    if source_chunks.get(chunk) == target_chunks.get(chunk):
+      continue
+
+    chunk_start = start + chunk * span
+    chunk_end = min(chunk_start + span, end)
+    row_count = max(source_chunks.get(chunk, (0, None))[0], target_chunks.get(chunk, (0, None))[0])
+
+    # Small enough, fetch the rows from both sides and diff them
+    if row_count <= CHECKSUM_LEAF_ROWS or span == 1:
+      key_field = table_schema_source['__PRIMARY_KEYS__'][0]
+      sql = 'SELECT * FROM %s WHERE `%s` >= %d AND `%s` < %d ORDER BY %s' % (table, key_field, chunk_start, key_field, chunk_end,
+                                                                          GetRowKeyOrderSql(table_schema_source))
+      source_rows = [diff.source_codec.ToTuple(row) for row in Query(zone_source, database_set, instance, sql)]
+      target_rows = [diff.target_codec.ToTuple(row) for row in Query(zone_target, database_set, instance, sql)]
+
+      for (operation, data) in MergeRowDiff(zone_source, zone_target, database_set, instance, table, diff,
+                                            iter(source_rows), iter(target_rows), selected_schema_keys=selected_schema_keys):
+        getattr(diff, operation).append(data)
+
+    # Else, bisect this chunk and checksum the halves
+    else:
+      _DiffChecksumRange(zone_source, zone_target, database_set, instance, table, table_schema_source, chunk_start, chunk_end,
+                         -(-span // 2), diff, selected_schema_keys)
+
+
+def GetChunkChecksums(zone, database_set, instance, table, table_schema, start, end, span):
+  """Returns dict keyed on chunk number, of (row_count, checksum) for every span keys in [start, end).  Empty chunks are not returned."""
+  key_field = table_schema['__PRIMARY_KEYS__'][0]
+
+  sql = 'SELECT FLOOR((`%s` - %d) / %d) AS chunk, COUNT(*) AS row_count, BIT_XOR(%s) AS checksum FROM %s ' \
+        'WHERE `%s` >= %d AND `%s` < %d GROUP BY chunk' % (key_field, start, span, GetRowChecksumSql(table_schema), table,
+                                                         key_field, start, key_field, end)
+  result = Query(zone, database_set, instance, sql)
+
+  chunks = {}
+  for item in result:
+    chunks[int(item['chunk'])] = (int(item['row_count']), int(item['checksum']))
+
+  return chunks
+
+
+def GetRowChecksumSql(table_schema):
+  """Returns string, SQL expression for a 64 bit checksum of all the fields in a row.  NULL and empty strings checksum differently.
+
+  Rows are BIT_XOR'd together, so the checksum is the first 16 hex digits of an MD5, not a CRC32.  CRC32 is linear
+  under XOR: changing a field the same way in 2 rows of the same length changes both CRC32s by the same bits, and
+  they cancel, so the changed rows checksum the same as before.
+  """
+  return 'CAST(CONV(LEFT(MD5(%s), 16), 16, 10) AS UNSIGNED)' % GetRowConcatSql(table_schema)
+
+
+def GetRowDigestSql(table_schema):
+  """Returns string, SQL expression for the 16 byte MD5 digest of all the fields in a row"""
+  return 'UNHEX(MD5(%s))' % GetRowConcatSql(table_schema)
+
+
+def GetRowConcatSql(table_schema):
+  """Returns string, SQL expression joining all the fields of a row, and which of them are NULL, in table order.
+
+  Each field is prefixed with its length, so a separator in a value cant make different rows join the same:
+  ('a#', 'b') and ('a', '#b') would both be 'a##b' without it.
+  """
+  fields = []
+  null_flags = []
+  for field in table_schema['__FIELD_ORDER__']:
+    fields.append('LENGTH(`%s`)' % field)
+    fields.append('`%s`' % field)
+    null_flags.append('ISNULL(`%s`)' % field)
+
+  sql = "CONCAT_WS('#', %s)" % ', '.join(fields + null_flags)
+
+  return sql
+
+
+def IsChecksumComparable(table_schema_source, table_schema_target):
+  """Returns boolean, True if the tables have the same fields and an integer first primary key, so server checksums can be compared."""
+  if not table_schema_source['__PRIMARY_KEYS__'] or table_schema_source['__PRIMARY_KEYS__'] != table_schema_target['__PRIMARY_KEYS__']:
+    return False
+
+  key_field = table_schema_source['__PRIMARY_KEYS__'][0]
+  if GetFieldBaseType(table_schema_source[key_field]) not in INTEGER_TYPES:
+    return False
+
+  return IsSameFields(table_schema_source, table_schema_target)
+
+
+def GetSql_TableRowDiffDigest(zone_source, zone_target, database_set, instance, table, selected_schema_keys=None):
+  """Returns the same TableDiff as GetSql_TableRowDiff(), holding only a digest of each row in memory.
+
+  Both zones compute an MD5 of every row, which is streamed with the row's primary key.  The source's
+  digests are kept in a RowDigestMap, and the target's are checked against them as they arrive, so
+  only the keys of the rows that differ are kept.  Then only those rows are fetched from both zones,
+  DIGEST_FETCH_ROWS at a time, and diffed.
+
+  Tables that cant be digested this way (no primary key, or different fields in the source and
+  target) are diffed with the stream mode.
+  """
+  diff = NewTableDiff(zone_source, zone_target, database_set, instance, table, selected_schema_keys=selected_schema_keys)
+
+  (query_module, _, _, _, _, _, zone_data) = GetZoneConnectionInfo(zone_source, database_set, instance)
+
+  if SkipTableCheck(table, zone_data):
+    return diff
+
+  schema_source = GetSchema(zone_source, database_set, instance)
+  schema_target = GetSchema(zone_target, database_set, instance)
+
+  if table not in schema_source or table not in schema_target or not IsDigestComparable(schema_source[table], schema_target[table]):
+    return GetSql_TableRowDiff(zone_source, zone_target, database_set, instance, table, selected_schema_keys=selected_schema_keys, diff_mode='stream')
+
+  source_digests = GetRowDigests(zone_source, database_set, instance, table, schema_source[table], query_module)
+
+  changed_keys = GetChangedDigestKeys(zone_target, database_set, instance, table, schema_source[table], source_digests, query_module)
+
+  # Free the digests before fetching rows
+  source_digests = None
+
+  AddDigestDiffRows(zone_source, zone_target, database_set, instance, table, diff, changed_keys, query_module, selected_schema_keys)
+
+  return diff
+
+
+def GetSql_TableRowDiffMulti(zone_source, zone_targets, database_set, instance, table, selected_schema_keys=None):
+  """Returns dict keyed on target zone, of the TableDiff from the source zone, the same as GetSql_TableRowDiff().
+
+  The source's row digests are read once, and checked against each target's, like the digest mode.
+  Then the changed source rows are fetched once for all the targets, DIGEST_FETCH_ROWS at a time,
+  and each target only fetches its own changed rows.
+
+  Targets whose table cant be digested against the source's are diffed with the stream mode, which
+  reads the source rows again for them.
+  """
+  diffs = {}
+  for zone_target in zone_targets:
+    diffs[zone_target] = NewTableDiff(zone_source, zone_target, database_set, instance, table, selected_schema_keys=selected_schema_keys)
+
+  (query_module, _, _, _, _, _, zone_data) = GetZoneConnectionInfo(zone_source, database_set, instance)
+
+  if SkipTableCheck(table, zone_data):
+    return diffs
+
+  schema_source = GetSchema(zone_source, database_set, instance)
+  if table not in schema_source:
+    digest_targets = []
+  else:
+    table_schema_source = schema_source[table]
+
+    # A missing target table is digested as empty, all the source rows are inserts
+    digest_targets = []
+    for zone_target in zone_targets:
+      schema_target = GetSchema(zone_target, database_set, instance)
+      if table_schema_source['__PRIMARY_KEYS__'] and (table not in schema_target or IsDigestComparable(table_schema_source, schema_target[table])):
+        digest_targets.append(zone_target)
+
+  for zone_target in zone_targets:
+    if zone_target not in digest_targets:
+      diffs[zone_target] = GetSql_TableRowDiff(zone_source, zone_target, database_set, instance, table, selected_schema_keys=selected_schema_keys,
+                                               diff_mode='stream')
+
+  if not digest_targets:
+    return diffs
+
+  source_digests = GetRowDigests(zone_source, database_set, instance, table, table_schema_source, query_module)
+
+  # Set of each target's changed keys, and all of them sorted
+  changed_keys = {}
+  for zone_target in digest_targets:
+    changed_keys[zone_target] = set(GetChangedDigestKeys(zone_target, database_set, instance, table, table_schema_source, source_digests, query_module))
+
+  all_changed_keys = sorted(set().union(*changed_keys.values()), key=GetSortKey)
+
+  # Free the digests before fetching rows
+  source_digests = None
+
+  # The source rows have the same fields for every digested target
+  source_diff = diffs[digest_targets[0]]
+
+  for start in range(0, len(all_changed_keys), DIGEST_FETCH_ROWS):
+    keys = all_changed_keys[start:start + DIGEST_FETCH_ROWS]
+
+    source_rows = _FetchRowsByKey(zone_source, database_set, instance, table, source_diff.source_codec, source_diff.GetSourceKey, keys, query_module)
+
+    for zone_target in digest_targets:
+      target_keys = [key for key in keys if key in changed_keys[zone_target]]
+
+      AddDigestDiffRows(zone_source, zone_target, database_set, instance, table, diffs[zone_target], target_keys, query_module, selected_schema_keys,
+                        source_rows=source_rows)
+
+  return diffs
+
+
+def GetRowDigests(zone, database_set, instance, table, table_schema_source, query_module):
+  """Returns RowDigestMap of the primary keys and row digests of this table in this zone, from its streamed rows"""
+  row_digests = RowDigestMap(GetDigestKeyTypecode(table_schema_source))
+
+  for row in _QueryStreamIfTableExists(zone, database_set, instance, GetRowDigestQuerySql(table, table_schema_source), query_module, tuples=True):
+    row_digests.Add(row[:-1], row[-1])
+
+  row_digests.Finish()
+
+  return row_digests
+
+
+def GetChangedDigestKeys(zone_target, database_set, instance, table, table_schema_source, source_digests, query_module):
+  """Returns list of the primary key tuples of rows that are missing, extra or different in the target, sorted.
+
+  The target's row digests are streamed and checked against the source's RowDigestMap, which isnt changed,
+  so it can be checked against several targets.
+  """
+  changed_keys = []
+
+  # 1 byte per source row, set when the target has its key
+  found = bytearray(len(source_digests))
+
+  for row in _QueryStreamIfTableExists(zone_target, database_set, instance, GetRowDigestQuerySql(table, table_schema_source), query_module,
+                                       tuples=True):
+    key = row[:-1]
+    index = source_digests.GetIndex(key)
+
+    if index == None:
+      changed_keys.append(key)
+    else:
+      found[index] = 1
+      if source_digests.GetDigest(index) != row[-1]:
+        changed_keys.append(key)
+
+  # Source rows the target doesnt have
+  index = found.find(0)
+  while index != -1:
+    changed_keys.append(source_digests.GetKey(index))
+    index = found.find(0, index + 1)
+
+  changed_keys.sort(key=GetSortKey)
+
+  return changed_keys
+
+
+def AddDigestDiffRows(zone_source, zone_target, database_set, instance, table, diff, changed_keys, query_module, selected_schema_keys=None,
+                      source_rows=None):
+  """Fetch the rows of these primary keys from both zones, DIGEST_FETCH_ROWS at a time, and add their differences to diff.
+
+  If source_rows is given, it is a dict of primary key tuple to source tuple row, already fetched for these keys.
+  """
+  table_schema_source = diff.table_schema_source
+
+  for start in range(0, len(changed_keys), DIGEST_FETCH_ROWS):
+    keys = changed_keys[start:start + DIGEST_FETCH_ROWS]
+
+    if source_rows != None:
+      batch_source_rows = source_rows
+    else:
+      batch_source_rows = _FetchRowsByKey(zone_source, database_set, instance, table, diff.source_codec, diff.GetSourceKey, keys, query_module)
+    target_rows = _FetchRowsByKey(zone_target, database_set, instance, table, diff.target_codec, diff.GetTargetKey, keys, query_module)
+
+    for key in keys:
+      source_row = batch_source_rows.get(key)
+      target_row = target_rows.get(key)
+
+      #NOTE(g): Rows can change between the digest and row queries.  They are classified on what is fetched.
+      if target_row == None:
+        if source_row != None and IsDataKeySelected('insert', zone_source, zone_target, database_set, instance, table, table_schema_source, source_row,
+                                                    selected_schema_keys, codec=diff.source_codec):
+          diff.insert.append(source_row)
+
+      elif source_row == None:
+        if IsDataKeySelected('delete', zone_source, zone_target, database_set, instance, table, table_schema_source, target_row, selected_schema_keys,
+                             codec=diff.target_codec):
+          diff.delete.append(target_row)
+
+      elif not diff.IsSameRow(source_row, target_row):
+        if IsDataKeySelected('update', zone_source, zone_target, database_set, instance, table, table_schema_source, source_row, selected_schema_keys,
+                             codec=diff.source_codec):
+          diff.update.append((source_row, target_row))
+
+
+def GetRowDigestQuerySql(table, table_schema_source):
+  """Returns string, SQL selecting the primary key and row digest of every row, in primary key order.
+
+  Every zone digests its rows with the source's field order, so equal rows have equal digests.
+  """
+  primary_keys = table_schema_source['__PRIMARY_KEYS__']
+
+  return 'SELECT %s, %s AS row_digest FROM %s ORDER BY %s' % (', '.join(['`%s`' % field for field in primary_keys]), GetRowDigestSql(table_schema_source),
+                                                              table, GetRowKeyOrderSql(table_schema_source))
+
+
+def _FetchRowsByKey(zone, database_set, instance, table, codec, GetKey, keys, query_module):
+  """Returns dict of primary key tuple to tuple row, for the rows of these primary keys that exist in this zone"""
+  primary_keys = codec.primary_keys
+
+  key_values = []
+  for key in keys:
+    formatted_key = codec.FormatKey(key)
+    if len(formatted_key) == 1:
+      key_values.append(formatted_key[0])
+    else:
+      key_values.append('(%s)' % ', '.join(formatted_key))
+
+  if len(primary_keys) == 1:
+    key_sql = '`%s`' % primary_keys[0]
+  else:
+    key_sql = '(%s)' % ', '.join(['`%s`' % field for field in primary_keys])
+
+  sql = 'SELECT %s FROM %s WHERE %s IN (%s)' % (codec.sql_fields, table, key_sql, ', '.join(key_values))
+
+  rows = {}
+  for row in _QueryStreamIfTableExists(zone, database_set, instance, sql, query_module, tuples=True):
+    rows[GetKey(row)] = row
+
+  return rows
+
+
+class RowDigestMap:
+  """Map of primary key tuple to 16 byte row digest, as compact as the key allows.
+
+  Integer keys are kept in an array of 8 byte ints, and the digests in 1 bytearray, so a row costs
+  24 bytes.  Other keys are kept in a dict and a list, which costs more per row but takes any key.
+
+  Add() all the rows, then Finish(), then look keys up with GetIndex().  Lookups dont change the map,
+  so it can be compared against several zones.
+  """
+  __slots__ = ('keys', 'digests', '_indexes', '_is_sorted')
+
+  def __init__(self, typecode=None):
+    """typecode is the array typecode for single integer keys, or None for any other keys (see GetDigestKeyTypecode())"""
+    self.digests = bytearray()
+
+    if typecode != None:
+      self.keys = array.array(typecode)
+      self._indexes = None
+    else:
+      self.keys = []
+      self._indexes = {}
+
+    self._is_sorted = True
+
+
+  def __len__(self):
+    return len(self.keys)
+
+
+  def Add(self, key, digest):
+    """Add a primary key tuple's digest"""
+    if self._indexes != None:
+      self._indexes[key] = len(self.keys)
+      self.keys.append(key)
+    else:
+      key_value = key[0]
+      if self._is_sorted and self.keys and key_value < self.keys[-1]:
+        self._is_sorted = False
+
+      self.keys.append(key_value)
+
+    self.digests += digest
+
+
+  def Finish(self):
+    """Done adding.  Sorts the integer keys, if they werent added in order, so they can be binary searched."""
+    if self._indexes == None and not self._is_sorted:
+      #NOTE(g): Keys are streamed in primary key order, so this only happens if the server orders them differently
+      order = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+
+      keys = array.array(self.keys.typecode, [self.keys[index] for index in order])
+      digests = bytearray()
+      for index in order:
+        digests += self.digests[index * 16:index * 16 + 16]
+
+      (self.keys, self.digests) = (keys, digests)
+      self._is_sorted = True
+
+
+  def GetIndex(self, key):
+    """Returns int, the index of this primary key tuple, or None if it isnt in the map"""
+    if self._indexes != None:
+      return self._indexes.get(key)
+
+    key_value = key[0]
+    index = bisect.bisect_left(self.keys, key_value)
+    if index == len(self.keys) or self.keys[index] != key_value:
+      return None
+
+    return index
+
+
+  def GetDigest(self, index):
+    """Returns bytes, the digest at this index"""
+    return bytes(self.digests[index * 16:index * 16 + 16])
+
+
+  def GetKey(self, index):
+    """Returns tuple, the primary key at this index"""
+    if self._indexes != None:
+      return self.keys[index]
+
+    return (self.keys[index],)
+
+
+def GetDigestKeyTypecode(table_schema):
+  """Returns string, the array typecode a RowDigestMap can keep this table's primary keys in, or None if they arent a single integer"""
+  primary_keys = table_schema['__PRIMARY_KEYS__']
+  if len(primary_keys) != 1:
+    return None
+
+  field_info = table_schema[primary_keys[0]]
+  if GetFieldBaseType(field_info) not in INTEGER_TYPES:
+    return None
+
+  # Unsigned bigints dont fit in a signed 8 byte int
+  if 'unsigned' in field_info['Type'].lower():
+    return 'Q'
+  else:
+    return 'q'
+
+
+def IsDigestComparable(table_schema_source, table_schema_target):
+  """Returns boolean, True if the tables have the same primary key and fields, so server row digests can be compared."""
+  if not table_schema_source['__PRIMARY_KEYS__'] or table_schema_source['__PRIMARY_KEYS__'] != table_schema_target['__PRIMARY_KEYS__']:
+    return False
+
+  return IsSameFields(table_schema_source, table_schema_target)
+
+
+def IsSameFields(table_schema_source, table_schema_target):
+  """Returns boolean, True if both tables have the same fields and types.
+
+  Different fields or types make rows different in a full diff, but not in server checksums, so
+  checksums can only be compared when this is True.
+  """
+  if set(table_schema_source['__FIELD_ORDER__']) != set(table_schema_target['__FIELD_ORDER__']):
+    return False
+
+  for field in table_schema_source['__FIELD_ORDER__']:
+    if table_schema_source[field]['Type'] != table_schema_target[field]['Type']:
+      return False
+
+  return True
+
+
+def _QueryStreamIfTableExists(zone, database_set, instance, sql, query_module, tuples=False):
+  """Yields the QueryStream() rows, or nothing if the table doesnt exist in this zone."""
+  try:
+    for row in QueryStream(zone, database_set, instance, sql, tuples=tuples):
+      yield row
+
+  except query_module.QueryFailure as e:
+    # If we failed because the table doesnt exist (MySQL error code)
+    if e.code != 1146:
+      raise e
+
+
+def IsDataKeySelected(operation, zone_source, zone_target, database_set, instance, table, table_schema_source, row, selected_schema_keys, codec=None):
+  """Returns boolean, True if this row change is selected.  All changes are selected if selected_schema_keys is None.
+
+  If codec is given, row is a tuple row in its field order.
+  """
+  if selected_schema_keys == None:
+    return True
+
+  if codec != None:
+    row = codec.ToDict(row)
+
+  primary_key = GeneratePrimaryKeyId(table_schema_source, row)
+  select_key = GenerateDataKey(operation, zone_source, zone_target, database_set, instance, table, primary_key)
+  if select_key in selected_schema_keys:
+    return True
+
+  print('Select key not found: %s - %s' % (select_key, selected_schema_keys))
+  return False
+
+
+def GetRowKeyFields(table_schema):
+  """Returns list of fields that identify a row: the primary keys, or all fields if there is no primary key"""
+  if table_schema['__PRIMARY_KEYS__']:
+    return table_schema['__PRIMARY_KEYS__']
+
+  return table_schema['__FIELD_ORDER__']
+
+
+def GetRowKeyOrderSql(table_schema):
+  """Returns string, the ORDER BY fields that sort rows by their row key the same as GetSortKey()"""
+  return GetFieldsOrderSql(table_schema, GetRowKeyFields(table_schema))
 
-  # Compare target rows with source rows to find DELETE requirements
-  for (row_key, row) in target_rows_keyed.items():
-    # If the key isnt found in source, DELETE this row
-    if row_key not in source_rows_keyed:
-      primary_key = GeneratePrimaryKeyId(table_schema_source, row)
-      select_key = GenerateDataKey('insert', zone_source, zone_target, database_set, instance, table, primary_key)
-      if selected_schema_keys == None or select_key in selected_schema_keys:
-        diff['delete'].append(target_rows_keyed[row_key])
-      else:
-        print('Select key not found: %s - %s' % (select_key, selected_schema_keys))
 
-  return diff
+def GetFieldsOrderSql(table_schema, fields):
+  """Returns string, the ORDER BY fields that sort rows by these fields the same as GetSortKey()"""
+  order_fields = []
+
+  for field in fields:
+    if GetFieldBaseType(table_schema[field]) in COLLATED_TYPES:
+      order_fields.append('BINARY `%s`' % field)
+    else:
+      order_fields.append('`%s`' % field)
+
+  return ', '.join(order_fields)
+
+
+def GetFieldBaseType(field_info):
+  """Returns string, the lower case type name of the field, without size or attributes: 'int(10) unsigned' -> 'int'"""
+  return table_codec.GetBaseType(field_info['Type'])
+
+
+def GetSortKey(row_key):
+  """Returns tuple, comparable sort key for a tuple of row key values.  NULL sorts first, like MySQL does."""
+  return tuple([(value != None, value) for value in row_key])
 
 
 def GetTableSchema(zone_source, zone_target, database_set, instance, table, selected_schema_keys=None):
@@ -610,50 +2481,875 @@ def GetTableSchema(zone_source, zone_target, database_set, instance, table, sele
   return (table_schema_source, table_schema_target)
 
 
-def CreateSQLFromDataDiff(zone_source, zone_target, database_set, instance, diff, selected_schema_keys=None):
-  """Returns a forward and reverse list of SQL statements (strings)"""
-  diff_sql_statements = []
+def ReverseDataDiff(diff):
+  """Returns the diff from target to source, from a source to target diff, without reading any rows again.
+
+  Inserts and deletes swap, and update pairs are flipped.  The rows are shared, not copied.
+  """
+  reverse_diff = {}
 
   for (table, table_diff) in diff.items():
-    # Get the schemas for the tables, each time so that they can be matches together
-    (table_schema_source, table_schema_target) = GetTableSchema(zone_source, zone_target, database_set, instance, table, selected_schema_keys=selected_schema_keys)
+    reverse_diff[table] = table_diff.Reverse()
+
+  return reverse_diff
+
+
+def CreateSQLFromDataDiff(zone_source, zone_target, database_set, instance, diff, selected_schema_keys=None, reverse=False):
+  """Returns list of SQL commands to make the target data the same as the source.
+
+  If reverse is True, the commands undo that instead, returning the target to its current data.
+  Use CreateSQLFromDataDiffPaired() to get both, without building the statements twice.
+  """
+  (forward_commands, reverse_commands) = CreateSQLFromDataDiffPaired(zone_source, zone_target, database_set, instance, diff,
+                                                                     selected_schema_keys=selected_schema_keys)
+
+  if reverse:
+    return reverse_commands
+  else:
+    return forward_commands
+
+
+def CreateSQLFromDataDiffPaired(zone_source, zone_target, database_set, instance, diff, selected_schema_keys=None, batch_changes=True, spool=True):
+  """Returns (forward_commands, reverse_commands), SQL to make the target data the same as the source, and to undo it.
+
+  Commands are paired like GenerateSchemaSyncCommands(): reverse_commands[N] undoes forward_commands[N].
+  Inserted rows are batched into multi-row INSERTs, sized to the target's max_allowed_packet, and the
+  command pairing them deletes the same rows.
+
+  If batch_changes is True, deleted rows are batched into DELETE ... WHERE (primary keys) IN (...), and
+  updated rows into upserts (INSERT ... ON DUPLICATE KEY UPDATE) of the rows that changed the same
+  fields, which only SET those fields.  Otherwise there is 1 DELETE or UPDATE statement per row.
+
+  Tables with more than bulk_load_fraction of their rows different are reloaded with LOAD DATA from a
+  spool of the source rows, and reversed by reloading a spool of the target rows.  If spool is False, as
+  when the commands are only shown, they get row statements instead, so no spool files are written.
+
+  Tables that dont exist in the target are skipped, GenerateSchemaSyncCommands() creates and loads them.
+
+  Forward and reverse SQL are made from the same diff, so the zones only need to be read once.
+  """
+  forward_commands = []
+  reverse_commands = []
+
+  max_bytes = GetStatementByteBudget(zone_target, database_set, instance)
+  schema_target = GetSchema(zone_target, database_set, instance)
+
+  for (table, table_diff) in diff.items():
+    if table not in schema_target:
+      continue
+
+    # The schemas the diff's rows are in
+    table_schema_source = table_diff.table_schema_source
+    table_schema_target = table_diff.table_schema_target
+
+    # So much is different, replace all the rows
+    if spool and IsBulkReload(zone_source, zone_target, database_set, instance, table, table_diff, table_schema_source, table_schema_target,
+                              selected_schema_keys):
+      forward_commands.append(['TRUNCATE TABLE %s' % table] + GetSql_BulkLoadTable(zone_source, database_set, instance, table, table_schema_source))
+      reverse_commands.append(['TRUNCATE TABLE %s' % table] + GetSql_BulkLoadTable(zone_target, database_set, instance, table, table_schema_target))
+      continue
     
-    for row in table_diff['insert']:
-      diff_sql_statements.append(CreateInsert(table_schema_source, table_schema_target, table, row))
+    if batch_changes:
+      # Only checked when there are updates, it can need the CREATE TABLE
+      upsert = bool(table_diff.update) and IsUpsertSafe(zone_target, database_set, instance, table, table_schema_target)
+
+      (table_forward, table_reverse) = CreateSQLBatchesFromTableDiff(table_schema_source, table_schema_target, table, table_diff, max_bytes,
+                                                                     upsert=upsert)
+      forward_commands += table_forward
+      reverse_commands += table_reverse
+      continue
+
+    source_codec = table_diff.source_codec
+    target_codec = table_diff.target_codec
+
+    for (insert_sql, batch_rows) in IterInsertBatches(table_schema_source, table_schema_target, table, table_diff.insert, max_bytes):
+      forward_commands.append(insert_sql)
+      reverse_commands.append([CreateDelete(table_schema_source, table_schema_target, table, source_codec.ToDict(row)) for row in batch_rows])
     
-    for row in table_diff['delete']:
-      diff_sql_statements.append(CreateDelete(table_schema_source, table_schema_target, table, row))
+    # Deleted rows are target rows
+    for (insert_sql, batch_rows) in IterInsertBatches(table_schema_target, table_schema_source, table, table_diff.delete, max_bytes):
+      forward_commands.append([CreateDelete(table_schema_target, table_schema_source, table, target_codec.ToDict(row)) for row in batch_rows])
+      reverse_commands.append(insert_sql)
     
-    for (source_row, target_row) in table_diff['update']:
+    for (source_row, target_row) in table_diff.update:
+      (source_row, target_row) = (source_codec.ToDict(source_row), target_codec.ToDict(target_row))
       update_result = CreateUpdate(table_schema_source, table_schema_target, table, source_row, target_row)
       # Only append the UPDATE result if it is not None, because Target fields may not exist, 
       #     so no SETs can be performed
       if update_result != None:
-        diff_sql_statements.append(update_result)
+        forward_commands.append(update_result)
+        reverse_commands.append(CreateUpdate(table_schema_source, table_schema_target, table, target_row, source_row))
+
+  return (forward_commands, reverse_commands)
+
+
+def CreateSQLBatchesFromTableDiff(table_schema_source, table_schema_target, table, table_diff, max_bytes, upsert=True):
+  """Returns (forward_commands, reverse_commands), paired, with set-based statements for a table diff.
+
+  Inserts are multi-row INSERTs, deletes are DELETE ... IN (...), and updates are upserts grouped by
+  the fields they change.  Each is undone by the opposite batch for the same rows.  If upsert is False,
+  since the table has other unique keys or no primary key (see IsUpsertSafe()), updates are 1 UPDATE per row.
+
+  table_diff is a TableDiff, whose source and target rows are in the field orders of these schemas.
+  """
+  forward_commands = []
+  reverse_commands = []
+
+  for (insert_sql, batch_rows) in IterInsertBatches(table_schema_source, table_schema_target, table, table_diff.insert, max_bytes):
+    forward_commands.append(insert_sql)
+    reverse_commands.append(_GetCommand([sql for (sql, rows) in IterDeleteBatches(table_schema_source, table_schema_target, table, batch_rows, max_bytes)]))
+
+  # Deleted rows are target rows
+  for (delete_sql, batch_rows) in IterDeleteBatches(table_schema_target, table_schema_source, table, table_diff.delete, max_bytes):
+    forward_commands.append(delete_sql)
+    reverse_commands.append(_GetCommand([sql for (sql, rows) in IterInsertBatches(table_schema_target, table_schema_source, table, batch_rows, max_bytes)]))
+
+  if not upsert:
+    for (source_row, target_row) in table_diff.update:
+      (source_row, target_row) = (table_diff.source_codec.ToDict(source_row), table_diff.target_codec.ToDict(target_row))
+
+      # Target fields may not exist, so no SETs can be performed
+      update_sql = CreateUpdate(table_schema_source, table_schema_target, table, source_row, target_row)
+      if update_sql != None:
+        forward_commands.append(update_sql)
+        reverse_commands.append(CreateUpdate(table_schema_source, table_schema_target, table, target_row, source_row))
+
+    return (forward_commands, reverse_commands)
+
+  # Group the updated rows by the fields they change, so each group is upserted together
+  update_groups = {}
+  for (source_row, target_row) in table_diff.update:
+    changed_fields = table_diff.GetChangedFields(source_row, target_row)
+
+    # Target fields may not exist, so no SETs can be performed
+    if changed_fields:
+      update_groups.setdefault(changed_fields, []).append((source_row, target_row))
+
+  for (changed_fields, row_pairs) in update_groups.items():
+    source_rows = [source_row for (source_row, target_row) in row_pairs]
+
+    # Batches are in order, so this is where the current batch starts in row_pairs
+    offset = 0
 
-  return diff_sql_statements
+    for (upsert_sql, batch_rows) in IterInsertBatches(table_schema_source, table_schema_target, table, source_rows, max_bytes, update_fields=changed_fields):
+      target_rows = [target_row for (source_row, target_row) in row_pairs[offset:offset + len(batch_rows)]]
+      offset += len(batch_rows)
 
+      forward_commands.append(upsert_sql)
 
-def SyncTargetZone(zone, database_set, instance, sync_commands, depth=0):
+      # Upsert the target rows back, setting the same fields
+      reverse_commands.append(_GetCommand([sql for (sql, rows) in IterInsertBatches(table_schema_target, table_schema_source, table, target_rows, max_bytes,
+                                                                                   update_fields=changed_fields)]))
+
+  return (forward_commands, reverse_commands)
+
+
+def _GetCommand(statements):
+  """Returns a single statement as itself, or a list of statements, to run as 1 command"""
+  if len(statements) == 1:
+    return statements[0]
+  else:
+    return statements
+
+
+def SyncTargetZone(zone, database_set, instance, sync_commands, transaction_size=None, journal_path=None, start=None, progress=None, workers=1,
+                   replay=None):
   """Processes all the commands(queries) to sync the zones using sync_commands SQL.
 
-  sync_commands is a list of strings (SQL) and lists of strings (SQL).  When a 
-  list item is encountered SyncZones calls itself recursively.  Depth should not be
-  a problem as lists are only embedded one deep and not recursively embedded.
+  sync_commands is a list of strings (SQL) and lists of strings (SQL), applied in order.  Statements
+  are run on 1 held connection to the target, in transactions of transaction_size statements (default
+  is the zone's apply_transaction_size).  DDL is run on its own, since MySQL commits it anyway.
+
+  A failed transaction is rolled back and its QueryFailure raised, so the target is left as it was
+  after the last committed batch, not half way through one.
+
+  If workers is more than 1, commands for tables that arent connected by foreign keys are applied in
+  parallel, see SyncTargetZoneParallel().
+
+  If the zone has a throttle in conf/zones.yaml, batches wait for its hosts' replication lag and load
+  to be under its limits, and get smaller while they arent, see ApplyThrottle.
+
+  If journal_path is given, what has been committed is recorded in that apply_journal after each batch.
+  start is the (command index, statement index) to resume from, statements before it are skipped, and
+  progress is a dict of command index to the number of its statements already applied, also skipped.
+  replay is a list of (command index, statement index) of statements that may already be committed, from the
+  journal's begin lines, and the batches with any of them are replays (see GetApplyBatches()).
+
+  Returns dict of totals: batches, statements, bytes, seconds, throttled_seconds
+  """
+  log('Sync Target Zone: %s %s %s' % (zone, database_set, instance))
+
+  if transaction_size == None:
+    transaction_size = ZONES[zone][database_set].get('apply_transaction_size', DEFAULT_APPLY_TRANSACTION_SIZE)
+  transaction_size = int(transaction_size)
+
+  throttle = GetApplyThrottle(zone, database_set, instance, transaction_size)
+
+  if workers > 1:
+    totals = SyncTargetZoneParallel(zone, database_set, instance, sync_commands, transaction_size, journal_path, start, progress, workers,
+                                    throttle=throttle, replay=replay)
+
+  else:
+    batches = GetApplyBatches(sync_commands, transaction_size, start=start, progress=progress, replay_positions=replay)
+    totals = _NewApplyTotals(len(batches))
+
+    _ApplyBatches(zone, database_set, instance, batches, totals, journal_path, throttle=throttle)
+
+  if throttle != None:
+    totals['throttled_seconds'] = throttle.waited_seconds
+  else:
+    totals['throttled_seconds'] = 0.0
+
+  log('Sync complete: %s statements in %s batches, %.2f seconds, %.2f seconds throttled' % (totals['statements'], totals['batches'],
+      totals['seconds'], totals['throttled_seconds']))
+
+  del totals['batch_count']
+  del totals['lock']
+  return totals
+
+
+def SyncTargetZoneParallel(zone, database_set, instance, sync_commands, transaction_size, journal_path, start, progress, workers, throttle=None,
+                           replay=None):
+  """Apply sync_commands with up to workers connections, for SyncTargetZone().  Returns the totals dict.
+
+  Commands with DDL, or that dont touch exactly 1 table, are applied first, serially, in their order.
+  Then the rest are grouped by table into lanes of tables connected by foreign keys (GetApplyLanes()),
+  read from the zone after that DDL, and the lanes are applied in parallel, limited by the zone's max_connections.  If a lane fails, the others
+  stop after their current batch, and the failure is raised.  All the lanes share the throttle, if any.
+  """
+  (serial_indexes, table_indexes) = SplitApplyCommands(sync_commands)
+
+  serial_batches = GetApplyBatches(sync_commands, transaction_size, start=start, progress=progress, command_indexes=serial_indexes,
+                                   replay_positions=replay)
+
+  totals = _NewApplyTotals(len(serial_batches))
+
+  #NOTE(g): In parallel, commands finish out of order, so the journal records the progress of each command, and
+  #   the batches each lane begins, since every lane can die with a batch committed but not recorded
+  _ApplyBatches(zone, database_set, instance, serial_batches, totals, journal_path, journal_progress=True, throttle=throttle)
+
+  # The lanes need the foreign keys the tables have after the DDL, so they are found once it is applied
+  lane_batches = []
+  for lane in GetApplyLanes(zone, database_set, instance, sync_commands, table_indexes):
+    batches = GetApplyBatches(sync_commands, transaction_size, start=start, progress=progress, command_indexes=lane,
+                              replay_positions=replay)
+    if batches:
+      lane_batches.append(batches)
+
+  with totals['lock']:
+    totals['batch_count'] += sum([len(batches) for batches in lane_batches])
+
+  if not lane_batches:
+    return totals
+
+  max_connections = int(ZONES[zone][database_set].get('max_connections', DEFAULT_MAX_CONNECTIONS))
+  log('Applying %s independent table lanes, %s at a time' % (len(lane_batches), min(workers, max_connections)))
+
+  stop_event = threading.Event()
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, max_connections)) as executor:
+    futures = []
+    for batches in lane_batches:
+      futures.append(executor.submit(_ApplyLane, zone, database_set, instance, batches, totals, journal_path, stop_event, throttle))
+
+    # Wait for all the lanes, so none are still running when the first failure is raised
+    concurrent.futures.wait(futures)
+
+  for future in futures:
+    future.result()
+
+  return totals
+
+
+def _ApplyLane(zone, database_set, instance, batches, totals, journal_path, stop_event, throttle):
+  """Apply 1 lane of batches for SyncTargetZoneParallel(), once a connection to the target host is available"""
+  semaphore = GetHostSemaphore(zone, database_set, instance)
+
+  with semaphore:
+    try:
+      _ApplyBatches(zone, database_set, instance, batches, totals, journal_path, journal_progress=True, stop_event=stop_event,
+                    throttle=throttle)
+
+    except Exception:
+      stop_event.set()
+      raise
+
+
+def _NewApplyTotals(batch_count):
+  """Returns dict of apply totals, shared by the threads applying batches"""
+  return {'batches':0, 'statements':0, 'bytes':0, 'seconds':0.0, 'batch_count':batch_count, 'lock':threading.Lock()}
+
+
+def _ApplyBatches(zone, database_set, instance, batches, totals, journal_path, journal_progress=False, stop_event=None, throttle=None):
+  """Apply batches in order, on 1 connection held by this thread, and add them to totals.
+
+  After each batch, the journal (if any) gets its end position, or if journal_progress is True, the
+  progress of each of its commands.  If stop_event is set, no more batches are started.  If there is
+  a throttle, each batch waits on it, and is split to its current transaction size.
+  """
+  if not batches:
+    return
+
+  # Get the connection information once, not per statement
+  (query_module, host, database, user, password, port, zone_data) = GetZoneConnectionInfo(zone, database_set, instance)
+  port = int(port)
+  max_bytes = GetStatementByteBudget(zone, database_set, instance)
+
+  # Hold 1 connection for all the batches, every Execute() uses it
+  (conn, cursor) = query_module.Connect(host, user, password, database, port)
+  cursor.close()
+
+  try:
+    for planned_batch in batches:
+      for batch in _IterThrottledBatch(planned_batch, throttle, totals):
+        if stop_event != None and stop_event.is_set():
+          log('Stopping, another lane failed')
+          return
+
+        start_time = time.time()
+
+        # Parallel lanes each have a batch in flight, so a resume needs to know which ones may be committed
+        if journal_path and journal_progress:
+          apply_journal.Begin(journal_path, batch['positions'])
+
+        statements = batch['statements']
+        if batch['replay']:
+          statements = [GetReplaySql(statement) for statement in statements]
+
+        try:
+          query_module.Execute(statements, host=host, user=user, password=password, database=database, port=port,
+                               transaction=batch['transaction'], max_bytes=max_bytes)
+
+        except query_module.QueryFailure as exc:
+          # DDL commits itself, so a replayed DDL batch may already be applied
+          if not (batch['replay'] and not batch['transaction'] and str(exc.code) in [str(code) for code in REPLAY_APPLIED_ERROR_CODES]):
+            raise
+
+          log('Replayed DDL was already applied: %s: %s' % (statements[0][:100], exc))
+
+        #NOTE(g): If we die between the commit and this, the batch is applied again on resume, as a replay batch
+        if journal_path and journal_progress:
+          apply_journal.CommitProgress(journal_path, batch['progress'])
+        elif journal_path:
+          apply_journal.Commit(journal_path, batch['end'])
+
+        duration = time.time() - start_time
+        batch_bytes = sum([len(statement) for statement in batch['statements']])
+
+        with totals['lock']:
+          totals['batches'] += 1
+          totals['statements'] += len(batch['statements'])
+          totals['bytes'] += batch_bytes
+          totals['seconds'] += duration
+          batch_number = totals['batches']
+
+        log('  Batch %s/%s: %s statements, %s bytes, %.2f seconds, %.1f statements/second' % (batch_number, totals['batch_count'],
+            len(batch['statements']), batch_bytes, duration, len(batch['statements']) / max(duration, 0.001)))
+
+  finally:
+    query_module.Release(host, user, password, database, port)
+
+
+def _IterThrottledBatch(batch, throttle, totals):
+  """Yields the batch, or if there is a throttle, slices of it no bigger than the throttle's transaction size, waiting on it before each"""
+  if throttle == None:
+    yield batch
+    return
+
+  offset = 0
+  while offset < len(batch['statements']):
+    throttle.Wait()
+
+    sliced_batch = SliceApplyBatch(batch, offset, offset + throttle.transaction_size)
+    offset += len(sliced_batch['statements'])
+
+    # The batch was split, so there is 1 more to apply
+    if offset < len(batch['statements']):
+      with totals['lock']:
+        totals['batch_count'] += 1
+
+    yield sliced_batch
+
+
+def SliceApplyBatch(batch, start_index, end_index):
+  """Returns batch dict of the statements of an apply batch from start_index to end_index, with their end and progress"""
+  positions = batch['positions'][start_index:end_index]
+
+  if end_index >= len(batch['statements']):
+    end = batch['end']
+  else:
+    (command_index, statement_index) = positions[-1]
+    end = (command_index, statement_index + 1)
+
+  progress = {}
+  for (command_index, statement_index) in positions:
+    progress[command_index] = statement_index + 1
+
+  return {'statements':batch['statements'][start_index:end_index], 'transaction':batch['transaction'], 'positions':positions,
+          'end':end, 'progress':sorted(progress.items()), 'replay':batch['replay']}
+
+
+def GetApplyBatches(sync_commands, transaction_size, start=None, progress=None, command_indexes=None, replay_positions=None):
+  """Returns list of dicts, the statements of sync_commands grouped into the batches SyncTargetZone() runs.
+
+  Each batch is: statements (list of strings), transaction (boolean, False for DDL, which runs alone),
+  end: (command index, statement index), the position of the next statement after this batch, where
+  the statement index counts the statements of that command, with nested lists flattened, and
+  progress: list of (command index, statement index) after the batch, for each command it has statements from,
+  positions: list of (command index, statement index) of each statement, so a batch can be sliced, and
+  replay: boolean, True if the batch may already be committed, so it is run with GetReplaySql().
+
+  If start is a (command index, statement index), the statements before it are left out.  If progress is
+  a dict of command index to the number of its statements already applied, those are left out too.  Either
+  means a sync is being resumed, and the first batch is a replay: it may have been committed after the
+  journal's last commit line was written.  So is every batch with a statement in replay_positions, a list of
+  (command index, statement index) the journal has begin lines for, but no commit: the batches parallel lanes
+  were applying, whatever the workers of the resume.
+
+  If command_indexes is a list, only those commands are batched, in that order.
+  """
+  # Resuming, so the first batch may have been applied already
+  replay = (start != None or progress != None)
+
+  if start == None:
+    start = (0, 0)
+  start = tuple(start)
+
+  if progress == None:
+    progress = {}
+
+  if command_indexes == None:
+    command_indexes = range(len(sync_commands))
+
+  batches = []
+  batch = {'statements':[], 'transaction':True, 'progress':{}, 'positions':[]}
+  # Number of statements in each command
+  statement_counts = {}
+  command_index = -1
+
+  for command_index in command_indexes:
+    command_statements = FlattenCommand(sync_commands[command_index])
+    statement_counts[command_index] = len(command_statements)
+
+    for (statement_index, statement) in enumerate(command_statements):
+      # Already applied
+      if (command_index, statement_index) < start or statement_index < progress.get(command_index, 0):
+        continue
+
+      # DDL commits any open transaction, so end the batch before it, and run it alone
+      if statement.split(' ')[0].upper() in IMPLICIT_COMMIT_COMMANDS:
+        if batch['statements']:
+          batch['end'] = (command_index, statement_index)
+          batches.append(batch)
+          batch = {'statements':[], 'transaction':True, 'progress':{}, 'positions':[]}
+
+        batches.append({'statements':[statement], 'transaction':False, 'end':(command_index, statement_index + 1),
+                        'progress':{command_index:statement_index + 1}, 'positions':[(command_index, statement_index)]})
+        continue
+
+      batch['statements'].append(statement)
+      batch['progress'][command_index] = statement_index + 1
+      batch['positions'].append((command_index, statement_index))
+
+      if len(batch['statements']) >= transaction_size:
+        batch['end'] = (command_index, statement_index + 1)
+        batches.append(batch)
+        batch = {'statements':[], 'transaction':True, 'progress':{}, 'positions':[]}
+
+  if batch['statements']:
+    batch['end'] = (command_index + 1, 0)
+    batches.append(batch)
+
+  for batch in batches:
+    # A batch ending on the last statement of a command ends at the start of the next command
+    (end_command_index, end_statement_index) = batch['end']
+    if end_command_index in statement_counts and end_statement_index == statement_counts[end_command_index]:
+      batch['end'] = (end_command_index + 1, 0)
+
+    batch['progress'] = sorted(batch['progress'].items())
+    batch['replay'] = False
+
+  if batches and replay:
+    batches[0]['replay'] = True
+
+  if replay_positions:
+    replay_positions = set([tuple(position) for position in replay_positions])
+
+    for batch in batches:
+      for position in batch['positions']:
+        if position in replay_positions:
+          batch['replay'] = True
+          break
+
+  return batches
+
+
+def GetReplaySql(statement):
+  """Returns string, the statement so it can be run again after it was committed: plain INSERTs become INSERT IGNORE,
+  CREATE TABLE gets IF NOT EXISTS, and DROP TABLE gets IF EXISTS.
+
+  Upserts, UPDATEs, DELETEs and LOAD DATA LOCAL (which ignores duplicate keys) already can be.  ALTERs that were
+  already applied fail with REPLAY_APPLIED_ERROR_CODES, which _ApplyBatches() ignores for replays.  Rows of tables
+  without a primary key cant be told apart, so a replay can insert or delete an extra copy of a duplicate row,
+  which the next compare finds.
+  """
+  if statement.startswith('INSERT INTO ') and ' ON DUPLICATE KEY UPDATE ' not in statement:
+    return 'INSERT IGNORE INTO ' + statement[len('INSERT INTO '):]
+
+  if statement.upper().startswith('CREATE TABLE ') and not statement.upper().startswith('CREATE TABLE IF NOT EXISTS '):
+    return 'CREATE TABLE IF NOT EXISTS ' + statement[len('CREATE TABLE '):]
+
+  if statement.upper().startswith('DROP TABLE ') and not statement.upper().startswith('DROP TABLE IF EXISTS '):
+    return 'DROP TABLE IF EXISTS ' + statement[len('DROP TABLE '):]
+
+  return statement
+
+
+def SplitApplyCommands(sync_commands):
+  """Returns (serial_indexes, table_indexes): commands that must be applied serially, and the rest by table.
+
+  serial_indexes is a list of command indexes: commands with DDL, or that dont touch exactly 1 table.
+  table_indexes is a dict keyed on table name, of lists of command indexes, in order.
+  """
+  serial_indexes = []
+  table_indexes = {}
+
+  for (command_index, command) in enumerate(sync_commands):
+    statements = FlattenCommand(command)
+    if not statements:
+      continue
+
+    tables = set()
+    serial = False
+    for statement in statements:
+      if statement.split(' ')[0].upper() in IMPLICIT_COMMIT_COMMANDS:
+        serial = True
+
+      tables.add(GetStatementTable(statement))
+
+    if serial or len(tables) != 1 or None in tables:
+      serial_indexes.append(command_index)
+    else:
+      table_indexes.setdefault(tables.pop(), []).append(command_index)
+
+  return (serial_indexes, table_indexes)
+
+
+def GetStatementTable(statement):
+  """Returns string, the table a DML statement writes to, or None if it isnt known"""
+  match = STATEMENT_TABLE_REGEX.match(statement)
+  if match:
+    return match.group(1)
+
+  return None
+
+
+def GetApplyLanes(zone, database_set, instance, sync_commands, table_indexes):
+  """Returns list of lists of command indexes, each a lane that can be applied in parallel with the others.
+
+  Tables connected by foreign keys are in the same lane.  Its deletes go first, child tables before
+  their parents, then the other commands, parent tables before their children, so foreign keys are
+  never broken.  Lanes of a single table keep their command order.  Biggest lanes are first.
+  """
+  tables = list(table_indexes.keys())
+
+  # Foreign keys between the tables we are applying to.  SyncTargetZoneParallel() calls this after the DDL is applied,
+  #   so the zone has the schema they are applied to.
+  references = {}
+  for table in tables:
+    references[table] = (GetTableForeignKeys(zone, database_set, instance, table) & set(tables)) - set([table])
+
+  # Group tables connected by foreign keys, in either direction
+  components = {}
+  for table in tables:
+    components[table] = set([table])
+
+  for table in tables:
+    for parent in references[table]:
+      if components[table] is not components[parent]:
+        merged = components[table] | components[parent]
+        for member in merged:
+          components[member] = merged
+
+  lanes = []
+  seen = set()
+  for table in tables:
+    component = components[table]
+    if id(component) in seen:
+      continue
+    seen.add(id(component))
+
+    if len(component) == 1:
+      lanes.append(list(table_indexes[table]))
+      continue
+
+    order = SortTablesByForeignKeys([member for member in tables if member in component], references)
+
+    lane = []
+    for member in reversed(order):
+      lane += [command_index for command_index in table_indexes[member] if IsDeleteCommand(sync_commands[command_index])]
+    for member in order:
+      lane += [command_index for command_index in table_indexes[member] if not IsDeleteCommand(sync_commands[command_index])]
+
+    lanes.append(lane)
+
+  lanes.sort(key=len, reverse=True)
+
+  return lanes
+
+
+def SortTablesByForeignKeys(tables, references):
+  """Returns list of tables, parents (referenced tables) before the children that reference them.
+
+  Tables in a foreign key cycle keep their given order, after the tables that can be sorted.
+  """
+  ordered = []
+  remaining = list(tables)
+
+  while remaining:
+    ready = [table for table in remaining if not (references[table] & set(remaining))]
+
+    if not ready:
+      log('Foreign key cycle, applying in command order: %s' % ', '.join(remaining))
+      ordered += remaining
+      break
+
+    ordered += ready
+    remaining = [table for table in remaining if table not in ready]
+
+  return ordered
+
+
+def GetTableForeignKeys(zone, database_set, instance, table):
+  """Returns set of table names this zone's table references with foreign keys, parsed from its CREATE TABLE"""
+  schema = GetSchema(zone, database_set, instance)
+  if table not in schema:
+    return set()
+
+  create_sql = GetTableCreateSql(zone, database_set, instance, table, schema[table])
+  if not create_sql:
+    return set()
+
+  return set(FOREIGN_KEY_REGEX.findall(create_sql))
+
+
+def IsForeignKeyReferenced(zone, database_set, instance, table):
+  """Returns boolean, True if any of this zone's tables, this one included, has a foreign key referencing this table"""
+  for other_table in GetSchema(zone, database_set, instance):
+    if table in GetTableForeignKeys(zone, database_set, instance, other_table):
+      return True
+
+  return False
+
+
+def IsUpsertSafe(zone, database_set, instance, table, table_schema):
+  """Returns boolean, True if this zone's table can be updated with upserts (INSERT ... ON DUPLICATE KEY UPDATE).
+
+  Only if the primary key is its only unique key.  An upsert that collides on another unique key updates that
+  row instead, and without a primary key it never collides, so it inserts.
+  """
+  if not table_schema['__PRIMARY_KEYS__']:
+    return False
+
+  create_sql = GetTableCreateSql(zone, database_set, instance, table, table_schema)
+  if not create_sql:
+    return False
+
+  return not UNIQUE_KEY_REGEX.search(create_sql)
+
+
+def IsDeleteCommand(command):
+  """Returns boolean, True if the command's statements are DELETEs"""
+  statements = FlattenCommand(command)
+
+  return bool(statements) and statements[0].split(' ')[0].upper() == 'DELETE'
+
+
+def FlattenCommand(command):
+  """Returns list of strings, the SQL statements of a sync command, which may be a string or nested lists.
+
+  Empty commands (None or ''), which only keep forward and reverse commands paired, have no statements.
+  """
+  if type(command) == list:
+    statements = []
+    for item in command:
+      statements += FlattenCommand(item)
+
+    return statements
+
+  elif command:
+    return [command]
+
+  else:
+    return []
+
+
+def GetApplyThrottle(zone, database_set, instance, transaction_size):
+  """Returns ApplyThrottle for syncing into this zone, or None if the zone database set has no throttle.
+
+  transaction_size is the most statements per batch, the throttle only makes batches smaller.
   """
-  if depth == 0:
-    log('Sync Target Zone: %s %s %s' % (zone, database_set, instance))
+  (query_module, host, database, user, password, port, zone_data) = GetZoneConnectionInfo(zone, database_set, instance)
 
-  # Process all the commands (SQL strings or lists of SQL strings)
-  for command in sync_commands:
-    # If this is an embedded list of commands, recurse and process them
-    if type(command) == list:
-      SyncTargetZone(zone, database_set, instance, command, depth=depth+1)
+  throttle = zone_data.get('throttle')
+  if not throttle:
+    return None
 
-    # Else, make the query to satisfy this command
+  # The target itself is always sampled, its load is what the sync adds to
+  hosts = [(host, int(port))]
+  for throttle_host in throttle['hosts']:
+    if ':' in throttle_host:
+      (throttle_host, throttle_port) = throttle_host.rsplit(':', 1)
+      hosts.append((throttle_host, int(throttle_port)))
     else:
-      log('  %s' % command)
-      Query(zone, database_set, instance, command)
+      hosts.append((throttle_host, int(port)))
+
+  return ApplyThrottle(query_module, hosts, user, password, database, transaction_size,
+                       max_replica_lag=throttle.get('max_replica_lag'), max_threads_running=throttle.get('max_threads_running'),
+                       interval=throttle.get('interval', DEFAULT_THROTTLE_INTERVAL), max_wait=throttle.get('max_wait', DEFAULT_THROTTLE_MAX_WAIT))
+
+
+class ApplyThrottle:
+  """Paces a sync by the replication lag and load of hosts, usually the target's replicas.  Shared by the threads applying batches.
+
+  Before each batch, Wait() samples the hosts, at most every interval seconds: replication lag from SHOW SLAVE
+  STATUS, and Threads_running.  If a host is over a limit, the transaction size is halved, and Wait() pauses until
+  they are all back under the limits.  While they are well under (half the limits) the transaction size grows
+  back, a step at a time, up to max_transaction_size.
+  """
+
+  def __init__(self, query_module, hosts, user, password, database, max_transaction_size, max_replica_lag=None, max_threads_running=None,
+               interval=DEFAULT_THROTTLE_INTERVAL, max_wait=DEFAULT_THROTTLE_MAX_WAIT):
+    """
+    Args:
+      hosts: list of (host, port) tuples to sample.  They use the zone's user and password.
+      max_replica_lag: int, seconds, or None to not check lag
+      max_threads_running: int, or None to not check load
+    """
+    self.query_module = query_module
+    self.hosts = hosts
+    self.user = user
+    self.password = password
+    self.database = database
+    self.max_transaction_size = max_transaction_size
+    self.max_replica_lag = max_replica_lag
+    self.max_threads_running = max_threads_running
+    self.interval = float(interval)
+    self.max_wait = float(max_wait)
+
+    self.transaction_size = max_transaction_size
+    # Seconds spent paused, for the totals
+    self.waited_seconds = 0.0
+
+    #NOTE(g): Held while sampling and pausing, so when 1 lane pauses, every lane pauses
+    self._lock = threading.Lock()
+    self._last_sample_time = 0
+
+
+  def Wait(self):
+    """Wait until the hosts are under the limits, and adjust the transaction size.  Returns at once between samples."""
+    with self._lock:
+      if time.time() < self._last_sample_time + self.interval:
+        return
+
+      wait_start = time.time()
+      samples = self.Sample()
+      over_limits = self.GetOverLimits(samples)
+
+      if not over_limits:
+        self._last_sample_time = time.time()
+
+        # Well under the limits, grow back a step
+        if not self.GetOverLimits(samples, fraction=0.5):
+          self.transaction_size = min(self.max_transaction_size, self.transaction_size + max(1, self.max_transaction_size // 10))
+
+        return
+
+      # Back off, and stay smaller after the hosts recover, growing back slowly
+      self.transaction_size = max(1, self.transaction_size // 2)
+
+      while over_limits:
+        if time.time() - wait_start > self.max_wait:
+          raise ThrottleTimeout('Throttle hosts over their limits for more than %s seconds: %s' % (self.max_wait, '; '.join(over_limits)))
+
+        log('Throttling, transaction size %s: %s' % (self.transaction_size, '; '.join(over_limits)))
+        time.sleep(self.interval)
+
+        over_limits = self.GetOverLimits(self.Sample())
+
+      self._last_sample_time = time.time()
+      self.waited_seconds += time.time() - wait_start
+
+
+  def GetOverLimits(self, samples, fraction=1.0):
+    """Returns list of strings, describing each limit (times fraction) a host in samples is over.  Empty if they are all under."""
+    over_limits = []
+
+    for (host, port, replica_lag, threads_running) in samples:
+      if self.max_replica_lag != None:
+        #NOTE(g): None is a replica whose replication is stopped, its lag is unknown and growing
+        if replica_lag == None:
+          over_limits.append('%s:%s replication stopped' % (host, port))
+        elif replica_lag > self.max_replica_lag * fraction:
+          over_limits.append('%s:%s lag %s > %s' % (host, port, replica_lag, self.max_replica_lag * fraction))
+
+      if self.max_threads_running != None and threads_running > self.max_threads_running * fraction:
+        over_limits.append('%s:%s threads running %s > %s' % (host, port, threads_running, self.max_threads_running * fraction))
+
+    return over_limits
+
+
+  def Sample(self):
+    """Returns list of (host, port, replica_lag, threads_running) tuples.  replica_lag is 0 if the host isnt a replica.
+
+    A host that cant be queried is returned as stopped and fully loaded, so the sync waits instead of guessing.
+    """
+    samples = []
+
+    for (host, port) in self.hosts:
+      try:
+        replica_lag = 0
+        if self.max_replica_lag != None:
+          rows = self._Query(host, port, 'SHOW SLAVE STATUS')
+          if rows:
+            replica_lag = rows[0]['Seconds_Behind_Master']
+
+        threads_running = 0
+        if self.max_threads_running != None:
+          rows = self._Query(host, port, "SHOW GLOBAL STATUS LIKE 'Threads_running'")
+          threads_running = int(rows[0]['Value'])
+
+      except self.query_module.QueryFailure as exc:
+        log('Throttle host could not be sampled: %s:%s: %s' % (host, port, exc))
+        (replica_lag, threads_running) = (None, float('inf'))
+
+      samples.append((host, port, replica_lag, threads_running))
+
+    return samples
+
+
+  def _Query(self, host, port, sql):
+    """Returns list of dicts.  Runs on a pooled connection directly, so status is never a cached result."""
+    query_module = self.query_module
+
+    try:
+      (conn, cursor) = query_module.Connect(host, self.user, self.password, self.database, port)
+    except Exception as exc:
+      raise query_module.QueryFailure('Could not connect: %s' % exc)
+
+    discard = False
+    try:
+      cursor.execute(sql)
+      return cursor.fetchall()
+
+    #NOTE(g): SHOW statements only fail on a broken connection
+    except Exception as exc:
+      discard = True
+      raise query_module.QueryFailure(str(exc))
+
+    finally:
+      cursor.close()
+      query_module.Release(host, self.user, self.password, self.database, port, discard=discard)
 
 
 def GenerateSchemaDiffKeyDictionary(zone_source, zone_target, database_set, instance, diff):
@@ -723,6 +3419,9 @@ def GenerateDataDiffKeyDictionary(zone_source, zone_target, database_set, instan
     # Get the schemas for the tables, each time so that they can be matches together
     (table_schema_source, table_schema_target) = GetTableSchema(zone_source, zone_target, database_set, instance, table, selected_schema_keys=selected_schema_keys)
 
+    # Keys hold dict rows, since they are passed to other systems
+    table_diff = table_diff.ToDict()
+
     # Alter - Add Column
     for item in table_diff['insert']:
       primary_key = GeneratePrimaryKeyId(table_schema_source, item)
@@ -0,0 +1,314 @@
+"""
+Zone Snapshot
+
+Offline copy of a zone database set instance: its schema, and all its rows in primary key order, so
+it can be compared against like a live zone, without connecting to the zone again.
+
+A snapshot is a file of frames, after a magic line.  Every frame is a header (4 byte kind, payload
+length, CRC32 of the payload) and a zlib compressed pickle payload.  The frames are the snapshot
+header, the schema, then for each table a table frame, its rows in chunks, and a table end frame with
+its row count, and last a done frame, so a truncated snapshot is refused.  Chunks are columnar, a list
+of values for each field, which compresses far better than rows, and only the fields asked for are
+taken from them.  Each chunk's checksum is verified when it is read.
+"""
+
+
+import os
+import io
+import zlib
+import time
+import struct
+import pickle
+
+from AbsoluteImport import Import
+
+log = Import('log', prefix='unidist').log
+
+
+# Directory snapshots are written to, unless a path is given
+SNAPSHOT_PATH = os.environ.get('DBSYNC_SNAPSHOT_PATH', os.path.expanduser('~/.dbsync/snapshot'))
+
+# Bump this when the snapshot format changes, so old snapshots are refused instead of misread
+SNAPSHOT_VERSION = 1
+
+SNAPSHOT_MAGIC = b'DBSYNC SNAPSHOT\n'
+
+# Rows per chunk.  Bigger chunks compress better, and are held in memory while read or written.
+SNAPSHOT_CHUNK_ROWS = 5000
+
+SNAPSHOT_COMPRESS_LEVEL = 6
+
+# Frame header: kind, payload length, payload CRC32
+FRAME_HEADER = struct.Struct('>4sII')
+
+FRAME_HEADER_KIND = b'HEAD'
+FRAME_SCHEMA = b'SCHM'
+FRAME_TABLE = b'TABL'
+FRAME_CHUNK = b'CHNK'
+FRAME_TABLE_END = b'TEND'
+FRAME_DONE = b'DONE'
+
+# Types row values can be unpickled as, besides the ones pickle has opcodes for.  Nothing else is loaded.
+SAFE_PICKLE_CLASSES = {
+  'builtins': ('set', 'frozenset', 'bytearray', 'complex'),
+  'datetime': ('date', 'datetime', 'time', 'timedelta', 'timezone'),
+  'decimal': ('Decimal',),
+}
+
+
+class SnapshotError(Exception):
+  """Snapshot file is missing, corrupt, truncated or from a different version."""
+
+
+class SnapshotWriter:
+  """Writes a snapshot file.  WriteTable() every table in the schema, then Close().
+
+  The snapshot is written to a temp file, and only renamed into place by Close(), so a snapshot at
+  path is always complete.  Abort() removes the temp file.
+  """
+
+  def __init__(self, path, database_set, zone, instance, schema, chunk_rows=SNAPSHOT_CHUNK_ROWS):
+    self.path = path
+    self.chunk_rows = max(1, int(chunk_rows))
+
+    # Row count of each written table
+    self.tables = {}
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory, exist_ok=True)
+
+    self._temp_path = '%s.%s.tmp' % (path, os.getpid())
+    self._file = open(self._temp_path, 'wb')
+    self._file.write(SNAPSHOT_MAGIC)
+
+    header = {'snapshot':SNAPSHOT_VERSION, 'database_set':database_set, 'zone':zone, 'instance':instance, 'created':time.time()}
+    self._WriteFrame(FRAME_HEADER_KIND, header)
+    self._WriteFrame(FRAME_SCHEMA, schema)
+
+
+  def WriteTable(self, table, fields, rows):
+    """Write all the tuple rows of a table, with values in the order of fields.  Returns int, the row count."""
+    fields = tuple(fields)
+    self._WriteFrame(FRAME_TABLE, {'table':table, 'fields':fields})
+
+    row_count = 0
+    chunk_count = 0
+    chunk = []
+
+    for row in rows:
+      chunk.append(row)
+
+      if len(chunk) >= self.chunk_rows:
+        self._WriteChunk(fields, chunk)
+        row_count += len(chunk)
+        chunk_count += 1
+        chunk = []
+
+    if chunk:
+      self._WriteChunk(fields, chunk)
+      row_count += len(chunk)
+      chunk_count += 1
+
+    self._WriteFrame(FRAME_TABLE_END, {'table':table, 'rows':row_count, 'chunks':chunk_count})
+    self.tables[table] = row_count
+
+    return row_count
+
+
+  def Close(self):
+    """Finish the snapshot, and move it into place.  It is on disk before this returns."""
+    self._WriteFrame(FRAME_DONE, {'tables':self.tables})
+
+    self._file.flush()
+    os.fsync(self._file.fileno())
+    self._file.close()
+
+    os.replace(self._temp_path, self.path)
+
+    log('Snapshot written: %s: %s tables, %s rows' % (self.path, len(self.tables), sum(self.tables.values())))
+
+
+  def Abort(self):
+    """Stop writing, and remove the unfinished snapshot"""
+    self._file.close()
+
+    if os.path.exists(self._temp_path):
+      os.remove(self._temp_path)
+
+
+  def _WriteChunk(self, fields, chunk):
+    """Write rows as a columnar chunk: a list of values for each field"""
+    if len(chunk[0]) != len(fields):
+      raise SnapshotError('Row has %s values, table has %s fields' % (len(chunk[0]), len(fields)))
+
+    self._WriteFrame(FRAME_CHUNK, [list(column) for column in zip(*chunk)])
+
+
+  def _WriteFrame(self, kind, data):
+    payload = zlib.compress(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL), SNAPSHOT_COMPRESS_LEVEL)
+
+    self._file.write(FRAME_HEADER.pack(kind, len(payload), zlib.crc32(payload)))
+    self._file.write(payload)
+
+
+class Snapshot:
+  """Reads a snapshot file.  The header and schema are loaded, and the chunks are read as rows are asked for."""
+
+  def __init__(self, path):
+    self.path = path
+
+    # Per table: {'fields':tuple, 'rows':int, 'chunks':list of (offset, length, crc)}
+    self.tables = {}
+
+    with open(path, 'rb') as snapshot_file:
+      if snapshot_file.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+        raise SnapshotError('Not a snapshot: %s' % path)
+
+      self.header = self._ReadFrameData(snapshot_file, FRAME_HEADER_KIND)
+      if self.header.get('snapshot') != SNAPSHOT_VERSION:
+        raise SnapshotError('Snapshot version %s is not supported, expected %s: %s' % (self.header.get('snapshot'), SNAPSHOT_VERSION, path))
+
+      self.schema = self._ReadFrameData(snapshot_file, FRAME_SCHEMA)
+
+      self._ReadIndex(snapshot_file)
+
+    self.database_set = self.header['database_set']
+    self.zone = self.header['zone']
+    self.instance = self.header['instance']
+    self.created = self.header['created']
+
+
+  def __repr__(self):
+    return 'Snapshot(%s: %s %s %s, %s)' % (self.path, self.database_set, self.zone, self.instance,
+                                           time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.created)))
+
+
+  def GetRowCount(self, table):
+    """Returns int, rows in this table.  0 if the table isnt in the snapshot."""
+    if table not in self.tables:
+      return 0
+
+    return self.tables[table]['rows']
+
+
+  def IterRows(self, table, fields=None):
+    """Yields the rows of this table as tuples of the values of fields (default: all the fields), in primary key order.
+
+    Nothing is yielded if the table isnt in the snapshot.
+    """
+    if table not in self.tables:
+      return
+
+    table_info = self.tables[table]
+
+    if fields == None:
+      indexes = list(range(len(table_info['fields'])))
+    else:
+      try:
+        indexes = [table_info['fields'].index(field) for field in fields]
+      except ValueError as exc:
+        raise SnapshotError('Field not in snapshot table: %s: %s' % (table, exc))
+
+    with open(self.path, 'rb') as snapshot_file:
+      for (offset, length, crc) in table_info['chunks']:
+        snapshot_file.seek(offset)
+        columns = self._LoadPayload(snapshot_file.read(length), crc)
+
+        for row in zip(*[columns[index] for index in indexes]):
+          yield row
+
+
+  def _ReadIndex(self, snapshot_file):
+    """Find every table's chunks, without reading them"""
+    table = None
+
+    while True:
+      (kind, length, crc) = self._ReadFrameHeader(snapshot_file)
+
+      if kind == FRAME_CHUNK:
+        if table == None:
+          raise SnapshotError('Chunk outside a table: %s' % self.path)
+
+        self.tables[table]['chunks'].append((snapshot_file.tell(), length, crc))
+        snapshot_file.seek(length, io.SEEK_CUR)
+        continue
+
+      data = self._LoadPayload(snapshot_file.read(length), crc)
+
+      if kind == FRAME_TABLE:
+        table = data['table']
+        self.tables[table] = {'fields':tuple(data['fields']), 'rows':0, 'chunks':[]}
+
+      elif kind == FRAME_TABLE_END:
+        if data['table'] != table or data['chunks'] != len(self.tables[table]['chunks']):
+          raise SnapshotError('Table is missing chunks: %s: %s' % (data['table'], self.path))
+
+        self.tables[table]['rows'] = data['rows']
+        table = None
+
+      elif kind == FRAME_DONE:
+        if table != None or set(data['tables']) != set(self.tables):
+          raise SnapshotError('Snapshot is missing tables: %s' % self.path)
+        return
+
+      else:
+        raise SnapshotError('Unknown frame %s: %s' % (kind, self.path))
+
+
+  def _ReadFrameData(self, snapshot_file, expected_kind):
+    """Returns the data of the next frame, which must be of expected_kind"""
+    (kind, length, crc) = self._ReadFrameHeader(snapshot_file)
+    if kind != expected_kind:
+      raise SnapshotError('Expected %s frame, found %s: %s' % (expected_kind, kind, self.path))
+
+    return self._LoadPayload(snapshot_file.read(length), crc)
+
+
+  def _ReadFrameHeader(self, snapshot_file):
+    """Returns tuple (kind, length, crc) of the next frame"""
+    data = snapshot_file.read(FRAME_HEADER.size)
+    if len(data) != FRAME_HEADER.size:
+      raise SnapshotError('Snapshot is truncated: %s' % self.path)
+
+    return FRAME_HEADER.unpack(data)
+
+
+  def _LoadPayload(self, payload, crc):
+    """Returns the data of a frame payload, after checking its CRC"""
+    if zlib.crc32(payload) != crc:
+      raise SnapshotError('Snapshot checksum failed, the file is corrupt or truncated: %s' % self.path)
+
+    return _SnapshotUnpickler(io.BytesIO(zlib.decompress(payload))).load()
+
+
+class _SnapshotUnpickler(pickle.Unpickler):
+  """Unpickler that only loads SAFE_PICKLE_CLASSES, so a snapshot file cant run code"""
+
+  def find_class(self, module, name):
+    if name in SAFE_PICKLE_CLASSES.get(module, ()):
+      return super().find_class(module, name)
+
+    raise SnapshotError('Snapshot has a value of a type that isnt allowed: %s.%s' % (module, name))
+
+
+def Open(path):
+  """Returns Snapshot, read from this path, or raises SnapshotError"""
+  try:
+    return Snapshot(path)
+  except (OSError, EOFError, zlib.error, pickle.UnpicklingError, KeyError, TypeError) as exc:
+    raise SnapshotError('Cant read snapshot: %s: %s' % (path, exc))
+
+
+def IsSnapshotFile(path):
+  """Returns boolean, True if path is a snapshot file"""
+  try:
+    with open(path, 'rb') as snapshot_file:
+      return snapshot_file.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+  except (OSError, TypeError, ValueError):
+    return False
+
+
+def GetSnapshotPath(database_set, zone, instance):
+  """Returns string, path for a new snapshot of this zone database set instance"""
+  return '%s/%s.%s.%s.%s.snapshot' % (SNAPSHOT_PATH, database_set, zone, instance, time.strftime('%Y%m%d-%H%M%S'))